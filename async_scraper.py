@@ -0,0 +1,49 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+from scraper import GameScraper
+
+class AsyncGameScraper:
+    """
+    Scrape many game pages from a single event loop.
+
+    At most `concurrency` requests are in flight at any moment. The blocking
+    download and parse of each page run on a worker thread over the shared
+    pooled HttpClient, whose rate limiter paces them and waits out
+    Retry-After, so the event loop only schedules work.
+
+    Offers are emitted back on the event loop's thread. An `on_offers` writer
+    therefore never sees two pages at once and can use the caller's SQLite
+    connection.
+    """
+
+    def __init__(self, scraper=None, concurrency=8):
+        self.scraper = scraper or GameScraper()
+        self.concurrency = concurrency
+
+    async def scrape_game_data(self, game_url, semaphore, executor):
+        """Async counterpart of GameScraper.scrape_game_data, returning the same dict"""
+        loop = asyncio.get_running_loop()
+        try:
+            async with semaphore:
+                page = await loop.run_in_executor(executor, self.scraper.fetch_game_page, game_url)
+            return self.scraper.emit(game_url, page)
+        except requests.HTTPError as http_err:
+            print(f"HTTP error occurred: {http_err}")
+        except requests.RequestException as e:
+            print(f"Failed to fetch {game_url}: {e}")
+        return None
+
+    async def scrape_games(self, game_urls):
+        """Scrape all URLs concurrently and return {url: game_data} in input order"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = await asyncio.gather(
+                *(self.scrape_game_data(url, semaphore, executor) for url in game_urls)
+            )
+        return dict(zip(game_urls, results))
+
+    def run(self, game_urls):
+        """Synchronous entry point that drives the whole list through one event loop"""
+        return asyncio.run(self.scrape_games(list(game_urls)))
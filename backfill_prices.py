@@ -0,0 +1,86 @@
+"""
+Fill the numeric price and stock columns of rows stored before they existed.
+
+offers: amount / currency / stock are parsed from the price and in_stock texts.
+orders: legacy rows hold the tc-price text ("1.23 €") in the REAL price column;
+it is replaced by the amount, and its currency fills the currency column. A
+text with no amount in it is kept as it is.
+
+Rows are converted in chunks, walking the primary key, one commit per chunk.
+The scrapers can keep writing meanwhile, and an interrupted backfill resumes
+where it stopped.
+
+    python backfill_prices.py --db funpay.db --chunk 5000
+"""
+import argparse
+
+from db_manager import DatabaseManager
+from offers_store import setup_offer_tables
+from prices import normalize, parse_price
+
+CHUNK = 5000
+
+def backfill_offers(db, chunk=CHUNK):
+    """Parse amount, currency and stock for offers that have none of them; returns rows updated"""
+    last_id, updated = 0, 0
+    while True:
+        db.cursor.execute('''
+            SELECT offer_id, price, in_stock FROM offers
+            WHERE offer_id > ? AND amount IS NULL AND currency IS NULL AND stock IS NULL
+            ORDER BY offer_id LIMIT ?
+        ''', (last_id, chunk))
+        rows = db.cursor.fetchall()
+        if not rows:
+            return updated
+        last_id = rows[-1][0]
+        values = [(*normalize(price, in_stock), offer_id) for offer_id, price, in_stock in rows]
+        values = [row for row in values if row[:3] != (None, None, None)]
+        db.cursor.executemany("UPDATE offers SET amount = ?, currency = ?, stock = ? WHERE offer_id = ?", values)
+        db.conn.commit()
+        updated += len(values)
+        print(f"offers: {updated} updated, up to offer_id {last_id}")
+
+def backfill_orders(db, chunk=CHUNK):
+    """
+    Replace price texts in orders with their amount and currency; returns rows updated.
+    Texts that do not parse are left as they are, to be inspected or re-run.
+    """
+    last_id, updated = 0, 0
+    while True:
+        db.cursor.execute('''
+            SELECT order_id, price FROM orders
+            WHERE order_id > ? AND typeof(price) = 'text'
+            ORDER BY order_id LIMIT ?
+        ''', (last_id, chunk))
+        rows = db.cursor.fetchall()
+        if not rows:
+            return updated
+        last_id = rows[-1][0]
+        values = [(*parse_price(price), order_id) for order_id, price in rows]
+        values = [row for row in values if row[0] is not None]
+        db.cursor.executemany(
+            "UPDATE orders SET price = ?, currency = COALESCE(currency, ?) WHERE order_id = ?", values
+        )
+        db.conn.commit()
+        updated += len(values)
+        print(f"orders: {updated} updated, up to order_id {last_id}")
+
+def backfill(db_name='funpay.db', chunk=CHUNK):
+    """Backfill offers and orders in `db_name`; returns {"offers", "orders"} rows updated"""
+    db = DatabaseManager(db_name, start_run=False)
+    try:
+        # Adds the numeric columns and idx_offers_category_amount to an existing offers table
+        setup_offer_tables(db.cursor)
+        db.conn.commit()
+        return {"offers": backfill_offers(db, chunk), "orders": backfill_orders(db, chunk)}
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fill the numeric price / stock columns of existing offers and orders.")
+    parser.add_argument("--db", default="funpay.db")
+    parser.add_argument("--chunk", type=int, default=CHUNK, help="rows converted per transaction")
+    args = parser.parse_args()
+
+    counts = backfill(args.db, args.chunk)
+    print(f"Backfilled {counts['offers']} offers and {counts['orders']} orders.")
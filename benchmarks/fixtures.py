@@ -0,0 +1,160 @@
+"""
+Page corpus for the offline benchmarks.
+
+Pages recorded from funpay.com live in benchmarks/fixtures/ as home.html,
+lots/<id>.html and users/<id>.html. When nothing has been recorded, a
+deterministic synthetic corpus with the same markup is generated instead, so
+the benchmarks always run offline.
+
+Record a corpus with:
+    python -m benchmarks.fixtures --games 10 --users 50
+"""
+import argparse
+import random
+import re
+from pathlib import Path
+
+FIXTURES_DIR = Path(__file__).parent / "fixtures"
+ORIGIN = "https://funpay.com"
+
+CURRENCIES = ["€", "$", "₽"]
+SERVERS = ["EU", "NA", "Asia", "PC", "PS5", "Xbox"]
+WORDS = ["account", "gold", "level", "rare", "skin", "boost", "fast", "cheap",
+         "legendary", "items", "ranked", "instant", "delivery", "full", "access"]
+
+def _offer_row(rng, offer_id, user_id):
+    amount = rng.choice(["", f'<div class="tc-amount">{rng.randint(1, 5000):,}'.replace(",", " ") + "</div>"])
+    description = " ".join(rng.choice(WORDS) for _ in range(rng.randint(4, 14)))
+    return f'''
+  <a href="{ORIGIN}/en/lots/offer?id={offer_id}" class="tc-item">
+    <div class="tc-server hidden-xxs">{rng.choice(SERVERS)}</div>
+    <div class="tc-desc"><div class="tc-desc-text">{description}</div></div>
+    <div class="tc-user"><div class="media media-user">
+      <div class="media-left"><div class="avatar-photo" data-href="{ORIGIN}/en/users/{user_id}/" style="background-image: url(/img/layout/avatar.png);"></div></div>
+      <div class="media-body"><div class="media-user-name"><span class="pseudo-a">Seller{user_id}</span></div>
+        <div class="media-user-reviews"><div class="rating-stars rating-5"><i class="fas"></i></div><span class="rating-mini-count">{rng.randint(0, 900)}</span></div>
+      </div></div></div>
+    {amount}
+    <div class="tc-price" data-s="{rng.uniform(0.1, 500):.2f}"><div>{rng.uniform(0.1, 500):.2f} <span class="unit">{rng.choice(CURRENCIES)}</span></div></div>
+  </a>'''
+
+def _page(title, body):
+    # Padding similar to the real header/footer so parse cost covers the whole document
+    chrome = "".join(f'<li><a href="/en/lots/{i}/">Menu entry {i}</a></li>' for i in range(300))
+    return f'''<!DOCTYPE html>
+<html lang="en"><head><meta charset="utf-8"><title>{title}</title>
+<script>window._locale = "en";</script></head>
+<body><header><nav><ul class="dropdown-menu">{chrome}</ul></nav></header>
+<div class="wrapper"><div class="content">{body}</div></div>
+<footer><ul>{chrome}</ul></footer></body></html>'''
+
+def generate_corpus(seed=0, games=20, offers_per_page=300, users=100):
+    """Return {path: html} for a synthetic home page, `games` lot pages and `users` profiles"""
+    rng = random.Random(seed)
+    corpus = {}
+    user_ids = list(range(1000, 1000 + users))
+
+    items = []
+    for game_id in range(1, games + 1):
+        lots = "".join(f'<li><a href="/en/lots/{game_id * 10 + k}/">Lot {k}</a></li>' for k in range(3))
+        items.append(f'''
+<div class="promo-game-item"><div class="game-title" data-id="{game_id}"><a href="/en/lots/{game_id}/">Game {game_id}</a></div>
+<ul class="list-inline">{lots}</ul></div>''')
+    corpus["/en/"] = _page("FunPay", "".join(items))
+
+    offer_id = 1
+    for game_id in range(1, games + 1):
+        counters = "".join(f'''
+<a href="/en/lots/{game_id}/" class="counter-item"><div class="inside"><div class="counter-param">{name}</div>
+<div class="counter-value">{rng.randint(0, 20000)}</div></div></a>''' for name in ("Accounts", "Items", "Boosting", "Gold"))
+        rows = []
+        for _ in range(offers_per_page):
+            rows.append(_offer_row(rng, offer_id, rng.choice(user_ids)))
+            offer_id += 1
+        body = f'<div class="counter-list">{counters}</div><div class="tc table-hover">{"".join(rows)}</div>'
+        page = _page(f"Game {game_id}", body)
+        corpus[f"/en/lots/{game_id}/"] = page
+        for k in range(3):
+            corpus[f"/en/lots/{game_id * 10 + k}/"] = page
+
+    for user_id in user_ids:
+        if rng.random() < 0.1:
+            corpus[f"/en/users/{user_id}/"] = _page("Error", "<div class=\"page-content\"><p>User not found</p></div>")
+            continue
+        sections = []
+        for _ in range(rng.randint(0, 4)):
+            rows = []
+            for _ in range(rng.randint(1, 30)):
+                rows.append(_offer_row(rng, offer_id, user_id))
+                offer_id += 1
+            sections.append(f'''
+<div class="offer"><div class="offer-list-title-container"><div class="offer-list-title"><h3><a href="/en/lots/{rng.randint(1, games)}/">Game {rng.randint(1, games)} Accounts</a></h3></div></div>
+<div class="tc table-hover">{"".join(rows)}</div></div>''')
+        online = "Online" if rng.random() < 0.3 else "Was online 2 days ago"
+        body = f'''
+<div class="profile-header"><h1 class="mb40"><span class="mr4">Seller{user_id}</span><span class="media-user-status">{online}</span></h1>
+<div class="param-item"><h5>Registration date</h5><div class="text-nowrap">{rng.randint(1, 28)} September 2023, {rng.randint(0, 23)}:{rng.randint(0, 59):02d}<br>1 year ago</div></div>
+<div class="rating-value"><span class="big">{rng.uniform(3, 5):.1f}</span></div>
+<div class="rating-full-count">{rng.randint(0, 5000)} reviews</div></div>
+{"".join(sections)}'''
+        corpus[f"/en/users/{user_id}/"] = _page(f"Seller{user_id}", body)
+
+    return corpus
+
+def _fixture_path(directory, url_path):
+    if url_path == "/en/":
+        return directory / "home.html"
+    kind, page_id = re.match(r"^/en/(lots|users)/(\d+)/$", url_path).groups()
+    return directory / kind / f"{page_id}.html"
+
+def load_corpus(directory=FIXTURES_DIR):
+    """Return {path: html} for a recorded corpus, or {} if none was recorded"""
+    corpus = {}
+    if (directory / "home.html").exists():
+        corpus["/en/"] = (directory / "home.html").read_text(encoding="utf-8")
+    for kind in ("lots", "users"):
+        for path in sorted((directory / kind).glob("*.html")):
+            corpus[f"/en/{kind}/{path.stem}/"] = path.read_text(encoding="utf-8")
+    return corpus
+
+def get_corpus(directory=FIXTURES_DIR, **synthetic_options):
+    """Recorded corpus if there is one, the synthetic corpus otherwise"""
+    return load_corpus(directory) or generate_corpus(**synthetic_options)
+
+def record_corpus(directory=FIXTURES_DIR, games=10, users=50):
+    """Download the home page, the first `games` lot pages and `users` seller profiles from funpay.com"""
+    import requests
+    from extractors import extract
+
+    session = requests.Session()
+    session.headers["User-Agent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+    def save(url_path):
+        response = session.get(ORIGIN + url_path, timeout=30)
+        response.raise_for_status()
+        path = _fixture_path(directory, url_path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(response.text, encoding="utf-8")
+        print(f"Recorded {url_path}")
+        return response.text
+
+    home = save("/en/")
+    user_paths = []
+    for game in extract("home_page", home)["games"][:games]:
+        url_path = re.sub(r"^https?://[^/]+", "", game["url"])
+        page = save(url_path)
+        for offer in extract("game_page", page)["offers"]:
+            user_path = re.sub(r"^https?://[^/]+", "", offer["avatar_href"] or "")
+            if user_path and user_path not in user_paths:
+                user_paths.append(user_path)
+
+    for user_path in user_paths[:users]:
+        save(user_path)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Record a FunPay page corpus for the benchmarks.")
+    parser.add_argument("--games", type=int, default=10, help="number of lot pages to record")
+    parser.add_argument("--users", type=int, default=50, help="number of seller profiles to record")
+    parser.add_argument("--dir", type=Path, default=FIXTURES_DIR, help="corpus directory")
+    args = parser.parse_args()
+    record_corpus(args.dir, args.games, args.users)
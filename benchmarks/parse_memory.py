@@ -0,0 +1,117 @@
+"""
+Peak memory and parse time per page, full versus partial parsing.
+
+Every (backend, mode, page type) combination runs in a fresh interpreter,
+and each page is read from its own file just before it is parsed, so the
+peak RSS reported belongs to the parse: the high-water mark after parsing
+minus the resident size after start-up. On Linux the high-water mark is reset
+first (/proc/self/clear_refs); elsewhere ru_maxrss is used and start-up
+peaks can hide small parses. Partial mode is measured only on backends that
+have it.
+
+    python -m benchmarks.parse_memory --offers-per-page 3000
+"""
+import argparse
+import json
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fixtures import get_corpus
+
+def page_type(path):
+    return "home_page" if path == "/en/" else "game_page" if path.startswith("/en/lots/") else "user_page"
+
+def rss_kb():
+    """(current, peak) resident set size in KiB"""
+    try:
+        status = Path("/proc/self/status").read_text()
+        values = dict(re.findall(r"^(VmRSS|VmHWM):\s+(\d+) kB", status, re.M))
+        return int(values["VmRSS"]), int(values["VmHWM"])
+    except OSError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        peak = peak // 1024 if sys.platform == "darwin" else peak
+        return peak, peak
+
+def reset_peak_rss():
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+def run_child(pages_dir, kind, backend, partial, repeat):
+    """Parse the pages saved in `pages_dir` and print {"ms_per_page", "peak_rss_kb"} as JSON"""
+    from extractors import extract
+
+    paths = sorted(Path(pages_dir).glob("*.html"))
+    extract(kind, "<html><body></body></html>", backend, partial)  # imports and selector compilation
+    reset_peak_rss()
+    baseline = rss_kb()[0]
+
+    elapsed = 0.0
+    for _ in range(repeat):
+        for path in paths:
+            html = path.read_text(encoding="utf-8")
+            start = time.perf_counter()
+            extract(kind, html, backend, partial)
+            elapsed += time.perf_counter() - start
+            del html
+    print(json.dumps({
+        "ms_per_page": round(elapsed * 1000 / (repeat * len(paths)), 3),
+        "peak_rss_kb": rss_kb()[1] - baseline,
+    }))
+
+def measure_parse_memory(corpus, repeat=3):
+    """{backend: {page_type: {"full": stats, "partial": stats}}}, each measured in its own process"""
+    from extractors import BACKENDS, available_backends
+
+    by_type = {}
+    for path, html in corpus.items():
+        by_type.setdefault(page_type(path), []).append(html)
+
+    results = {}
+    with tempfile.TemporaryDirectory() as workdir:
+        for kind, pages in by_type.items():
+            pages_dir = Path(workdir) / kind
+            pages_dir.mkdir()
+            for number, html in enumerate(pages):
+                (pages_dir / f"{number:06d}.html").write_text(html, encoding="utf-8")
+            for backend in available_backends():
+                modes = [False, True] if hasattr(BACKENDS[backend], "parse_regions") else [False]
+                for partial in modes:
+                    output = subprocess.run(
+                        [sys.executable, "-m", "benchmarks.parse_memory", "--child", str(pages_dir),
+                         "--page-type", kind, "--backend", backend, "--repeat", str(repeat)]
+                        + (["--partial"] if partial else []),
+                        check=True, capture_output=True, text=True
+                    ).stdout
+                    stats = json.loads(output.splitlines()[-1])
+                    results.setdefault(backend, {}).setdefault(kind, {})["partial" if partial else "full"] = stats
+                    print(f"memory {backend:>10} {kind:>9} {'partial' if partial else 'full':>7}: "
+                          f"{stats['ms_per_page']} ms/page, peak +{stats['peak_rss_kb']} KiB")
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure parse time and peak RSS per page, full vs partial parsing.")
+    parser.add_argument("--games", type=int, default=5, help="synthetic corpus: number of games")
+    parser.add_argument("--users", type=int, default=50, help="synthetic corpus: number of user profiles")
+    parser.add_argument("--offers-per-page", type=int, default=1000, help="synthetic corpus: offers per lot page")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--page-type", help=argparse.SUPPRESS)
+    parser.add_argument("--backend", help=argparse.SUPPRESS)
+    parser.add_argument("--partial", action="store_true", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.page_type, args.backend, args.partial, args.repeat)
+        return
+    corpus = get_corpus(games=args.games, users=args.users, offers_per_page=args.offers_per_page)
+    measure_parse_memory(corpus, args.repeat)
+
+if __name__ == "__main__":
+    main()
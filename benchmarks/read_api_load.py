@@ -0,0 +1,184 @@
+"""
+Load test for read_api while a scrape is writing to the same database.
+
+Fills a fresh database from the stand-in server (home page, games, user
+profiles), starts read_api on it and then, for --duration seconds, has
+--clients threads request a mix of its endpoints over keep-alive connections.
+Meanwhile a scrape loop keeps starting new runs against the stand-in server:
+home page, every game page and a share of the user profiles. Every new run
+invalidates the API's result cache.
+
+Reports sustained requests/s, p50/p99 latency, the cache hit ratio and how
+many scrape runs committed during the test. Pass --no-scrape for the
+read-only baseline.
+
+    python -m benchmarks.read_api_load --clients 8 --duration 20
+"""
+import argparse
+import contextlib
+import http.client
+import io
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from urllib.parse import quote
+
+from benchmarks.fixtures import get_corpus
+from benchmarks.run import percentile
+from benchmarks.server import StandInServer, parse_latency
+
+def fill_database(db_path, corpus):
+    """One full scrape into `db_path`; returns the IDs of the user profiles it found"""
+    import parse_funpay_users
+    from db_manager import DatabaseManager
+    from main import refresh_games, refresh_home
+
+    db = DatabaseManager(db_path)
+    with contextlib.redirect_stdout(io.StringIO()):
+        refresh_games(db, refresh_home(db))
+    parse_funpay_users.setup_database(db)
+    user_ids = [int(path.split("/")[3]) for path in corpus if path.startswith("/en/users/")]
+    for user_id in user_ids:
+        parse_funpay_users.parse_user_page(user_id, db)
+    found = [row[0] for row in db.cursor.execute("SELECT user_id FROM users ORDER BY user_id")]
+    db.close()
+    return found
+
+def endpoint_mix(db_path, user_ids):
+    """Request targets covering every endpoint, weighted toward the per-game and per-user ones"""
+    import storage
+
+    conn = storage.connect(db_path, readonly=True)
+    game_ids = [row[0] for row in conn.execute("SELECT game_id FROM games")]
+    categories = [row[0] for row in conn.execute("SELECT DISTINCT category FROM offers WHERE category IS NOT NULL")]
+    conn.close()
+
+    targets = ["/games", "/runs"]
+    for game_id in game_ids:
+        targets += [f"/games/{game_id}/metrics", f"/games/{game_id}/lots",
+                    f"/games/{game_id}/orders?limit=20", f"/games/{game_id}/orders/summary"]
+    for user_id in user_ids:
+        targets += [f"/users/{user_id}", f"/users/{user_id}/offers"]
+    targets += [f"/categories/{quote(category)}/sellers" for category in categories]
+    return targets
+
+def scrape_loop(db_path, user_ids, stop, runs):
+    """Start a new run every cycle until `stop` is set, as a scheduled scrape would"""
+    import parse_funpay_users
+    from db_manager import DatabaseManager
+    from main import refresh_games, refresh_home
+
+    db = DatabaseManager(db_path, start_run=False)
+    rng = random.Random(0)
+    while not stop.is_set():
+        # parser_runs timestamps have one-second resolution
+        time.sleep(max(0.0, 1.0 - (time.time() % 1.0)))
+        db.start_run()
+        with contextlib.redirect_stdout(io.StringIO()):
+            refresh_games(db, refresh_home(db))
+        for user_id in rng.sample(user_ids, min(len(user_ids), max(1, len(user_ids) // 5))):
+            if stop.is_set():
+                break
+            parse_funpay_users.parse_user_page(user_id, db)
+        db.flush()
+        runs.append(db.run_id)
+    db.close()
+
+def client_loop(port, targets, deadline, seed, results):
+    rng = random.Random(seed)
+    conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+    latencies, hits, errors = [], 0, 0
+    while time.perf_counter() < deadline:
+        target = rng.choice(targets)
+        start = time.perf_counter()
+        try:
+            conn.request("GET", target)
+            response = conn.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            errors += 1
+            conn.close()
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=30)
+            continue
+        latencies.append(time.perf_counter() - start)
+        if response.status != 200:
+            errors += 1
+        hits += response.getheader("X-Cache") == "HIT"
+    conn.close()
+    results.append((latencies, hits, errors))
+
+def run_load(db_path, corpus, clients, duration, scrape=True):
+    import parse_funpay_users  # noqa: F401 (configures logging on import)
+    import read_api
+
+    logging.getLogger().setLevel(logging.ERROR)  # the user crawler logs one line per profile
+    user_ids = fill_database(db_path, corpus)
+    targets = endpoint_mix(db_path, user_ids)
+    server = read_api.serve(db_path, port=0)
+    port = server.server_address[1]
+
+    stop, runs = threading.Event(), []
+    scraper = threading.Thread(target=scrape_loop, args=(db_path, user_ids, stop, runs), daemon=True)
+    if scrape:
+        scraper.start()
+
+    results = []
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client_loop, args=(port, targets, start + duration, seed, results))
+               for seed in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    if scrape:
+        scraper.join()
+    cache_stats = dict(server.api.cache.stats)
+    server.shutdown()
+
+    latencies = [latency for result in results for latency in result[0]]
+    hits = sum(result[1] for result in results)
+    return {
+        "requests": len(latencies),
+        "seconds": round(elapsed, 2),
+        "requests_per_s": round(len(latencies) / elapsed, 1),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "cache_hit_ratio": round(hits / len(latencies), 3) if latencies else None,
+        "cache_invalidations": cache_stats["invalidations"],
+        "errors": sum(result[2] for result in results),
+        "scrape_runs": len(runs),
+        "endpoints": len(targets),
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test read_api while a scrape writes to the same database.")
+    parser.add_argument("--clients", type=int, default=8, help="concurrent API clients")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    parser.add_argument("--latency", type=parse_latency, default=(5, 20), help="stand-in server latency in ms")
+    parser.add_argument("--games", type=int, default=20, help="synthetic corpus: number of games")
+    parser.add_argument("--users", type=int, default=100, help="synthetic corpus: number of user profiles")
+    parser.add_argument("--no-scrape", action="store_true", help="measure without a concurrent scrape")
+    args = parser.parse_args()
+
+    corpus = get_corpus(games=args.games, users=args.users)
+    server = StandInServer(corpus, latency_ms=args.latency).start()
+    os.environ["FUNPAY_URL"] = server.url
+    os.environ.setdefault("FUNPAY_RATE", "1000")
+    os.environ.setdefault("FUNPAY_MAX_RATE", "1000")
+    print(f"Serving {len(corpus)} pages on {server.url}")
+
+    with tempfile.TemporaryDirectory() as workdir:
+        result = run_load(str(Path(workdir) / "read_api.db"), corpus, args.clients, args.duration,
+                          scrape=not args.no_scrape)
+    server.stop()
+    print(json.dumps(result, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""
+Offline throughput benchmark for the scrape pipeline.
+
+Starts the local stand-in server on the page corpus and drives the real
+entry points against it:
+
+- home:  main.get_games_data
+- games: GameScraper through AsyncGameScraper, plus DatabaseManager.update_game / save_orders
+- users: parse_funpay_users.parse_user_page
+- lots:  lot_scraper.LotCrawler over the lots recorded by the games scenario
+
+For each scenario it reports pages/s, p50/p99 request latency and the time
+spent writing to SQLite. It also measures pure parse time per page type
+for every installed parser backend, and peak RSS per page for full versus
+partial parsing (benchmarks/parse_memory.py). Results are saved under
+benchmarks/results/ with the current commit so runs can be compared.
+
+    python -m benchmarks.run --latency 20-80 --rate-429 0.01 --compare
+"""
+import argparse
+import contextlib
+import io
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fixtures import get_corpus
+from benchmarks.parse_memory import measure_parse_memory
+from benchmarks.server import StandInServer, parse_latency
+
+RESULTS_DIR = Path(__file__).parent / "results"
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+class TimedConnection:
+    """sqlite3 connection proxy that accumulates the time spent in writes and commits"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.seconds = 0.0
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def execute(self, *args):
+        return self._timed(self.conn.execute, *args)
+
+    def executemany(self, *args):
+        return self._timed(self.conn.executemany, *args)
+
+    def commit(self):
+        return self._timed(self.conn.commit)
+
+    def rollback(self):
+        return self.conn.rollback()
+
+    def cursor(self):
+        return self
+
+def git_commit():
+    try:
+        commit = subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+        dirty = bool(subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], text=True).strip())
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown", False
+    return commit, dirty
+
+def summarize(pages, seconds, latencies, db_seconds, failures=0):
+    return {
+        "pages": pages,
+        "seconds": round(seconds, 4),
+        "pages_per_s": round(pages / seconds, 2) if seconds else None,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2) if latencies else None,
+        "db_write_s": round(db_seconds, 4),
+        "failures": failures,
+    }
+
+def run_benchmarks(corpus, workdir, concurrency):
+    # Project modules read FUNPAY_URL at import time, so they are imported here
+    import http_client
+    import lot_scraper
+    import main as home_scraper
+    import parse_funpay_users
+    from async_scraper import AsyncGameScraper
+    from db_manager import DatabaseManager
+    from page_archive import PageArchive
+    from rate_limiter import AdaptiveRateLimiter
+    from scraper import GameScraper
+
+    logging.getLogger().setLevel(logging.ERROR)  # the user crawler logs one line per profile
+    latencies = []
+
+    class TimedClient(http_client.HttpClient):
+        def get(self, url, **kwargs):
+            start = time.perf_counter()
+            try:
+                return super().get(url, **kwargs)
+            finally:
+                latencies.append(time.perf_counter() - start)
+
+    client = TimedClient(pool_size=max(16, concurrency), cache=http_client.ValidatorCache(str(workdir / "http_cache.db")),
+                        archive=PageArchive(str(workdir / "page_archive.db")),
+                        # Same 429 handling as production, but no pacing below the stand-in server's speed
+                        limiter=AdaptiveRateLimiter(initial_rate=10_000, max_rate=10_000, burst=concurrency))
+    http_client.set_client(client)
+    results = {}
+
+    def scenario(name, body):
+        latencies.clear()
+        client.reset_stats()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            pages, db_seconds, failures = body()
+        results[name] = summarize(pages, time.perf_counter() - start, list(latencies), db_seconds, failures)
+        results[name]["cache_hits"] = client.stats["cache_hits"]
+        print(f"{name:>6}: {results[name]}")
+
+    db = DatabaseManager(str(workdir / "bench.db"))
+    db.batch.conn = timed = TimedConnection(db.conn)
+    state = {}
+
+    def home():
+        state["games_data"] = home_scraper.get_games_data()
+        return 1, 0.0, 0 if state["games_data"] else 1
+
+    def games():
+        db.insert_games(state["games_data"])
+        db.create_lots_table()
+        db.insert_lots(state["games_data"])
+        games = db.get_all_games()
+        game_ids = {game_url: game_id for game_id, game_url in games}
+        scraper = GameScraper(on_offers=lambda game_url, offers: db.save_orders(game_ids.get(game_url), offers))
+        scraped = AsyncGameScraper(scraper, concurrency=concurrency).run(url for _, url in games)
+        with db.transaction():
+            for game_id, game_url in games:
+                if scraped.get(game_url):
+                    db.update_game(game_id, scraped[game_url])
+        return len(games), timed.seconds, sum(1 for data in scraped.values() if not data)
+
+    def users():
+        timed.seconds = 0.0
+        parse_funpay_users.setup_database(db)
+        user_ids = [int(path.split("/")[3]) for path in corpus if path.startswith("/en/users/")]
+        parsed = [parse_funpay_users.parse_user_page(user_id, db) for user_id in user_ids]
+        db.flush()
+        return len(user_ids), timed.seconds, parsed.count(False)
+
+    def lots():
+        crawler = lot_scraper.LotCrawler(db, client=client, concurrency=concurrency)
+        timed.seconds = 0.0
+        stats = crawler.run(restart=True)
+        return stats["lots"], timed.seconds, stats["failed"]
+
+    scenario("home", home)
+    scenario("games", games)
+    scenario("users", users)
+    scenario("lots", lots)
+    db.close()
+    return results
+
+def measure_parsers(corpus, repeat=3):
+    """Milliseconds per page for each page type on every installed parser backend"""
+    from extractors import available_backends, extract
+
+    page_types = {"home_page": [], "game_page": [], "user_page": []}
+    for path, html in corpus.items():
+        kind = "home_page" if path == "/en/" else "game_page" if path.startswith("/en/lots/") else "user_page"
+        page_types[kind].append(html)
+
+    timings = {}
+    for backend in available_backends():
+        timings[backend] = {}
+        for page_type, pages in page_types.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                for html in pages:
+                    extract(page_type, html, backend)
+            timings[backend][page_type] = round((time.perf_counter() - start) * 1000 / (repeat * len(pages)), 3)
+        print(f"parse {backend:>10}: {timings[backend]} ms/page")
+    return timings
+
+def previous_result(current_path):
+    results = sorted(p for p in RESULTS_DIR.glob("*.json") if p != current_path)
+    return json.loads(results[-1].read_text()) if results else None
+
+def compare(current, previous):
+    print(f"\nCompared with {previous['commit']} ({previous['timestamp']}):")
+    for name, stats in current["scenarios"].items():
+        before = previous["scenarios"].get(name)
+        if before and before.get("pages_per_s") and stats.get("pages_per_s"):
+            ratio = stats["pages_per_s"] / before["pages_per_s"]
+            print(f"  {name:>6}: {before['pages_per_s']} -> {stats['pages_per_s']} pages/s ({ratio:.2f}x)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the offline scrape benchmarks against a local stand-in server.")
+    parser.add_argument("--latency", type=parse_latency, default=(20, 80), help="per-request latency in ms, e.g. 20-80")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+    parser.add_argument("--concurrency", type=int, default=8, help="AsyncGameScraper concurrency")
+    parser.add_argument("--games", type=int, default=20, help="synthetic corpus: number of games")
+    parser.add_argument("--users", type=int, default=100, help="synthetic corpus: number of user profiles")
+    parser.add_argument("--compare", action="store_true", help="compare with the previous saved result")
+    args = parser.parse_args()
+
+    corpus = get_corpus(games=args.games, users=args.users)
+    server = StandInServer(corpus, latency_ms=args.latency, rate_429=args.rate_429).start()
+    os.environ["FUNPAY_URL"] = server.url
+    print(f"Serving {len(corpus)} pages on {server.url}")
+
+    commit, dirty = git_commit()
+    with tempfile.TemporaryDirectory() as workdir:
+        scenarios = run_benchmarks(corpus, Path(workdir), args.concurrency)
+    server.stop()
+
+    result = {
+        "commit": commit,
+        "dirty": dirty,
+        "timestamp": time.strftime("%Y%m%d_%H%M%S"),
+        "python": sys.version.split()[0],
+        "options": {"latency_ms": args.latency, "rate_429": args.rate_429, "concurrency": args.concurrency,
+                    "pages": len(corpus)},
+        "scenarios": scenarios,
+        "parse_ms_per_page": measure_parsers(corpus),
+        "parse_memory": measure_parse_memory(corpus, repeat=1),
+        "server": server.counts,
+    }
+
+    RESULTS_DIR.mkdir(exist_ok=True)
+    path = RESULTS_DIR / f"{result['timestamp']}_{commit}.json"
+    path.write_text(json.dumps(result, indent=2))
+    print(f"Saved {path}")
+
+    if args.compare:
+        previous = previous_result(path)
+        if previous:
+            compare(result, previous)
+        else:
+            print("No previous result to compare with.")
+
+if __name__ == "__main__":
+    main()
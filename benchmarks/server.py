@@ -0,0 +1,101 @@
+"""
+Local stand-in for funpay.com serving a page corpus.
+
+Absolute https://funpay.com links in the pages are rewritten to the server's
+own origin, so every scraper stays on the local machine. Each response can be
+delayed by a random latency, and a fraction of requests can be answered with
+429 + Retry-After. Pages carry an ETag so conditional GETs can be exercised.
+
+Run standalone with:
+    python -m benchmarks.server --port 8800 --latency 50-200 --rate-429 0.02
+"""
+import argparse
+import hashlib
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from benchmarks.fixtures import ORIGIN, get_corpus
+
+class StandInServer:
+    def __init__(self, corpus, host="127.0.0.1", port=0, latency_ms=(0, 0), rate_429=0.0, retry_after=1, seed=0):
+        self.latency_ms = latency_ms
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.rng_lock = threading.Lock()
+        self.counts = {"200": 0, "304": 0, "404": 0, "429": 0}
+        self.httpd = ThreadingHTTPServer((host, port), self._handler())
+        self.httpd.daemon_threads = True
+        self.url = f"http://{host}:{self.httpd.server_address[1]}"
+
+        self.pages = {}
+        for path, html in corpus.items():
+            body = html.replace(ORIGIN, self.url).encode("utf-8")
+            self.pages[path] = (body, '"' + hashlib.sha1(body).hexdigest() + '"')
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                with server.rng_lock:
+                    delay = server.rng.uniform(*server.latency_ms) / 1000
+                    throttled = server.rng.random() < server.rate_429
+                time.sleep(delay)
+
+                path = self.path.split("?")[0]
+                page = server.pages.get(path)
+                if throttled:
+                    self._reply(429, b"Too Many Requests", {"Retry-After": str(server.retry_after)})
+                elif page is None:
+                    self._reply(404, b"Not Found")
+                elif self.headers.get("If-None-Match") == page[1]:
+                    self._reply(304, b"", {"ETag": page[1]})
+                else:
+                    self._reply(200, page[0], {"ETag": page[1], "Content-Type": "text/html; charset=utf-8"})
+
+            def _reply(self, status, body, headers=None):
+                with server.rng_lock:
+                    server.counts[str(status)] += 1
+                self.send_response(status)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def parse_latency(value):
+    """'50-200' -> (50.0, 200.0); '100' -> (100.0, 100.0)"""
+    low, _, high = value.partition("-")
+    return float(low), float(high or low)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve the benchmark corpus as a local funpay.com stand-in.")
+    parser.add_argument("--port", type=int, default=8800)
+    parser.add_argument("--latency", type=parse_latency, default=(0, 0), help="per-request latency in ms, e.g. 50-200")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="fraction of requests answered with 429")
+    args = parser.parse_args()
+
+    server = StandInServer(get_corpus(), port=args.port, latency_ms=args.latency, rate_429=args.rate_429)
+    print(f"Serving {len(server.pages)} pages on {server.url} (set FUNPAY_URL={server.url})")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
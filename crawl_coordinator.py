@@ -0,0 +1,390 @@
+"""
+Sharded, multi-worker execution of the user-profile crawl.
+
+The crawl order is the seeded permutation of crawl_frontier. Its positions
+[0, max_id) are cut into leases of `lease_size` positions that workers claim
+from a coordinator:
+
+- LeaseCoordinator keeps the leases in a SQLite file, which is enough for
+  several processes on one box;
+- `serve` exposes the same coordinator as a small JSON HTTP service and
+  RemoteCoordinator talks to it, for workers spread over several boxes. It
+  listens on 127.0.0.1 unless given --host; it has no authentication, so only
+  open it to a trusted network.
+
+A lease expires `lease_ttl` seconds after its last heartbeat and is then
+handed to the next worker that asks, resuming at the last reported position.
+Each worker writes users/offers to its own shard database; `merge` folds
+shards into the main funpay.db.
+
+    python crawl_coordinator.py worker --worker-id box1-a
+    python crawl_coordinator.py serve --host 0.0.0.0 --port 8700
+    python crawl_coordinator.py worker --worker-id box2-a --coordinator http://box1:8700
+    python crawl_coordinator.py merge
+"""
+import argparse
+import datetime
+import json
+import random
+import sqlite3
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import storage
+from crawl_frontier import SeededPermutation
+
+# Shard rows are stamped when the worker sees them, not when its BatchWriter
+# commits them (up to batch_age seconds later, or longer under a slow disk), so
+# the merge watermark trails the clock by a wide margin
+MERGE_LAG = 300
+
+class LeaseCoordinator:
+    def __init__(self, db_name='crawl_leases.db', max_id=None, lease_size=1000, lease_ttl=900, seed=None):
+        self.conn = storage.connect(db_name, isolation_level=None, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.lease_ttl = lease_ttl
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS coordinator_meta (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                seed INTEGER NOT NULL,
+                max_id INTEGER NOT NULL,
+                lease_size INTEGER NOT NULL,
+                next_start INTEGER NOT NULL
+            )
+        ''')
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS leases (
+                lease_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                start INTEGER NOT NULL,
+                end INTEGER NOT NULL,
+                position INTEGER NOT NULL,
+                worker TEXT,
+                expires_at REAL,
+                done INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        self.conn.execute("CREATE INDEX IF NOT EXISTS idx_leases_open ON leases (done, expires_at)")
+        if max_id is not None:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO coordinator_meta (id, seed, max_id, lease_size, next_start) VALUES (1, ?, ?, ?, 0)",
+                (seed if seed is not None else random.getrandbits(63), max_id, lease_size)
+            )
+
+    def meta(self):
+        """Return {"seed", "max_id"} shared by every worker"""
+        row = self.conn.execute("SELECT seed, max_id FROM coordinator_meta WHERE id = 1").fetchone()
+        if row is None:
+            raise RuntimeError("Coordinator is not initialised; create it with max_id first")
+        return {"seed": row[0], "max_id": row[1]}
+
+    def claim(self, worker):
+        """Claim an expired or new lease for `worker`; returns a lease dict or None when the crawl is done"""
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.conn.execute('''
+                    SELECT lease_id, start, end, position FROM leases
+                    WHERE done = 0 AND (worker IS NULL OR expires_at < ?)
+                    ORDER BY lease_id LIMIT 1
+                ''', (now,)).fetchone()
+                if row is None:
+                    lease_size, next_start, max_id = self.conn.execute(
+                        "SELECT lease_size, next_start, max_id FROM coordinator_meta WHERE id = 1"
+                    ).fetchone()
+                    if next_start >= max_id:
+                        self.conn.execute("COMMIT")
+                        return None
+                    end = min(next_start + lease_size, max_id)
+                    self.conn.execute("UPDATE coordinator_meta SET next_start = ? WHERE id = 1", (end,))
+                    cursor = self.conn.execute(
+                        "INSERT INTO leases (start, end, position) VALUES (?, ?, ?)", (next_start, end, next_start)
+                    )
+                    row = (cursor.lastrowid, next_start, end, next_start)
+                self.conn.execute(
+                    "UPDATE leases SET worker = ?, expires_at = ? WHERE lease_id = ?", (worker, now + self.lease_ttl, row[0])
+                )
+                self.conn.execute("COMMIT")
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+        return {"lease_id": row[0], "start": row[1], "end": row[2], "position": row[3]}
+
+    def heartbeat(self, lease_id, worker, position):
+        """Record progress and extend the lease; False means the lease was lost to another worker"""
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE leases SET position = ?, expires_at = ? WHERE lease_id = ? AND worker = ? AND done = 0",
+                (position, time.time() + self.lease_ttl, lease_id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, lease_id, worker):
+        with self.lock:
+            cursor = self.conn.execute(
+                "UPDATE leases SET done = 1, position = end, expires_at = NULL WHERE lease_id = ? AND worker = ?",
+                (lease_id, worker)
+            )
+        return cursor.rowcount == 1
+
+    def status(self):
+        meta = self.conn.execute("SELECT max_id, next_start FROM coordinator_meta WHERE id = 1").fetchone()
+        done, active, expired = self.conn.execute('''
+            SELECT COALESCE(SUM(done = 1), 0),
+                   COALESCE(SUM(done = 0 AND expires_at >= ?), 0),
+                   COALESCE(SUM(done = 0 AND (expires_at IS NULL OR expires_at < ?)), 0)
+            FROM leases
+        ''', (time.time(), time.time())).fetchone()
+        visited = self.conn.execute("SELECT COALESCE(SUM(position - start), 0) FROM leases").fetchone()[0]
+        return {"max_id": meta[0] if meta else None, "leased_until": meta[1] if meta else None,
+                "visited": visited, "leases_done": done, "leases_active": active, "leases_expired": expired}
+
+class RemoteCoordinator:
+    """Client for a coordinator exposed with `crawl_coordinator.py serve`"""
+
+    def __init__(self, url):
+        import requests
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def _call(self, method, **params):
+        response = self.session.post(f"{self.url}/{method}", json=params, timeout=30)
+        response.raise_for_status()
+        return response.json()["result"]
+
+    def meta(self):
+        return self._call("meta")
+
+    def claim(self, worker):
+        return self._call("claim", worker=worker)
+
+    def heartbeat(self, lease_id, worker, position):
+        return self._call("heartbeat", lease_id=lease_id, worker=worker, position=position)
+
+    def complete(self, lease_id, worker):
+        return self._call("complete", lease_id=lease_id, worker=worker)
+
+    def status(self):
+        return self._call("status")
+
+# Coordinator methods served over HTTP, with the type of each of their arguments
+SERVED_METHODS = {
+    "meta": {},
+    "claim": {"worker": str},
+    "heartbeat": {"lease_id": int, "worker": str, "position": int},
+    "complete": {"lease_id": int, "worker": str},
+    "status": {},
+}
+
+def serve(coordinator, host="127.0.0.1", port=8700):
+    """Expose `coordinator` over HTTP: POST /<method> with JSON arguments, answered with {"result"} or {"error"}"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            method = self.path.strip("/")
+            if method not in SERVED_METHODS:
+                self.reply(404, {"error": "unknown method"})
+                return
+            try:
+                params = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+            except ValueError:
+                self.reply(400, {"error": "body is not JSON"})
+                return
+            types = SERVED_METHODS[method]
+            if (not isinstance(params, dict) or set(params) != set(types)
+                    or not all(isinstance(params[name], kind) for name, kind in types.items())):
+                expected = ", ".join(f"{name} ({kind.__name__})" for name, kind in types.items())
+                self.reply(400, {"error": f"{method} takes {expected or 'no arguments'}"})
+                return
+            try:
+                result = getattr(coordinator, method)(**params)
+            except (RuntimeError, sqlite3.Error) as e:
+                self.reply(503, {"error": str(e)})
+                return
+            self.reply(200, {"result": result})
+
+        def reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    print(f"Coordinator listening on {host}:{port}")
+    ThreadingHTTPServer((host, port), Handler).serve_forever()
+
+def run_worker(coordinator, worker, shard_dir='shards', heartbeat_every=50):
+    """Claim leases until the crawl is done, writing users/offers to shards/<worker>.db"""
+    import parse_funpay_users
+    from db_manager import DatabaseManager
+
+    meta = coordinator.meta()
+    permutation = SeededPermutation(meta["max_id"], meta["seed"])
+    Path(shard_dir).mkdir(parents=True, exist_ok=True)
+    db = DatabaseManager(str(Path(shard_dir) / f"{worker}.db"), start_run=False)
+    parse_funpay_users.setup_database(db)
+
+    try:
+        while (lease := coordinator.claim(worker)) is not None:
+            print(f"Worker {worker}: lease {lease['lease_id']} positions {lease['position']}-{lease['end']}")
+            for position in range(lease["position"], lease["end"]):
+                parse_funpay_users.parse_user_page(permutation[position] + 1, db)
+                if (position + 1 - lease["start"]) % heartbeat_every == 0:
+                    # Commit the shard first so the coordinator never runs ahead of stored data
+                    db.flush()
+                    if not coordinator.heartbeat(lease["lease_id"], worker, position + 1):
+                        print(f"Worker {worker}: lease {lease['lease_id']} expired, moving on")
+                        break
+            else:
+                db.flush()
+                coordinator.complete(lease["lease_id"], worker)
+    finally:
+        db.close()
+
+def merge_shards(shard_dir='shards', db_name='funpay.db', lag=MERGE_LAG):
+    """
+    Fold every shard into the main database. Users are upserted when the shard
+    copy is newer; for those users only, offers are upserted by identity and
+    the shard's offer_changes history is appended. Merged users and offers keep
+    the shard's timestamps and get merged_at, the time of the merge, which
+    incremental readers use to find them. A per-shard watermark
+    (everything stamped before it has been merged) makes the merge incremental
+    and idempotent. The watermark lags the clock by `lag` seconds, well past
+    the workers' batch age, so it is safe to run while workers are still
+    writing: a row stamped before the watermark has been committed by then.
+    """
+    import parse_funpay_users
+    from db_manager import DatabaseManager
+
+    db = DatabaseManager(db_name, start_run=False)
+    parse_funpay_users.setup_database(db)
+    db.cursor.execute('''
+        CREATE TABLE IF NOT EXISTS shard_merges (
+            shard TEXT PRIMARY KEY,
+            merged_until TEXT NOT NULL
+        )
+    ''')
+
+    for shard in sorted(Path(shard_dir).glob("*.db")):
+        db.cursor.execute("SELECT merged_until FROM shard_merges WHERE shard = ?", (shard.name,))
+        row = db.cursor.fetchone()
+        merged_until = row[0] if row else ""
+        # Rows stamped before `until` are committed; later ones are left for the next merge
+        until = (datetime.datetime.now() - datetime.timedelta(seconds=lag)).strftime("%Y-%m-%d %H:%M:%S")
+        merged_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+        db.cursor.execute("ATTACH DATABASE ? AS shard", (str(shard),))
+        try:
+            with db.transaction():
+                db.cursor.execute("DROP TABLE IF EXISTS temp.merging")
+                # Only users whose shard copy is newer than the main one; an older
+                # copy must not overwrite their offers or add stale history
+                db.cursor.execute('''
+                    CREATE TEMP TABLE merging AS
+                    SELECT shard_users.user_id FROM shard.users AS shard_users
+                    LEFT JOIN main.users ON main.users.user_id = shard_users.user_id
+                    WHERE shard_users.updated_at >= ? AND shard_users.updated_at < ?
+                      AND (main.users.user_id IS NULL OR shard_users.updated_at > main.users.updated_at)
+                ''', (merged_until, until))
+                db.cursor.execute('''
+                    INSERT INTO main.users (user_id, username, status_timestamp, registration_timestamp, seller_rating, total_reviews, created_at, updated_at, merged_at)
+                    SELECT user_id, username, status_timestamp, registration_timestamp, seller_rating, total_reviews, created_at, updated_at, ?
+                    FROM shard.users WHERE user_id IN (SELECT user_id FROM merging)
+                    ON CONFLICT(user_id) DO UPDATE SET
+                        username = excluded.username,
+                        status_timestamp = excluded.status_timestamp,
+                        registration_timestamp = excluded.registration_timestamp,
+                        seller_rating = excluded.seller_rating,
+                        total_reviews = excluded.total_reviews,
+                        updated_at = excluded.updated_at,
+                        merged_at = excluded.merged_at
+                    WHERE excluded.updated_at > main.users.updated_at
+                ''', (merged_at,))
+                db.cursor.execute('''
+                    INSERT INTO main.offers (user_id, category, description, price, server_or_platform, in_stock, link,
+                                             offer_key, content_hash, amount, currency, stock, first_seen, last_seen, removed_at, merged_at)
+                    SELECT user_id, category, description, price, server_or_platform, in_stock, link,
+                           offer_key, content_hash, amount, currency, stock, first_seen, last_seen, removed_at, ?
+                    FROM shard.offers WHERE user_id IN (SELECT user_id FROM merging) AND offer_key IS NOT NULL
+                    ON CONFLICT(user_id, offer_key) DO UPDATE SET
+                        category = COALESCE(excluded.category, main.offers.category),
+                        description = excluded.description,
+                        price = excluded.price,
+                        server_or_platform = excluded.server_or_platform,
+                        in_stock = excluded.in_stock,
+                        link = excluded.link,
+                        content_hash = excluded.content_hash,
+                        amount = excluded.amount,
+                        currency = excluded.currency,
+                        stock = excluded.stock,
+                        first_seen = MIN(COALESCE(main.offers.first_seen, excluded.first_seen), COALESCE(excluded.first_seen, main.offers.first_seen)),
+                        last_seen = COALESCE(excluded.last_seen, main.offers.last_seen),
+                        removed_at = excluded.removed_at,
+                        merged_at = excluded.merged_at
+                ''', (merged_at,))
+                db.cursor.execute('''
+                    INSERT INTO main.offer_changes (user_id, offer_key, change, content_hash, price, in_stock, changed_at)
+                    SELECT user_id, offer_key, change, content_hash, price, in_stock, changed_at
+                    FROM shard.offer_changes WHERE user_id IN (SELECT user_id FROM merging)
+                      AND changed_at >= ? AND changed_at < ?
+                ''', (merged_until, until))
+                merged = db.cursor.execute("SELECT COUNT(*) FROM merging").fetchone()[0]
+                db.cursor.execute("DROP TABLE merging")
+                db.cursor.execute(
+                    "INSERT OR REPLACE INTO shard_merges (shard, merged_until) VALUES (?, ?)", (shard.name, until)
+                )
+            print(f"Merged {merged} users from {shard.name}")
+        finally:
+            db.cursor.execute("DETACH DATABASE shard")
+    db.close()
+
+def main():
+    from parse_funpay_users import MAX_USER_ID
+
+    parser = argparse.ArgumentParser(description="Sharded multi-worker user-profile crawl.")
+    parser.add_argument("--leases", default="crawl_leases.db", help="SQLite coordinator file")
+    parser.add_argument("--lease-size", type=int, default=1000)
+    parser.add_argument("--lease-ttl", type=int, default=900, help="seconds before an unrenewed lease is reassigned")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    worker = sub.add_parser("worker", help="claim leases and crawl them into a shard")
+    worker.add_argument("--worker-id", required=True)
+    worker.add_argument("--coordinator", help="URL of a `serve` coordinator (default: the local --leases file)")
+    worker.add_argument("--shard-dir", default="shards")
+
+    serve_cmd = sub.add_parser("serve", help="expose the coordinator over HTTP")
+    serve_cmd.add_argument("--host", default="127.0.0.1", help="address to listen on (0.0.0.0 for workers on other boxes)")
+    serve_cmd.add_argument("--port", type=int, default=8700)
+
+    merge = sub.add_parser("merge", help="fold shard databases into the main database")
+    merge.add_argument("--shard-dir", default="shards")
+    merge.add_argument("--db", default="funpay.db")
+    merge.add_argument("--lag", type=int, default=MERGE_LAG, help="seconds the merge watermark trails the clock")
+
+    sub.add_parser("status", help="show lease progress")
+    args = parser.parse_args()
+
+    if args.command == "merge":
+        merge_shards(args.shard_dir, args.db, args.lag)
+        return
+
+    if args.command == "worker" and args.coordinator:
+        coordinator = RemoteCoordinator(args.coordinator)
+    else:
+        coordinator = LeaseCoordinator(args.leases, MAX_USER_ID, args.lease_size, args.lease_ttl)
+
+    if args.command == "worker":
+        run_worker(coordinator, args.worker_id, args.shard_dir)
+    elif args.command == "serve":
+        serve(coordinator, args.host, args.port)
+    else:
+        print(coordinator.status())
+
+if __name__ == "__main__":
+    main()
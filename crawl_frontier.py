@@ -0,0 +1,112 @@
+import datetime
+import random
+
+MASK64 = (1 << 64) - 1
+
+def _mix(value):
+    """splitmix64 finaliser: a cheap, well-distributed 64-bit hash"""
+    value = (value + 0x9E3779B97F4A7C15) & MASK64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & MASK64
+    return value ^ (value >> 31)
+
+class SeededPermutation:
+    """
+    Bijection of [0, size) onto itself, keyed by a seed.
+
+    A balanced Feistel network permutes the smallest even-bit power of two that
+    covers `size`; values that land outside [0, size) are walked through the
+    network again until they fall inside (cycle walking), which keeps the map a
+    bijection on [0, size). The domain is at most 4x size, so a lookup takes a
+    few rounds on average and needs no memory.
+    """
+    rounds = 4
+
+    def __init__(self, size, seed):
+        self.size = size
+        self.half_bits = max(1, ((size - 1).bit_length() + 1) // 2)
+        self.half_mask = (1 << self.half_bits) - 1
+        self.keys = [_mix(seed * self.rounds + r) for r in range(self.rounds)]
+
+    def _feistel(self, value):
+        left, right = value >> self.half_bits, value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ (_mix(right ^ key) & self.half_mask)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, position):
+        value = self._feistel(position)
+        while value >= self.size:
+            value = self._feistel(value)
+        return value
+
+class PermutationFrontier:
+    """
+    Crawl frontier that visits every ID in [1, max_id] exactly once, in a seeded
+    pseudo-random order.
+
+    Only the seed and a cursor (how many positions have been handed out) are
+    stored, in the crawl_frontier table. save() queues the cursor update on the
+    DatabaseManager batch writer, so it commits in the same transaction as the
+    rows written for the IDs it covers: after a crash the crawl resumes right
+    after the last committed ID.
+    """
+
+    def __init__(self, db, max_id, name='users', seed=None):
+        self.db = db
+        self.name = name
+        db.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_frontier (
+                name TEXT PRIMARY KEY,
+                seed INTEGER NOT NULL,
+                max_id INTEGER NOT NULL,
+                cursor INTEGER NOT NULL,
+                updated_at TEXT NOT NULL
+            )
+        ''')
+        db.cursor.execute("SELECT seed, max_id, cursor FROM crawl_frontier WHERE name = ?", (name,))
+        row = db.cursor.fetchone()
+        if row is None:
+            seed = seed if seed is not None else random.getrandbits(63)
+            row = (seed, max_id, 0)
+            db.cursor.execute(
+                "INSERT INTO crawl_frontier (name, seed, max_id, cursor, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (name, seed, max_id, 0, self._now())
+            )
+            db.conn.commit()
+        elif row[1] != max_id:
+            print(f"Frontier '{name}' was created for max_id {row[1]}; keeping it (start a new frontier name for {max_id}).")
+
+        self.seed, self.max_id, self.cursor = row
+        self.permutation = SeededPermutation(self.max_id, self.seed)
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def id_at(self, position):
+        """The ID visited at `position` of the crawl order"""
+        return self.permutation[position] + 1
+
+    def next(self):
+        """Return the next unvisited ID and advance the cursor, or None when the frontier is exhausted"""
+        if self.cursor >= self.max_id:
+            return None
+        user_id = self.id_at(self.cursor)
+        self.cursor += 1
+        return user_id
+
+    def __iter__(self):
+        while (user_id := self.next()) is not None:
+            yield user_id
+
+    def save(self):
+        """Queue the cursor update on the batch writer (commits with the next flush)"""
+        self.db.batch.add(
+            "UPDATE crawl_frontier SET cursor = ?, updated_at = ? WHERE name = ?",
+            (self.cursor, self._now(), self.name)
+        )
+
+    @property
+    def remaining(self):
+        return self.max_id - self.cursor
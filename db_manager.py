@@ -1,36 +1,165 @@
 import sqlite3
 import datetime
 import re
+import time
+from contextlib import contextmanager
+
+import metrics
+import profiling
+import storage
+
+def category_name(counter):
+    """Name a counter label is stored under in categories (non-identifier characters dropped)"""
+    return re.sub(r'[^a-zA-Z0-9_]', '', counter)
+
+class BatchWriter:
+    """
+    Buffers write statements and applies them with executemany in large transactions.
+
+    Rows are kept in arrival order; consecutive rows for the same statement are sent
+    in one executemany call. The buffer is flushed when it holds `max_rows` rows or
+    its oldest row is `max_age` seconds old (checked whenever a row is added), and on
+    flush()/close().
+
+    Crash guarantee: every flush outside a transaction() scope is one SQLite
+    transaction. After a crash the database holds exactly the rows of the flushes
+    that committed; rows still buffered, or in a flush that had not committed, are
+    lost as a whole, never partially applied. Inside a transaction() scope nothing
+    is committed until the outermost scope exits, so the scope is all-or-nothing.
+    """
+
+    def __init__(self, conn, max_rows=1000, max_age=5.0, after_commit=None):
+        self.conn = conn
+        self.after_commit = after_commit
+        self.max_rows = max_rows
+        self.max_age = max_age
+        self.pending = []  # [(sql, [params, ...]), ...] in arrival order
+        self.pending_rows = 0
+        self.oldest = None
+        self.depth = 0
+
+    def add(self, sql, params):
+        """Buffer one row for `sql`, flushing if the size or age limit is reached"""
+        if self.pending and self.pending[-1][0] == sql:
+            self.pending[-1][1].append(params)
+        else:
+            self.pending.append((sql, [params]))
+        self.pending_rows += 1
+        if self.oldest is None:
+            self.oldest = time.monotonic()
+        if self.pending_rows >= self.max_rows or time.monotonic() - self.oldest >= self.max_age:
+            self.flush()
+
+    def add_many(self, sql, rows):
+        for params in rows:
+            self.add(sql, params)
+
+    def flush(self):
+        """Write buffered rows; commits unless a transaction() scope is open"""
+        pending, self.pending = self.pending, []
+        rows_written, self.pending_rows = self.pending_rows, 0
+        self.oldest = None
+        start = time.perf_counter()
+        try:
+            for sql, rows in pending:
+                self.conn.executemany(sql, rows)
+        except sqlite3.Error:
+            if self.depth == 0:
+                self.conn.rollback()
+            raise
+        if self.depth == 0:
+            self.conn.commit()
+            if self.after_commit is not None:
+                self.after_commit()
+        if rows_written:
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - start, stage="db_write")
+            metrics.DB_ROWS.inc(rows_written)
+
+    @contextmanager
+    def transaction(self):
+        """Group everything written inside the block into one atomic commit"""
+        self.depth += 1
+        try:
+            yield self
+        except BaseException:
+            self.depth -= 1
+            self.pending, self.pending_rows, self.oldest = [], 0, None
+            if self.depth == 0:
+                self.conn.rollback()
+            raise
+        self.depth -= 1
+        if self.depth == 0:
+            self.flush()
 
 class DatabaseManager:
-    def __init__(self, db_name='funpay.db'):
-        self.conn = sqlite3.connect(db_name)
+    # Columns added to orders after its first layout
+    ORDER_COLUMNS = {"currency": "TEXT", "game_id": "INTEGER", "run_id": "INTEGER", "stock": "INTEGER"}
+
+    def __init__(self, db_name='funpay.db', start_run=True, batch_rows=1000, batch_age=5.0):
+        self.conn = storage.connect(db_name)
         self.cursor = self.conn.cursor()
+        self.checkpointer = storage.WalCheckpointer(self.conn)
+        self.batch = BatchWriter(self.conn, max_rows=batch_rows, max_age=batch_age, after_commit=self.checkpointer.maybe)
         self.timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        self.games_table_name = f"games_{self.timestamp}"  # Table name with timestamp
-        self._setup_database()
+        self.games_table_name = f"games_{self.timestamp}"  # Legacy run label
+        self._category_ids = {}
+        self.run_id = None
+        self._setup_database(start_run)
 
-    def _setup_database(self):
-        """Initialize the database structure with timestamped games table, parser_runs table, and orders table."""
+    def _setup_database(self, start_run=True):
+        """
+        Initialize the database structure: parser_runs, games, the long-format game metrics store and orders.
+        A parser_runs row is recorded for this instance unless start_run is False (maintenance tools).
+        """
 
         # Create a table to store parser run details
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS parser_runs (
                 run_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT UNIQUE NOT NULL
+                timestamp TEXT UNIQUE NOT NULL,
+                finished_at TEXT
             )
         ''')
+        self.cursor.execute("PRAGMA table_info(parser_runs)")
+        if "finished_at" not in {row[1] for row in self.cursor.fetchall()}:
+            self.cursor.execute("ALTER TABLE parser_runs ADD COLUMN finished_at TEXT")
 
-        # Create the timestamped games table
-        self.cursor.execute(f'''
-            CREATE TABLE IF NOT EXISTS {self.games_table_name} (
+        # One row per game, refreshed by every run that sees it on the home page
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS games (
                 game_id INTEGER PRIMARY KEY,
                 game_url TEXT NOT NULL,
-                game_title TEXT NOT NULL
+                game_title TEXT NOT NULL,
+                last_seen_run INTEGER
+            )
+        ''')
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_games_last_seen_run ON games (last_seen_run)")
+
+        # Counter categories (e.g. "Accounts"), numbered once instead of being table columns
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS categories (
+                category_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                name TEXT UNIQUE NOT NULL
             )
         ''')
 
-        # Create the orders table
+        # Long-format time series: (run_id, game_id, category_id) -> value
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS game_metrics (
+                run_id INTEGER NOT NULL,
+                game_id INTEGER NOT NULL,
+                category_id INTEGER NOT NULL,
+                value INTEGER NOT NULL,
+                PRIMARY KEY (run_id, game_id, category_id)
+            ) WITHOUT ROWID
+        ''')
+        # Covering index so "metric X for game Y over time" is a single range scan
+        self.cursor.execute('''
+            CREATE INDEX IF NOT EXISTS idx_game_metrics_series
+            ON game_metrics (game_id, category_id, run_id, value)
+        ''')
+
+        # Create the orders table: one row per offer seen on a game page, per run
         self.cursor.execute('''
             CREATE TABLE IF NOT EXISTS orders (
                 order_id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -39,9 +168,40 @@ class DatabaseManager:
                 description TEXT,
                 price REAL,
                 link TEXT,
-                timestamp TEXT
+                timestamp TEXT,
+                currency TEXT,
+                game_id INTEGER,
+                run_id INTEGER,
+                stock INTEGER
             )
         ''')
+        # Per-run counters and timings (metrics.RunSummary), one row per sample
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS run_metrics (
+                run_id INTEGER NOT NULL,
+                metric TEXT NOT NULL,
+                value REAL NOT NULL,
+                PRIMARY KEY (run_id, metric)
+            ) WITHOUT ROWID
+        ''')
+
+        self.cursor.execute("PRAGMA table_info(orders)")
+        existing = {row[1] for row in self.cursor.fetchall()}
+        for name, column_type in self.ORDER_COLUMNS.items():
+            if name not in existing:
+                self.cursor.execute(f"ALTER TABLE orders ADD COLUMN {name} {column_type}")
+        # A game's price range or cheapest offer in a run is a range scan over this index
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_game_run ON orders (game_id, run_id, price)")
+
+        self.conn.commit()
+        if start_run:
+            self.start_run()
+
+    def start_run(self, timestamp=None):
+        """Record a parser_runs row (now, or `timestamp` as YYYYmmdd_HHMMSS) and make it the current run"""
+        self.finish_run()
+        self.timestamp = timestamp or datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        self.games_table_name = f"games_{self.timestamp}"
 
         # Inserting time into parser_runs
         try:
@@ -49,40 +209,91 @@ class DatabaseManager:
             self.conn.commit()
         except sqlite3.IntegrityError:
             print(f"Timestamp {self.timestamp} already exists in parser_runs. Skipping insertion.")
-            self.timestamp = self.get_last_timestamp()
-            self.games_table_name = f"games_{self.timestamp}"
+            if timestamp is None:
+                self.timestamp = self.get_last_timestamp()
+                self.games_table_name = f"games_{self.timestamp}"
+        self.cursor.execute("SELECT run_id FROM parser_runs WHERE timestamp = ?", (self.timestamp,))
+        self.run_id = self.cursor.fetchone()[0]
+        # A reused run takes more rows, so it is unfinished again until the next finish_run()
+        self.cursor.execute("UPDATE parser_runs SET finished_at = NULL WHERE run_id = ?", (self.run_id,))
+        self.conn.commit()
+        return self.run_id
+
+    def finish_run(self):
+        """Commit the current run's buffered rows and mark it finished (readers may then cache it)"""
+        if self.run_id is None:
+            return
+        # Queued behind the run's rows, so it commits with (or after) the last of them
+        self.batch.add(
+            "UPDATE parser_runs SET finished_at = ? WHERE run_id = ? AND finished_at IS NULL",
+            (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), self.run_id)
+        )
+        self.flush()
 
-    def save_order(self, user_id, user_name, description, price, link):
+    def save_order(self, user_id, user_name, description, price, link, currency=None, game_id=None, stock=None):
         """Save order details into the orders table."""
-        timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.cursor.execute('''
-            INSERT INTO orders (user_id, user_name, description, price, link, timestamp)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', (user_id, user_name, description, price, link, timestamp))
-        self.conn.commit()
+        self.save_orders(game_id, [(user_id, user_name, description, price, currency, stock, link)])
+
+    def save_orders(self, game_id, orders, timestamp=None):
+        """
+        Queue the offers of one game page, as (user_id, user_name, description, amount,
+        currency, stock, link) rows, on the batch writer for the current run.
+        """
+        timestamp = timestamp or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.batch.add_many('''
+            INSERT INTO orders (user_id, user_name, description, price, currency, stock, link, timestamp, game_id, run_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(str(user_id), user_name, description, amount, currency, stock, link, timestamp, game_id, self.run_id)
+              for user_id, user_name, description, amount, currency, stock, link in orders])
 
     def get_all_games(self):
-        """Fetch all game URLs from the current timestamped games table"""
-        self.cursor.execute(f"SELECT game_id, game_url FROM {self.games_table_name}")
+        """Fetch the game URLs seen on the home page during the current run"""
+        self.flush()
+        self.cursor.execute("SELECT game_id, game_url FROM games WHERE last_seen_run = ?", (self.run_id,))
         return self.cursor.fetchall()
 
-    def get_existing_columns(self):
-        """Get all current column names in the current timestamped games table"""
-        self.cursor.execute(f"PRAGMA table_info({self.games_table_name})")
-        return {row[1] for row in self.cursor.fetchall()}
-
-    def add_column(self, column_name):
-        column_name_clear = re.sub(r'[^a-zA-Z0-9_]', '', column_name)
-        self.cursor.execute(f"ALTER TABLE {self.games_table_name} ADD COLUMN {column_name_clear} INTEGER DEFAULT 0")
-        self.conn.commit()
+    def get_category_ids(self, categories):
+        """Map category names to category_id, registering names seen for the first time"""
+        missing = [name for name in categories if name not in self._category_ids]
+        if missing:
+            # Where the legacy per-run tables grew a column for each new category
+            with profiling.stage("column_evolution"):
+                self.cursor.executemany("INSERT OR IGNORE INTO categories (name) VALUES (?)", [(name,) for name in missing])
+                self.cursor.execute("SELECT name, category_id FROM categories")
+                self._category_ids = dict(self.cursor.fetchall())
+        return {name: self._category_ids[name] for name in categories}
 
     def update_game(self, game_id, game_data):
-        """Update game record in the current timestamped games table with new data"""
-        columns = ", ".join(f"{re.sub(r'[^a-zA-Z0-9_]', '', col)} = ?" for col in game_data.keys())
-        values = list(game_data.values()) + [game_id]
-        query = f"UPDATE {self.games_table_name} SET {columns} WHERE game_id = ?"
-        self.cursor.execute(query, values)
-        self.conn.commit()
+        """Store the counter values of a game for the current run"""
+        with profiling.stage("update_game"):
+            values = {category_name(col): value for col, value in game_data.items()}
+            category_ids = self.get_category_ids(list(values))
+            rows = [(self.run_id, game_id, category_ids[name], value) for name, value in values.items()]
+            self.batch.add_many(
+                "INSERT OR REPLACE INTO game_metrics (run_id, game_id, category_id, value) VALUES (?, ?, ?, ?)", rows
+            )
+
+    def get_metric_history(self, game_id, category):
+        """Return [(timestamp, value)] of one counter of one game across all runs"""
+        self.flush()
+        self.cursor.execute('''
+            SELECT parser_runs.timestamp, game_metrics.value
+            FROM game_metrics
+            JOIN categories ON categories.category_id = game_metrics.category_id
+            JOIN parser_runs ON parser_runs.run_id = game_metrics.run_id
+            WHERE game_metrics.game_id = ? AND categories.name = ?
+            ORDER BY game_metrics.run_id
+        ''', (game_id, category))
+        return self.cursor.fetchall()
+
+    def save_run_metrics(self, values, run_id=None):
+        """Store a RunSummary's {metric: value} against the current (or given) run"""
+        run_id = run_id or self.run_id
+        self.batch.add_many(
+            "INSERT OR REPLACE INTO run_metrics (run_id, metric, value) VALUES (?, ?, ?)",
+            [(run_id, metric, value) for metric, value in values.items()]
+        )
+        self.flush()
 
     def get_parser_runs(self):
         """Fetch all recorded parser runs."""
@@ -90,6 +301,7 @@ class DatabaseManager:
         return self.cursor.fetchall()
 
     def get_games_table_name(self):
+        """Legacy per-run label, still recorded in lots.table_name"""
         return self.games_table_name
 
     def get_last_timestamp(self):
@@ -100,14 +312,34 @@ class DatabaseManager:
         else:
             return None
 
+    def flush(self):
+        """Write (and, outside a transaction scope, commit) all buffered rows"""
+        self.batch.flush()
+
+    @contextmanager
+    def transaction(self):
+        """Context manager making every write inside it one atomic commit"""
+        try:
+            with self.batch.transaction():
+                yield self
+        except BaseException:
+            # Categories registered inside the scope may have been rolled back
+            self._category_ids = {}
+            raise
+
     def close(self):
-        """Close the database connection"""
-        self.conn.close()
+        """Finish the current run, checkpoint the WAL and close the database connection"""
+        self.finish_run()
+        storage.close_writer(self.conn)
 
     def insert_games(self, games_data):
-        for game_id, game_url, game_title, _ in games_data:
-            self.cursor.execute(f'INSERT OR IGNORE INTO {self.games_table_name} (game_id, game_url, game_title) VALUES (?, ?, ?)', (game_id, game_url, game_title))
-        self.conn.commit()
+        self.batch.add_many('''
+            INSERT INTO games (game_id, game_url, game_title, last_seen_run) VALUES (?, ?, ?, ?)
+            ON CONFLICT(game_id) DO UPDATE SET
+                game_url = excluded.game_url,
+                game_title = excluded.game_title,
+                last_seen_run = excluded.last_seen_run
+        ''', [(game_id, game_url, game_title, self.run_id) for game_id, game_url, game_title, _ in games_data])
 
     def create_lots_table(self):
         self.cursor.execute('''
@@ -120,10 +352,9 @@ class DatabaseManager:
                 FOREIGN KEY (game_id) REFERENCES games (game_id)
             )
         ''')
-        self.conn.commit()
 
     def insert_lots(self, games_data):
-        for game_id, _, _, lots in games_data:
-            for lot_name, lot_url in lots:
-                self.cursor.execute('INSERT INTO lots (lot_name, lot_url, game_id, table_name) VALUES (?, ?, ?, ?)', (lot_name, lot_url, game_id, self.games_table_name))
-        self.conn.commit()
\ No newline at end of file
+        self.batch.add_many(
+            'INSERT INTO lots (lot_name, lot_url, game_id, table_name) VALUES (?, ?, ?, ?)',
+            [(lot_name, lot_url, game_id, self.games_table_name) for game_id, _, _, lots in games_data for lot_name, lot_url in lots]
+        )
\ No newline at end of file
@@ -0,0 +1,354 @@
+"""
+Declarative extraction rules for FunPay pages, executed by a swappable HTML
+parser backend.
+
+Each page type is described once in RULES as a tree of selectors. A backend
+(selectolax, lxml or BeautifulSoup) compiles those selectors once and runs
+them against a parsed page. Text is whitespace-normalised the same way on
+every backend, so all backends produce identical records.
+
+The backend is picked with the FUNPAY_HTML_PARSER environment variable
+("selectolax", "lxml" or "bs4"); by default the fastest installed one is used,
+with BeautifulSoup as the fallback.
+
+Pages are parsed partially where that pays off: the top-level selectors of a
+page type name the regions it reads (counter-list, tc-item rows, rating
+block, ...), and a backend with `parse_regions` builds only those subtrees.
+Only the BeautifulSoup backend has it. A Python-side filter costs the
+C parsers more than the tree it saves. FUNPAY_PARTIAL_PARSE=0 turns it off.
+Every tree is released as soon as its record has been built.
+"""
+import os
+import re
+import threading
+
+import metrics
+
+class Text:
+    """Whitespace-normalised text of the first match of `selector` (or of the node itself)"""
+
+    def __init__(self, selector=None):
+        self.selector = selector
+
+class Attr:
+    """Attribute `name` of the first match of `selector` (or of the node itself)"""
+
+    def __init__(self, selector, name):
+        self.selector = selector
+        self.name = name
+
+class First:
+    """Record built from `fields` for the first match of `selector`, or None"""
+
+    def __init__(self, selector, fields):
+        self.selector = selector
+        self.fields = fields
+
+class All:
+    """List of records built from `fields`, one per match of `selector`"""
+
+    def __init__(self, selector, fields):
+        self.selector = selector
+        self.fields = fields
+
+TC_ITEM = {
+    "user_name": Text("div.media-user-name"),
+    "avatar_href": Attr("div.avatar-photo", "data-href"),
+    "description": Text("div.tc-desc-text"),
+    "price": Text("div.tc-price"),
+    "price_value": Text("div.tc-price div"),
+    "server": Text("div.tc-server"),
+    "amount": Text("div.tc-amount"),
+    "link": Attr(None, "href"),
+}
+
+RULES = {
+    # funpay.com/en/ home page: games and their lot links
+    "home_page": {
+        "games": All("div.promo-game-item", {
+            "title": Text("div.game-title"),
+            "game_id": Attr("div.game-title", "data-id"),
+            "url": Attr("div.game-title a", "href"),
+            "lot_list": First("ul.list-inline", {
+                "lots": All("li", {
+                    "name": Text(),
+                    "url": Attr("a", "href"),
+                }),
+            }),
+        }),
+    },
+    # lots/<id>/ pages: counter-list, tc-item offer rows and the next page of a paginated list
+    "game_page": {
+        "counter_list": First("div.counter-list", {
+            "counters": All("a.counter-item", {
+                "param": Text("div.inside div.counter-param"),
+                "value": Text("div.inside div.counter-value"),
+            }),
+        }),
+        "offers": All("a.tc-item", TC_ITEM),
+        "next_page": Attr("link[rel=next], a[rel=next]", "href"),
+    },
+    # users/<id>/ profiles
+    "user_page": {
+        "h1": Text("h1"),
+        "username": Text("h1.mb40 span.mr4"),
+        "status": Text("span.media-user-status"),
+        "param_item": First("div.param-item", {
+            "registration": Text("div.text-nowrap"),
+        }),
+        "rating": First("div.rating-value", {
+            "value": Text("span.big"),
+        }),
+        "reviews": Text("div.rating-full-count"),
+        "sections": All("div.offer", {
+            "category": Text("div.offer-list-title h3"),
+            "items": All("a.tc-item", TC_ITEM),
+        }),
+    },
+}
+
+def normalize_text(text):
+    return " ".join(text.split())
+
+SIMPLE_SELECTOR = re.compile(r"^([a-z][a-z0-9]*)?((?:\.[\w-]+)*)((?:\[[\w-]+=[\w-]+\])*)$")
+ATTRIBUTE_TEST = re.compile(r"\[([\w-]+)=([\w-]+)\]")
+
+def page_regions(fields):
+    """
+    [(tag, {classes}, {attribute: value})] of the outermost elements the top-level
+    rules of a page type read from, or None when a selector is too complex to
+    tell (full parse). A rule's region is the first compound of its selector
+    (of each selector, for a list), so everything it matches lies inside a region.
+    """
+    regions = []
+    for spec in fields.values():
+        if spec.selector is None:
+            return None
+        for selector in spec.selector.split(","):
+            match = SIMPLE_SELECTOR.match(selector.split()[0])
+            if match is None:
+                return None
+            tag, classes, attributes = match.groups()
+            regions.append((tag, set(filter(None, classes.split("."))), dict(ATTRIBUTE_TEST.findall(attributes))))
+    return regions
+
+def in_regions(regions, tag, attrs):
+    classes = set(attrs["class"].split()) if attrs.get("class") else set()
+    return any((want is None or tag == want) and wanted <= classes
+               and all(attrs.get(name) == value for name, value in tests.items())
+               for want, wanted, tests in regions)
+
+class Bs4Backend:
+    """Pure-Python fallback: BeautifulSoup's html.parser with soupsieve selectors"""
+    name = "bs4"
+
+    def __init__(self):
+        from bs4 import BeautifulSoup
+        from bs4.filter import ElementFilter
+        import soupsieve
+        self._soup = BeautifulSoup
+        self._compile = soupsieve.compile
+
+        class RegionFilter(ElementFilter):
+            """Lets the tree builder create only region elements (and everything inside them)"""
+
+            def __init__(self, regions):
+                super().__init__()
+                self.regions = regions
+
+            def allow_tag_creation(self, nsprefix, name, attrs):
+                return in_regions(self.regions, name, attrs or {})
+
+            def allow_string_creation(self, string):
+                return False
+
+        self._region_filter = RegionFilter
+
+    def parse(self, html):
+        return self._soup(html, "html.parser")
+
+    def parse_regions(self, html, regions):
+        return self._soup(html, "html.parser", parse_only=self._region_filter(regions))
+
+    def compile(self, css):
+        return self._compile(css)
+
+    def select(self, node, selector):
+        return selector.select(node)
+
+    def select_first(self, node, selector):
+        found = selector.select(node, limit=1)
+        return found[0] if found else None
+
+    def text(self, node):
+        return node.get_text()
+
+    def attr(self, node, name):
+        return node.get(name)
+
+    def release(self, tree):
+        tree.decompose()
+
+class LxmlBackend:
+    """libxml2 parser with selectors compiled to XPath by cssselect"""
+    name = "lxml"
+
+    def __init__(self):
+        import lxml.html
+        from lxml import etree
+        from cssselect import HTMLTranslator
+        self._html = lxml.html
+        self._etree = etree
+        self._translator = HTMLTranslator()
+        self._local = threading.local()  # lxml parsers must not be shared between threads
+
+    def parse(self, html):
+        parser = getattr(self._local, "parser", None)
+        if parser is None:
+            parser = self._local.parser = self._html.HTMLParser(encoding="utf-8")
+        if isinstance(html, str):
+            html = html.encode("utf-8")
+        return self._html.document_fromstring(html, parser=parser)
+
+    def compile(self, css):
+        # "descendant::" keeps the context node itself out of the matches, like the other backends
+        return self._etree.XPath(self._translator.css_to_xpath(css, prefix="descendant::"))
+
+    def select(self, node, selector):
+        return selector(node)
+
+    def select_first(self, node, selector):
+        found = selector(node)
+        return found[0] if found else None
+
+    def text(self, node):
+        return node.text_content()
+
+    def attr(self, node, name):
+        return node.get(name)
+
+    def release(self, tree):
+        tree.clear()
+
+class SelectolaxBackend:
+    """Lexbor (C, HTML5) parser via selectolax"""
+    name = "selectolax"
+
+    def __init__(self):
+        from selectolax.lexbor import LexborHTMLParser
+        self._parser = LexborHTMLParser
+
+    def parse(self, html):
+        return self._parser(html)
+
+    def compile(self, css):
+        return css
+
+    def select(self, node, selector):
+        return node.css(selector)
+
+    def select_first(self, node, selector):
+        return node.css_first(selector)
+
+    def text(self, node):
+        return node.text(deep=True)
+
+    def attr(self, node, name):
+        return node.attributes.get(name)
+
+    def release(self, tree):
+        pass  # the lexbor tree is freed with the parser object
+
+BACKENDS = {
+    "selectolax": SelectolaxBackend,
+    "lxml": LxmlBackend,
+    "bs4": Bs4Backend,
+}
+
+class Extractor:
+    """Runs RULES on one backend, compiling every selector once"""
+
+    def __init__(self, backend, partial=None):
+        self.backend = backend
+        if partial is None:
+            partial = os.environ.get("FUNPAY_PARTIAL_PARSE", "1") != "0"
+        self.partial = partial and hasattr(backend, "parse_regions")
+        self._regions = {page_type: page_regions(fields) for page_type, fields in RULES.items()}
+        self._compiled = {}
+
+    def _selector(self, css):
+        selector = self._compiled.get(css)
+        if selector is None:
+            selector = self._compiled[css] = self.backend.compile(css)
+        return selector
+
+    def _target(self, node, css):
+        return node if css is None else self.backend.select_first(node, self._selector(css))
+
+    def _record(self, node, fields):
+        return {name: self._value(node, spec) for name, spec in fields.items()}
+
+    def _value(self, node, spec):
+        if isinstance(spec, Text):
+            target = self._target(node, spec.selector)
+            return normalize_text(self.backend.text(target)) if target is not None else None
+        if isinstance(spec, Attr):
+            target = self._target(node, spec.selector)
+            return self.backend.attr(target, spec.name) if target is not None else None
+        if isinstance(spec, First):
+            target = self.backend.select_first(node, self._selector(spec.selector))
+            return self._record(target, spec.fields) if target is not None else None
+        if isinstance(spec, All):
+            return [self._record(match, spec.fields)
+                    for match in self.backend.select(node, self._selector(spec.selector))]
+        raise TypeError(f"Unknown extraction rule: {spec!r}")
+
+    def extract(self, page_type, html):
+        """Parse `html` and return the record described by RULES[page_type]"""
+        regions = self._regions[page_type] if self.partial else None
+        with metrics.stage("parse"):
+            tree = self.backend.parse_regions(html, regions) if regions else self.backend.parse(html)
+        try:
+            with metrics.stage("extract"):
+                record = self._record(tree, RULES[page_type])
+            metrics.PAGES.inc(page_type=page_type)
+            return record
+        finally:
+            self.backend.release(tree)
+
+def available_backends():
+    """Names of the backends whose parser is installed, fastest first"""
+    names = []
+    for name, backend in BACKENDS.items():
+        try:
+            backend()
+        except ImportError:
+            continue
+        names.append(name)
+    return names
+
+_extractors = {}
+
+def get_extractor(name=None, partial=None):
+    """Return the (cached) Extractor for `name`, FUNPAY_HTML_PARSER, or the fastest installed backend"""
+    name = name or os.environ.get("FUNPAY_HTML_PARSER")
+    if (name, partial) not in _extractors:
+        if name:
+            backend = BACKENDS[name]()
+        else:
+            backend = BACKENDS[available_backends()[0]]()
+        _extractors[name, partial] = Extractor(backend, partial)
+    return _extractors[name, partial]
+
+def extract(page_type, html, backend=None, partial=None):
+    """Extract the record of a page of `page_type` ("home_page", "game_page" or "user_page")"""
+    return get_extractor(backend, partial).extract(page_type, html)
+
+def compare_backends(page_type, html):
+    """Return {backend: record} for every installed backend (and partial mode) whose record differs from a full bs4 parse"""
+    reference = extract(page_type, html, "bs4", partial=False)
+    differing = {name: record for name in available_backends()
+                 if (record := extract(page_type, html, name)) != reference}
+    if (record := extract(page_type, html, "bs4", partial=True)) != reference:
+        differing["bs4-partial"] = record
+    return differing
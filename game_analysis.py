@@ -1,148 +1,318 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
+import matplotlib
+matplotlib.use("Agg")  # headless: charts are only ever written to files
 import matplotlib.pyplot as plt
 import seaborn as sns
 from pathlib import Path
 import sqlite3
 import numpy as np
-from datetime import datetime
-
-def load_games_data(db_path='funpay.db'):
+import warnings
+from datetime import datetime, timedelta
+
+import profiling
+import storage
+from metrics_cache import MetricsCache
+
+# Bump when the look of the charts changes, so unchanged data is rendered again
+CHART_STYLE_VERSION = 1
+# Longest gap over which a game's last value is carried forward (the scheduler's longest interval)
+FILL_LIMIT = timedelta(days=1)
+# Per-format savefig metadata that leaves out creation dates
+DETERMINISTIC_METADATA = {"pdf": {"CreationDate": None}, "svg": {"Date": None}, "png": {"Software": None}}
+matplotlib.rcParams["svg.hashsalt"] = "funpay"
+
+def read_metric_series(db_path='funpay.db', cache_dir='analysis_cache'):
     """
-    Load games data from SQLite database and ensure no empty or null values.
+    Return the game_metrics rows as {column: array} (through the memory-mapped
+    MetricsCache in `cache_dir`, which only appends the runs added since the
+    last report) with the run timestamps, game titles and category names.
     """
-    conn = sqlite3.connect(db_path)
-    cursor = conn.cursor()
-
-    # Get all tables that start with 'games_'
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'games_%'")
-    tables = cursor.fetchall()
-
-    all_data = []
-    for table in tables:
-        table_name = table[0]
-
-        # Get columns for this table
-        cursor.execute(f"PRAGMA table_info({table_name})")
-        columns = [row[1] for row in cursor.fetchall()]
-
-        # Skip tables with only basic columns
-        if len(columns) <= 3:
-            continue
-
-        numerical_columns = [col for col in columns if col not in ('game_id', 'game_url', 'game_title')]
-        if not numerical_columns:
-            continue
-
-        # Read the table and drop rows with missing values
-        query = f"""
-            SELECT game_id, game_title, {', '.join(numerical_columns)}
-            FROM {table_name}
-            WHERE game_title IS NOT NULL
-        """
-        df = pd.read_sql_query(query, conn).dropna()
-
-        # Extract timestamp from table name
-        try:
-            timestamp = pd.to_datetime(table_name.split('_')[1] + '_' + table_name.split('_')[2],
-                                       format='%Y%m%d_%H%M%S')
-            df['timestamp'] = timestamp
-            all_data.append(df)
-        except (IndexError, ValueError):
-            continue  # Skip tables with incorrect naming format
-
-    conn.close()
-
-    if not all_data:
-        raise ValueError("No valid games_* tables found with numerical data")
-
-    return pd.concat(all_data, ignore_index=True)
-
-def get_top_32_games(df, metric_column):
+    conn = storage.connect(db_path, readonly=True)
+    try:
+        cache = MetricsCache(cache_dir)
+        cache.update(conn)
+        columns = cache.load(conn)
+        runs = dict(conn.execute("SELECT run_id, timestamp FROM parser_runs"))
+        games = dict(conn.execute("SELECT game_id, game_title FROM games WHERE game_title IS NOT NULL"))
+        categories = dict(conn.execute("SELECT category_id, name FROM categories"))
+    except sqlite3.DatabaseError as e:
+        raise ValueError(f"No game_metrics store found (run migrate_games_tables.py?): {e}")
+    finally:
+        conn.close()
+    return columns, runs, games, categories
+
+def load_games_data(db_path='funpay.db', cache_dir='analysis_cache'):
     """
-    Get top 32 games by latest absolute values and biggest changes.
+    Load games data from the long-format game_metrics store as one row per
+    (timestamp, game) with a column per metric. Metrics a game did not report
+    in a run are left as NaN.
     """
-    latest_timestamp = df['timestamp'].max()
-    latest_values = df[df['timestamp'] == latest_timestamp][['game_title', metric_column]].dropna()
-
-    if latest_values.empty:
-        return None, None
-
-    top_32_absolute = latest_values.nlargest(20, metric_column)
-
-    pivot_df = df.pivot_table(index='timestamp', columns='game_title', values=metric_column, aggfunc='mean')
-
-    if pivot_df.shape[0] < 2:  # Ensure at least two timestamps exist for change calculation
-        return top_32_absolute, None
-
-    # Calculate percentage change
-    initial_values = pivot_df.iloc[0]
-    final_values = pivot_df.iloc[-1]
-    percentage_change = ((final_values - initial_values) / initial_values) * 100
-    top_32_changes = percentage_change.abs().nlargest(32).dropna()
-
-    return top_32_absolute, pd.DataFrame(top_32_changes)
-
-def plot_time_series_for_games(df, games_list, metric_column, title, y_label, plot_type='absolute', output_dir=None):
+    columns, runs, games, categories = read_metric_series(db_path, cache_dir)
+
+    long_df = pd.DataFrame(columns)
+    long_df = long_df[long_df['game_id'].isin(list(games))]
+    if long_df.empty:
+        raise ValueError("No game metrics found in game_metrics")
+
+    long_df['timestamp'] = pd.to_datetime(long_df['run_id'].map(runs), format='%Y%m%d_%H%M%S')
+    long_df['game_title'] = long_df['game_id'].map(games)
+    long_df['metric'] = long_df['category_id'].map(categories)
+    df = long_df.pivot_table(index=['timestamp', 'game_id', 'game_title'], columns='metric',
+                             values='value', aggfunc='first').reset_index()
+    df.columns.name = None
+    return df[['game_id', 'game_title'] + [c for c in df.columns if c not in ('timestamp', 'game_id', 'game_title')] + ['timestamp']]
+
+class MetricCube:
     """
-    Plot time series data for specific games only if valid data exists.
+    Every metric of every game at every run, as one timestamp x game x metric
+    float array (NaN where a game did not report a metric). Built in a single
+    pass over the long-format rows; the report statistics are computed for
+    all metrics at once from it, so no per-metric pivot is needed.
     """
-    if not games_list:
-        return  # No valid games to plot
 
-    pivot_df = df.pivot_table(index='timestamp', columns='game_title', values=metric_column, aggfunc='mean')
+    def __init__(self, timestamps, games, metrics, values):
+        self.timestamps = timestamps  # DatetimeIndex, ascending
+        self.games = games            # game titles, sorted
+        self.metrics = metrics        # metric names, sorted
+        self.values = values          # shape (len(timestamps), len(games), len(metrics))
+
+    @classmethod
+    def from_series(cls, columns, runs, games, categories):
+        """Build the cube from read_metric_series() output; games sharing a title are averaged"""
+        keep = np.isin(columns['game_id'], np.fromiter(games, dtype=np.int64, count=len(games)))
+        run_ids = np.asarray(columns['run_id'])[keep]
+        game_ids = np.asarray(columns['game_id'])[keep]
+        category_ids = np.asarray(columns['category_id'])[keep]
+        values = np.asarray(columns['value'])[keep].astype(np.float64)
+        if values.size == 0:
+            raise ValueError("No game metrics found in game_metrics")
+
+        def codes(ids, label_of):
+            """Position of each id's label in the sorted list of distinct labels"""
+            unique_ids, inverse = np.unique(ids, return_inverse=True)
+            labels = np.array([label_of[i] for i in unique_ids])
+            axis, label_codes = np.unique(labels, return_inverse=True)
+            return axis, label_codes[inverse]
+
+        # Run timestamps are YYYYmmdd_HHMMSS, so sorting them as strings sorts them in time
+        stamps, t = codes(run_ids, runs)
+        titles, g = codes(game_ids, games)
+        metrics, m = codes(category_ids, categories)
+
+        shape = (len(stamps), len(titles), len(metrics))
+        sums = np.zeros(shape)
+        counts = np.zeros(shape)
+        np.add.at(sums, (t, g, m), values)
+        np.add.at(counts, (t, g, m), 1)
+        with np.errstate(invalid='ignore'):
+            cube = sums / counts
+
+        timestamps = pd.to_datetime(pd.Index(stamps), format='%Y%m%d_%H%M%S')
+
+        # Scheduled runs refresh only the games that are due, so a game missing from
+        # a run keeps the value it was last seen with, for up to FILL_LIMIT
+        seen = np.where(np.isnan(cube), 0, np.arange(len(stamps))[:, None, None])
+        last_seen = np.maximum.accumulate(seen, axis=0)
+        filled = np.take_along_axis(cube, last_seen, axis=0)
+        times = timestamps.values
+        stale = (times[:, None, None] - times[last_seen]) > np.timedelta64(FILL_LIMIT)
+        cube = np.where(stale, np.nan, filled)
+        return cls(timestamps, list(titles), list(metrics), cube)
+
+    def top_latest(self, n=20):
+        """{metric: DataFrame[game_title, metric]} of the `n` largest values at the latest timestamp"""
+        latest = self.values[-1]  # (game, metric)
+        order = np.argsort(-np.nan_to_num(latest, nan=-np.inf), axis=0, kind='stable')
+        top = {}
+        for k, metric in enumerate(self.metrics):
+            ranked = [i for i in order[:, k] if not np.isnan(latest[i, k])][:n]
+            if ranked:
+                top[metric] = pd.DataFrame({'game_title': [self.games[i] for i in ranked], metric: latest[ranked, k]})
+        return top
+
+    def percentage_change(self, n=32):
+        """
+        {metric: DataFrame} of the `n` largest absolute % changes between the first
+        and last timestamps at which the metric was reported (None with fewer than two)
+        """
+        reported = ~np.isnan(self.values).all(axis=1)  # (timestamp, metric)
+        first = reported.argmax(axis=0)
+        last = len(self.timestamps) - 1 - reported[::-1].argmax(axis=0)
+        columns = np.arange(len(self.metrics))
+        initial = self.values[first, :, columns]  # (metric, game)
+        final = self.values[last, :, columns]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            change = np.abs((final - initial) / initial * 100)
+
+        changes = {}
+        for k, metric in enumerate(self.metrics):
+            if reported[:, k].sum() < 2:
+                changes[metric] = None
+                continue
+            series = pd.Series(change[k], index=self.games).dropna()
+            changes[metric] = pd.DataFrame(series.nlargest(n))
+        return changes
+
+    def stats(self):
+        """{metric: DataFrame[mean, min, max, std]} per game, for games with at least two values"""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)  # all-NaN slices and single values
+            table = {
+                'mean': np.nanmean(self.values, axis=0),
+                'min': np.nanmin(self.values, axis=0),
+                'max': np.nanmax(self.values, axis=0),
+                'std': np.nanstd(self.values, axis=0, ddof=1),
+            }
+        return {metric: pd.DataFrame({name: column[:, k] for name, column in table.items()},
+                                     index=pd.Index(self.games, name='game_title')).dropna()
+                for k, metric in enumerate(self.metrics)}
+
+    def series(self, metric, games_list):
+        """DataFrame of `metric` over time for `games_list`, without timestamps where none of them reported"""
+        k = self.metrics.index(metric)
+        positions = [self.games.index(game) for game in games_list]
+        frame = pd.DataFrame(self.values[:, positions, k], index=self.timestamps, columns=list(games_list))
+        return frame.dropna(how='all')
+
+def chart_job(cube, games_list, metric_column, title, y_label, plot_type='absolute'):
+    """Everything needed to draw one chart, or None if there is no valid data to plot"""
+    if not games_list:
+        return None  # No valid games to plot
 
     # Ensure only non-empty data is used
-    plot_data = pivot_df[games_list].dropna(how='all')
+    plot_data = cube.series(metric_column, games_list)
     if plot_data.empty:
-        return
-
-    plt.figure(figsize=(15, 8))
+        return None
+    return {"title": title, "y_label": y_label, "plot_type": plot_type, "data": plot_data}
+
+def chart_hash(job, dpi, fmt):
+    """Digest of a chart's input data and rendering settings"""
+    digest = hashlib.sha256()
+    data = job["data"]
+    digest.update(repr((CHART_STYLE_VERSION, job["title"], job["y_label"], job["plot_type"], dpi, fmt,
+                        list(data.columns))).encode("utf-8"))
+    digest.update(data.index.asi8.tobytes())
+    digest.update(np.ascontiguousarray(data.to_numpy(dtype=np.float64)).tobytes())
+    return digest.hexdigest()
+
+def plot_time_series_for_games(job, output_path, dpi=300):
+    """
+    Plot the time series of one chart job into `output_path` (format from its suffix).
+    """
+    plot_data = job["data"]
     sns.set_style("whitegrid")
     sns.set_palette("husl")
+    fig = plt.figure(figsize=(15, 8))
+    try:
+        for column in plot_data.columns:
+            plt.plot(plot_data.index, plot_data[column], label=column, marker='o', markersize=4)
+
+        plt.title(job["title"])
+        plt.xlabel("Date")
+        plt.ylabel(job["y_label"])
+        plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', title="Games")
+        plt.grid(True, alpha=0.3)
+        if job["plot_type"] == 'change':
+            plt.axhline(y=0, color='black', linestyle='-', alpha=0.2)
+        plt.tight_layout()
+
+        # No creation dates in the file, so identical inputs give identical bytes
+        fig.savefig(output_path, bbox_inches='tight', dpi=dpi, metadata=DETERMINISTIC_METADATA.get(output_path.suffix[1:]))
+    finally:
+        plt.close(fig)
+    return output_path
+
+class ChartRenderer:
+    """
+    Renders chart jobs on a process pool (Agg backend, one figure per job).
 
-    for column in plot_data.columns:
-        plt.plot(plot_data.index, plot_data[column], label=column, marker='o', markersize=4)
-
-    plt.title(title)
-    plt.xlabel("Date")
-    plt.ylabel(y_label)
-    plt.legend(bbox_to_anchor=(1.05, 1), loc='upper left', title="Games")
-    plt.grid(True, alpha=0.3)
-    plt.axhline(y=0, color='black', linestyle='-', alpha=0.2) if plot_type == 'change' else None
-    plt.tight_layout()
+    reports/charts.json maps each chart file name to the hash of its input data
+    and settings, and the file last rendered for it. A chart whose hash has
+    not changed is hard-linked (or copied) from that file instead of being
+    drawn again.
+    """
 
-    if output_dir:
-        output_path = output_dir / f"{title.replace(' ', '_')}.png"
-        plt.savefig(output_path, bbox_inches='tight', dpi=300)
-        plt.close()
+    def __init__(self, reports_dir=Path("reports"), dpi=300, fmt="png", workers=None, force=False):
+        self.manifest_path = Path(reports_dir) / "charts.json"
+        self.dpi = dpi
+        self.fmt = fmt
+        self.workers = workers
+        self.force = force
 
-def main():
+    def _reuse(self, previous, output_path):
+        if output_path.exists() and os.path.samefile(previous, output_path):
+            return
+        try:
+            os.link(previous, output_path)
+        except OSError:
+            shutil.copy2(previous, output_path)
+
+    def render(self, jobs, output_dir):
+        """Render `jobs` into `output_dir`; returns {"rendered": n, "reused": n}"""
+        manifest = json.loads(self.manifest_path.read_text()) if self.manifest_path.exists() else {}
+        pending, reused = [], 0
+        for job in jobs:
+            name = f"{job['title'].replace(' ', '_')}.{self.fmt}"
+            output_path = Path(output_dir) / name
+            digest = chart_hash(job, self.dpi, self.fmt)
+            previous = manifest.get(name)
+            if not self.force and previous and previous["hash"] == digest and Path(previous["path"]).exists():
+                self._reuse(previous["path"], output_path)
+                reused += 1
+            else:
+                pending.append((job, output_path))
+            manifest[name] = {"hash": digest, "path": str(output_path)}
+
+        if pending:
+            workers = min(self.workers or os.cpu_count() or 1, len(pending))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(plot_time_series_for_games, *zip(*pending), [self.dpi] * len(pending)))
+
+        self.manifest_path.write_text(json.dumps(manifest, indent=2, sort_keys=True))
+        return {"rendered": len(pending), "reused": reused}
+
+def main(db_path='funpay.db', dpi=300, fmt='png', workers=None, force=False):
     try:
         print("Loading games data...")
-        df = load_games_data()
+        with profiling.stage("analysis_load"):
+            series = read_metric_series(db_path)
+        with profiling.stage("pivot"):
+            cube = MetricCube.from_series(*series)
         timestamp_str = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
         output_dir = Path(f"reports/{timestamp_str}")
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        metrics = [col for col in df.select_dtypes(include=['int64', 'float64']).columns if col != 'game_id']
-        if not metrics:
+        if not cube.metrics:
             print("No numerical metrics found. Exiting.")
             return
 
-        for metric in metrics:
+        # Every statistic for every metric, from the one cube
+        with profiling.stage("statistics"):
+            top_absolute = cube.top_latest(20)
+            top_changes = cube.percentage_change(32)
+            all_stats = cube.stats()
+
+        jobs = []
+        for metric in cube.metrics:
             print(f"Analyzing {metric}...")
 
-            top_32_absolute, top_32_changes = get_top_32_games(df, metric)
+            top_32_absolute = top_absolute.get(metric)
+            top_32_changes = top_changes[metric]
             if top_32_absolute is None:
                 continue  # Skip metric if no valid data exists
 
-            # Generate plots
-            plot_time_series_for_games(df, top_32_absolute['game_title'].tolist(), metric,
-                                       f"Top 32 Games by {metric} (Absolute Values)", metric, 'absolute', output_dir)
+            # Queue the plots; they are rendered together at the end
+            jobs.append(chart_job(cube, top_32_absolute['game_title'].tolist(), metric,
+                                  f"Top 32 Games by {metric} (Absolute Values)", metric, 'absolute'))
             if top_32_changes is not None:
-                plot_time_series_for_games(df, top_32_changes.index.tolist(), metric,
-                                           f"Top 32 Games by {metric} (Rate of Change)", f"{metric} Change (%)",
-                                           'change', output_dir)
+                jobs.append(chart_job(cube, top_32_changes.index.tolist(), metric,
+                                      f"Top 32 Games by {metric} (Rate of Change)", f"{metric} Change (%)", 'change'))
 
             # Save summary report
             report_path = output_dir / f"{metric}_analysis_report.txt"
@@ -164,13 +334,38 @@ def main():
 
                 f.write("Basic Statistics:\n")
                 f.write("-"*30 + "\n")
-                stats = df.groupby('game_title')[metric].agg(['mean', 'min', 'max', 'std']).dropna()
-                f.write(stats.to_string())
+                f.write(all_stats[metric].to_string())
+
+        print("Rendering charts...")
+        renderer = ChartRenderer(output_dir.parent, dpi=dpi, fmt=fmt, workers=workers, force=force)
+        with profiling.stage("plotting"):
+            counts = renderer.render([job for job in jobs if job is not None], output_dir)
+        print(f"{counts['rendered']} charts rendered, {counts['reused']} unchanged charts reused")
 
         print(f"Analysis complete! Reports saved in {output_dir}")
+        if profiling.PROFILER.enabled:
+            # Stored against the newest run, the one the report describes
+            conn = storage.connect(db_path)
+            try:
+                run_id = conn.execute("SELECT MAX(run_id) FROM parser_runs").fetchone()[0]
+                profiling.PROFILER.save(conn, run_id, "game_analysis")
+            finally:
+                conn.close()
+            print(profiling.PROFILER.report())
 
     except Exception as e:
         print(f"An error occurred: {str(e)}")
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Analyze game metrics and write reports with charts.")
+    parser.add_argument("--db", default="funpay.db", help="SQLite database to analyze")
+    parser.add_argument("--dpi", type=int, default=300, help="chart resolution")
+    parser.add_argument("--format", default="png", choices=["png", "svg", "pdf"], help="chart file format")
+    parser.add_argument("--workers", type=int, help="rendering processes (default: one per CPU)")
+    parser.add_argument("--force", action="store_true", help="render every chart, even if its data did not change")
+    parser.add_argument("--profile", action="store_true", help="time each stage and store the timings in run_profile")
+    parser.add_argument("--profile-dir", help="also write per-stage cProfile stats to this directory")
+    args = parser.parse_args()
+    if args.profile or args.profile_dir:
+        profiling.enable(args.profile_dir)
+    main(args.db, args.dpi, args.format, args.workers, args.force)
@@ -0,0 +1,252 @@
+import datetime
+import json
+import math
+import time
+from collections import deque
+
+from db_manager import category_name
+
+HOUR = datetime.timedelta(hours=1)
+MIN_INTERVAL = datetime.timedelta(minutes=10)
+MAX_INTERVAL = datetime.timedelta(days=1)
+
+# Page requests per hour shared by the home page and all game pages
+HOURLY_BUDGET = 120
+# Weight the change statistics keep at each refresh, so they follow recent behaviour
+DECAY = 0.95
+# History read to estimate change rates when the schedule is first created
+HISTORY = datetime.timedelta(days=7)
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+RUN_FORMAT = "%Y%m%d_%H%M%S"
+
+def counters_key(counters):
+    """Comparable form of a game's counters, as stored in categories/game_metrics"""
+    return json.dumps({category_name(name): value for name, value in counters.items()}, sort_keys=True)
+
+def change_rate(checks, changes, observed_s):
+    """
+    Counter changes per hour, from `checks` refreshes over `observed_s` seconds, of which
+    `changes` saw different counters. A refresh only tells whether something changed
+    since the previous one, not how many times, so the Poisson estimator
+    -ln((n - X + 0.5) / (n + 0.5)) / interval is used rather than X / time.
+    Returns None before anything has been observed.
+    """
+    if checks <= 0 or observed_s <= 0:
+        return None
+    mean_interval_h = observed_s / checks / 3600
+    return max(0.0, -math.log((checks - changes + 0.5) / (checks + 0.5)) / mean_interval_h)
+
+def refresh_intervals(rates, budget):
+    """
+    {game_id: refresh interval} spending `budget` refreshes per hour across the games.
+    Each game gets refreshes in proportion to its change rate, clamped to
+    MIN_INTERVAL..MAX_INTERVAL; games with no history yet count as changing hourly.
+    """
+    if not rates:
+        return {}
+    low, high = HOUR / MAX_INTERVAL, HOUR / MIN_INTERVAL
+    if budget <= low * len(rates):
+        return {game_id: HOUR * len(rates) / max(budget, 1) for game_id in rates}
+    # Games that never changed still share whatever budget the volatile ones leave
+    weights = {game_id: 1.0 if rate is None else max(rate, low) for game_id, rate in rates.items()}
+
+    def planned(scale):
+        return {game_id: min(max(scale * weight, low), high) for game_id, weight in weights.items()}
+
+    # The total is monotonic in the scale: bisect (in log space) for the largest one within budget
+    lo_scale, hi_scale = 1e-6, 1e6
+    for _ in range(60):
+        scale = math.sqrt(lo_scale * hi_scale)
+        if sum(planned(scale).values()) <= budget:
+            lo_scale = scale
+        else:
+            hi_scale = scale
+    return {game_id: HOUR / per_hour for game_id, per_hour in planned(lo_scale).items()}
+
+class GameRefreshScheduler:
+    """
+    Change-aware refresh queue for game pages.
+
+    game_schedule holds one row per game on the home page: when it is next due
+    and decayed counts of its refreshes, how many of them changed its counters
+    and the time they covered. rebalance() turns those into change rates and
+    shares the hourly budget out between games, so volatile games come round
+    every few minutes and stable ones once a day. due() never hands out more
+    than the budget allows in any rolling hour.
+    """
+
+    def __init__(self, db, budget=HOURLY_BUDGET):
+        self.db = db
+        self.budget = budget
+        self.sent = deque()
+        db.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS game_schedule (
+                game_id INTEGER PRIMARY KEY,
+                next_due TEXT NOT NULL,
+                interval_s REAL NOT NULL,
+                checks REAL NOT NULL DEFAULT 0,
+                changes REAL NOT NULL DEFAULT 0,
+                observed_s REAL NOT NULL DEFAULT 0,
+                counters TEXT,
+                last_checked TEXT
+            )
+        ''')
+        db.cursor.execute("CREATE INDEX IF NOT EXISTS idx_game_schedule_due ON game_schedule (next_due)")
+        db.cursor.execute("SELECT 1 FROM game_schedule LIMIT 1")
+        if db.cursor.fetchone() is None:
+            self._seed()
+        db.conn.commit()
+
+    def _seed(self, now=None):
+        """First run: estimate every game's change rate from the game_metrics history"""
+        now = now or datetime.datetime.now()
+        self.db.cursor.execute('''
+            SELECT game_metrics.game_id, parser_runs.timestamp, categories.name, game_metrics.value
+            FROM game_metrics
+            JOIN parser_runs ON parser_runs.run_id = game_metrics.run_id
+            JOIN categories ON categories.category_id = game_metrics.category_id
+            WHERE parser_runs.timestamp >= ?
+            ORDER BY game_metrics.game_id, game_metrics.run_id
+        ''', ((now - HISTORY).strftime(RUN_FORMAT),))
+
+        observations = {}
+        for game_id, timestamp, name, value in self.db.cursor:
+            runs = observations.setdefault(game_id, [])
+            if not runs or runs[-1][0] != timestamp:
+                runs.append((timestamp, {}))
+            runs[-1][1][name] = value
+
+        rows = []
+        for game_id, runs in observations.items():
+            times = [datetime.datetime.strptime(timestamp, RUN_FORMAT) for timestamp, _ in runs]
+            keys = [counters_key(counters) for _, counters in runs]
+            changes = sum(previous != key for previous, key in zip(keys, keys[1:]))
+            last_checked = times[-1].strftime(TIME_FORMAT)
+            rows.append((game_id, last_checked, HOUR.total_seconds(), len(runs) - 1, changes,
+                         (times[-1] - times[0]).total_seconds(), keys[-1], last_checked))
+        self.db.cursor.executemany('''
+            INSERT INTO game_schedule (game_id, next_due, interval_s, checks, changes, observed_s, counters, last_checked)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', rows)
+        self.rebalance()
+
+    def sync(self, games, now=None):
+        """Queue new games from the home page (due now) and drop the ones no longer listed"""
+        if not games:
+            return  # an empty or failed home page fetch must not empty the schedule
+        now = (now or datetime.datetime.now()).strftime(TIME_FORMAT)
+        game_ids = [game_id for game_id, _ in games]
+        self.db.flush()
+        self.db.cursor.executemany(
+            "INSERT OR IGNORE INTO game_schedule (game_id, next_due, interval_s) VALUES (?, ?, ?)",
+            [(game_id, now, HOUR.total_seconds()) for game_id in game_ids]
+        )
+        placeholders = ",".join("?" * len(game_ids))
+        self.db.cursor.execute(f"DELETE FROM game_schedule WHERE game_id NOT IN ({placeholders})", game_ids)
+        self.db.conn.commit()
+        self.rebalance()
+
+    def rebalance(self):
+        """Recompute every game's interval from its change rate, moving next_due to match"""
+        self.db.flush()
+        self.db.cursor.execute("SELECT game_id, checks, changes, observed_s FROM game_schedule")
+        rates = {game_id: change_rate(checks, changes, observed_s)
+                 for game_id, checks, changes, observed_s in self.db.cursor.fetchall()}
+        # One request an hour is left for the home page
+        intervals = refresh_intervals(rates, self.budget - 1)
+        self.db.cursor.executemany('''
+            UPDATE game_schedule SET
+                interval_s = ?,
+                next_due = COALESCE(datetime(last_checked, '+' || CAST(? AS INTEGER) || ' seconds'), next_due)
+            WHERE game_id = ?
+        ''', [(interval.total_seconds(), interval.total_seconds(), game_id) for game_id, interval in intervals.items()])
+        self.db.conn.commit()
+
+    def spend(self, requests=1):
+        """Count requests made outside due() (e.g. the home page) against the hourly budget"""
+        now = time.monotonic()
+        self.sent.extend([now] * requests)
+
+    def remaining(self):
+        """Requests still allowed in the current rolling hour"""
+        now = time.monotonic()
+        while self.sent and self.sent[0] <= now - HOUR.total_seconds():
+            self.sent.popleft()
+        return max(0, self.budget - len(self.sent))
+
+    def due(self, now=None):
+        """[(game_id, game_url)] due for a refresh, most overdue first, within the remaining budget"""
+        limit = self.remaining()
+        if not limit:
+            return []
+        self.db.flush()
+        self.db.cursor.execute('''
+            SELECT game_schedule.game_id, games.game_url FROM game_schedule
+            JOIN games ON games.game_id = game_schedule.game_id
+            WHERE next_due <= ? ORDER BY next_due LIMIT ?
+        ''', ((now or datetime.datetime.now()).strftime(TIME_FORMAT), limit))
+        games = self.db.cursor.fetchall()
+        self.spend(len(games))
+        return games
+
+    def next_due_at(self):
+        """When the earliest queued refresh is due, or None if the queue is empty"""
+        self.db.flush()
+        self.db.cursor.execute("SELECT MIN(next_due) FROM game_schedule")
+        value = self.db.cursor.fetchone()[0]
+        return datetime.datetime.strptime(value, TIME_FORMAT) if value else None
+
+    def record(self, game_id, counters, now=None):
+        """
+        Re-queue `game_id` after a refresh that returned `counters` (None if it failed).
+        Returns True when the counters changed since the previous refresh.
+        """
+        now = now or datetime.datetime.now()
+        self.db.flush()
+        self.db.cursor.execute(
+            "SELECT interval_s, checks, changes, observed_s, counters, last_checked FROM game_schedule WHERE game_id = ?",
+            (game_id,)
+        )
+        row = self.db.cursor.fetchone()
+        if row is None:
+            return False
+        interval_s, checks, changes, observed_s, previous, last_checked = row
+        if counters is None:
+            # Failed refresh: try again at the usual interval, the statistics are unchanged
+            self.db.batch.add("UPDATE game_schedule SET next_due = ? WHERE game_id = ?",
+                              ((now + datetime.timedelta(seconds=interval_s)).strftime(TIME_FORMAT), game_id))
+            return False
+
+        key = counters_key(counters)
+        changed = previous is not None and key != previous
+        if last_checked is not None:
+            elapsed = (now - datetime.datetime.strptime(last_checked, TIME_FORMAT)).total_seconds()
+            checks, changes, observed_s = checks * DECAY + 1, changes * DECAY + changed, observed_s * DECAY + elapsed
+        self.db.batch.add('''
+            UPDATE game_schedule SET
+                next_due = ?, checks = ?, changes = ?, observed_s = ?, counters = ?, last_checked = ?
+            WHERE game_id = ?
+        ''', ((now + datetime.timedelta(seconds=interval_s)).strftime(TIME_FORMAT), checks, changes, observed_s,
+              key, now.strftime(TIME_FORMAT), game_id))
+        return changed
+
+    def queue(self, limit=None):
+        """The schedule in due order: [{"game_id", "game_title", "next_due", "interval_min", "changes_per_hour"}]"""
+        self.db.flush()
+        self.db.cursor.execute('''
+            SELECT game_schedule.game_id, games.game_title, next_due, interval_s, checks, changes, observed_s
+            FROM game_schedule LEFT JOIN games ON games.game_id = game_schedule.game_id
+            ORDER BY next_due LIMIT ?
+        ''', (-1 if limit is None else limit,))
+        queue = []
+        for game_id, title, next_due, interval_s, checks, changes, observed_s in self.db.cursor.fetchall():
+            rate = change_rate(checks, changes, observed_s)
+            queue.append({
+                "game_id": game_id,
+                "game_title": title,
+                "next_due": next_due,
+                "interval_min": round(interval_s / 60, 1),
+                "changes_per_hour": None if rate is None else round(rate, 3),
+            })
+        return queue
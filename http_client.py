@@ -0,0 +1,269 @@
+import json
+import os
+import threading
+import datetime
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+import metrics
+import storage
+from page_archive import PageArchive
+from rate_limiter import AdaptiveRateLimiter
+
+try:
+    import brotli  # noqa: F401  (urllib3 decodes "br" only when brotli is installed)
+    ACCEPT_ENCODING = "gzip, deflate, br"
+except ImportError:
+    ACCEPT_ENCODING = "gzip, deflate"
+
+# Site root; overridable so benchmarks can point every script at a local stand-in server
+FUNPAY_URL = os.environ.get("FUNPAY_URL", "https://funpay.com").rstrip("/")
+
+# Raw page archive written by every client; set FUNPAY_ARCHIVE="" to disable
+ARCHIVE_DB = os.environ.get("FUNPAY_ARCHIVE", "page_archive.db")
+
+DEFAULT_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
+    "Accept-Encoding": ACCEPT_ENCODING,
+}
+
+# HttpClient.stats mirrored as Prometheus counters
+HTTP_COUNTERS = {
+    "requests": metrics.REGISTRY.counter("funpay_http_requests_total", "HTTP requests sent"),
+    "cache_hits": metrics.REGISTRY.counter("funpay_http_cache_hits_total", "Conditional GETs answered 304"),
+    "bytes_downloaded": metrics.REGISTRY.counter("funpay_http_bytes_downloaded_total", "Bytes received over the wire"),
+    "bytes_saved": metrics.REGISTRY.counter("funpay_http_bytes_saved_total", "Bytes not downloaded thanks to 304s"),
+    "throttled": metrics.REGISTRY.counter("funpay_http_throttled_total", "429/5xx answers"),
+}
+
+class TimedHTTPConnection(HTTPConnection):
+    def connect(self):
+        with metrics.stage("connect"):
+            super().connect()
+
+class TimedHTTPSConnection(HTTPSConnection):
+    def connect(self):
+        with metrics.stage("connect"):
+            super().connect()
+
+class TimedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = TimedHTTPConnection
+
+class TimedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = TimedHTTPSConnection
+
+class TimedAdapter(HTTPAdapter):
+    """HTTPAdapter whose connections report their connect time (DNS, TCP and TLS) to metrics"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {"http": TimedHTTPConnectionPool, "https": TimedHTTPSConnectionPool}
+
+class ValidatorCache:
+    """
+    On-disk store of HTTP validators (ETag / Last-Modified) and the parsed
+    result of the last full download of each URL.
+    """
+
+    def __init__(self, db_name='http_cache.db'):
+        self.conn = storage.connect(db_name, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.conn.execute('''
+            CREATE TABLE IF NOT EXISTS http_cache (
+                cache_key TEXT PRIMARY KEY,
+                etag TEXT,
+                last_modified TEXT,
+                content_length INTEGER,
+                payload TEXT,
+                stored_at TEXT NOT NULL
+            )
+        ''')
+        self.conn.commit()
+
+    def get(self, cache_key):
+        """Return (etag, last_modified, content_length, payload) for a key, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, content_length, payload FROM http_cache WHERE cache_key = ?",
+                (cache_key,)
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, content_length, payload = row
+        return etag, last_modified, content_length, json.loads(payload)
+
+    def store(self, cache_key, etag, last_modified, content_length, payload):
+        stored_at = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        with self.lock:
+            self.conn.execute('''
+                INSERT OR REPLACE INTO http_cache (cache_key, etag, last_modified, content_length, payload, stored_at)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (cache_key, etag, last_modified, content_length, json.dumps(payload), stored_at))
+            self.conn.commit()
+
+    def clear(self):
+        """Drop every cached entry, e.g. after an extractor changes its output"""
+        with self.lock:
+            self.conn.execute("DELETE FROM http_cache")
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+class HttpClient:
+    """
+    Shared HTTP client: one pooled keep-alive session with compression, plus
+    conditional GETs backed by a ValidatorCache. Every page downloaded is kept
+    in a PageArchive so it can be re-parsed offline later.
+
+    Requests go through an AdaptiveRateLimiter shared by all threads, which
+    also retries 429/5xx answers after their Retry-After (limiter=False sends
+    everything straight away and leaves retries to the caller).
+    """
+    max_retries = 5
+
+    def __init__(self, pool_size=16, timeout=30, cache=None, headers=None, archive=None, limiter=None):
+        self.session = requests.Session()
+        adapter = TimedAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(DEFAULT_HEADERS)
+        if headers:
+            self.session.headers.update(headers)
+        self.timeout = timeout
+        self.cache = cache if cache is not None else ValidatorCache()
+        if archive is None and ARCHIVE_DB:
+            archive = PageArchive(ARCHIVE_DB)
+        self.archive = archive or None
+        self.limiter = limiter if limiter is not None else AdaptiveRateLimiter()
+        self.limiter = self.limiter or None
+        self.stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """Zero the per-run counters"""
+        with self.stats_lock:
+            self.stats = {"requests": 0, "cache_hits": 0, "bytes_downloaded": 0, "bytes_saved": 0, "throttled": 0}
+
+    def _count(self, **increments):
+        with self.stats_lock:
+            for name, value in increments.items():
+                self.stats[name] += value
+        for name, value in increments.items():
+            HTTP_COUNTERS[name].inc(value)
+
+    @staticmethod
+    def _wire_size(response):
+        """Bytes received over the wire (compressed), falling back to the decoded size"""
+        try:
+            size = response.raw.tell()
+        except (AttributeError, ValueError):
+            size = 0
+        return size or len(response.content)
+
+    def get(self, url, **kwargs):
+        """
+        GET through the pooled session, paced by the rate limiter. Throttled
+        answers (429/5xx) are retried up to `max_retries` times; any other status
+        handling is left to the caller.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                metrics.HTTP_RETRIES.inc()
+            sent_at = self.limiter.acquire(url) if self.limiter else None
+            start = time.perf_counter()
+            response = self.session.get(url, **kwargs)
+            # elapsed stops at the response headers; the rest of the call read the body
+            waited = response.elapsed.total_seconds()
+            metrics.STAGE_SECONDS.observe(waited, stage="wait")
+            metrics.STAGE_SECONDS.observe(max(0.0, time.perf_counter() - start - waited), stage="download")
+            metrics.HTTP_RESPONSES.inc(status=response.status_code)
+            self._count(requests=1, bytes_downloaded=self._wire_size(response))
+            if self.limiter is None or not self.limiter.feedback(
+                    url, sent_at, response.status_code, response.headers.get("Retry-After")):
+                break
+            self._count(throttled=1)
+        if self.archive is not None and response.status_code == 200:
+            self.archive.store(url, response.text)
+        return response
+
+    def get_parsed(self, url, parse, **kwargs):
+        """
+        Conditional GET of `url`, returning `parse(html)`.
+
+        When the server answers 304 the previously parsed result is returned, so
+        neither the body nor the parse is paid again. The result of `parse` must be
+        JSON-serialisable. Non-2xx responses raise requests.HTTPError. Give
+        `parse` a new version (the payload_version decorator) whenever its result
+        changes shape, so results cached by the old version are not returned.
+        """
+        name = getattr(parse, '__qualname__', repr(parse))
+        version = getattr(parse, 'payload_version', None)
+        cache_key = f"{name}@{version}:{url}" if version else f"{name}:{url}"
+        cached = self.cache.get(cache_key)
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        if cached:
+            etag, last_modified, _, _ = cached
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        response = self.get(url, headers=headers, **kwargs)
+        if response.status_code == 304 and cached:
+            self._count(cache_hits=1, bytes_saved=cached[2] or 0)
+            if self.archive is not None:
+                self.archive.touch(url)
+            return cached[3]
+
+        response.raise_for_status()
+        result = parse(response.text)
+
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            self.cache.store(cache_key, etag, last_modified, self._wire_size(response), result)
+        return result
+
+    def summary(self):
+        s = self.stats
+        summary = (f"HTTP: {s['requests']} requests, {s['cache_hits']} cache hits, {s['throttled']} throttled, "
+                   f"{s['bytes_downloaded']} bytes downloaded, {s['bytes_saved']} bytes saved")
+        if self.limiter is not None:
+            summary += f"\nRate: {self.limiter.summary()}"
+        return summary
+
+    def close(self):
+        self.session.close()
+        self.cache.close()
+        if self.archive is not None:
+            self.archive.close()
+
+def payload_version(version):
+    """Decorator tagging a get_parsed() parse function with the version of its result shape"""
+    def tag(parse):
+        parse.payload_version = version
+        return parse
+    return tag
+
+_client = None
+_client_lock = threading.Lock()
+
+def get_client():
+    """Return the process-wide HttpClient, creating it on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+def set_client(client):
+    """Install `client` as the process-wide HttpClient (benchmarks, tests, custom pools)"""
+    global _client
+    with _client_lock:
+        _client = client
@@ -1,87 +1,239 @@
+import argparse
+import asyncio
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin
+
 import requests
-from bs4 import BeautifulSoup
-import sqlite3
-from datetime import datetime
-
-# Connect to SQLite database (or create it if it doesn't exist)
-conn = sqlite3.connect('funpay.db')
-cursor = conn.cursor()
-
-# Create the users table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        user_id INTEGER PRIMARY KEY,
-        username TEXT NOT NULL,
-        status_timestamp DATETIME,
-        registration_timestamp DATETIME,
-        seller_rating REAL,
-        total_reviews INTEGER,
-        created_at DATETIME NOT NULL,
-        updated_at DATETIME NOT NULL
-    )
-''')
-
-# Create the offers table
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS offers (
-        offer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        category TEXT,
-        description TEXT,
-        price TEXT,
-        server_or_platform TEXT,
-        in_stock TEXT,
-        link TEXT,
-        FOREIGN KEY (user_id) REFERENCES users (user_id)
-    )
-''')
-
-# URL of the page to scrape
-url = "https://funpay.com/en/lots/81/"
-
-# Send a GET request to the URL
-response = requests.get(url)
-
-# Check if the request was successful
-if response.status_code == 200:
-    # Parse the HTML content of the page
-    soup = BeautifulSoup(response.content, 'html.parser')
-
-    # Find all the order elements
-    orders = soup.find_all('a', class_='tc-item')
-
-    # Loop through each order and extract the required information
-    for order in orders:
-        # Extract the user ID and user name
-        user_info = order.find('div', class_='media-user-name')
-        user_id = int(order.find('div', class_='avatar-photo')['data-href'].split('/')[-2])
-        user_name = user_info.text.strip() if user_info else 'N/A'
-
-        # Extract the description
-        description = order.find('div', class_='tc-desc-text').text.strip()
-
-        # Extract the price
-        price = order.find('div', class_='tc-price').text.strip()
-
-        # Extract the link
-        link = order['href']
-
-        # Insert user data into the users table
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, created_at, updated_at)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, user_name, datetime.now(), datetime.now()))
-
-        # Insert offer data into the offers table
-        cursor.execute('''
-            INSERT INTO offers (user_id, description, price, link)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, description, price, link))
-
-    # Commit the changes and close the connection
-    conn.commit()
-else:
-    print(f"Failed to retrieve the page. Status code: {response.status_code}")
-
-# Close the database connection
-conn.close()
+from tqdm import tqdm
+
+import metrics
+from db_manager import DatabaseManager
+from extractors import extract
+from http_client import get_client
+from offers_store import setup_offer_tables, sync_listed_offers
+
+# Lot pages fetched at the same time
+CONCURRENCY = 16
+# Upper bound on the pages followed for one paginated lot list
+MAX_PAGES = 50
+
+def setup_tables(cursor):
+    """Create the users, offers and lot crawl progress tables if they do not exist yet"""
+    # Create the users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT NOT NULL,
+            status_timestamp DATETIME,
+            registration_timestamp DATETIME,
+            seller_rating REAL,
+            total_reviews INTEGER,
+            created_at DATETIME NOT NULL,
+            updated_at DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users (updated_at)")
+
+    # Create the offers / offer_changes tables
+    setup_offer_tables(cursor)
+
+    # One row per pass over the catalogue, and one per lot URL done in it
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lot_crawl_passes (
+            pass_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            started_at DATETIME NOT NULL,
+            finished_at DATETIME
+        )
+    ''')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS lot_crawl (
+            lot_url TEXT PRIMARY KEY,
+            pass_id INTEGER NOT NULL,
+            crawled_at DATETIME NOT NULL,
+            status TEXT NOT NULL,
+            pages INTEGER NOT NULL,
+            offers INTEGER NOT NULL
+        )
+    ''')
+
+def parse_lot_page(html):
+    """Offer rows [user_id, user_name, description, price, server, amount, link] of a lot page, and its next page"""
+    record = extract("game_page", html)
+    offers = []
+    for order in record["offers"]:
+        if not order["avatar_href"]:
+            continue
+        offers.append([
+            int(order["avatar_href"].rstrip('/').split('/')[-1]),
+            order["user_name"] or 'N/A',
+            order["description"],
+            order["price_value"] or order["price"],
+            order["server"],
+            order["amount"],
+            order["link"],
+        ])
+    return {"offers": offers, "next_page": record["next_page"]}
+
+class LotCrawler:
+    """
+    Crawl every lot list recorded in the `lots` table.
+
+    Work comes from the distinct lot URLs in `lots`. Pages are fetched
+    `concurrency` at a time, with next-page links followed up to
+    `max_pages`. New and changed offers are upserted by identity and recorded
+    in offer_changes through the batch writer, from the event loop thread.
+
+    Each finished lot is recorded in lot_crawl under the current pass, in the
+    same batch as its offers. An interrupted pass therefore resumes with the
+    lots it has not committed yet.
+    """
+
+    def __init__(self, db, client=None, concurrency=CONCURRENCY, max_pages=MAX_PAGES):
+        self.db = db
+        # Resolved when fetching, so reparse.py can save through a crawler without opening a client
+        self.client = client
+        self.concurrency = concurrency
+        self.max_pages = max_pages
+        self.pass_id = None
+        self.categories = {}  # lot_url -> offer category, see category()
+        setup_tables(db.cursor)
+        db.create_lots_table()
+        db.conn.commit()
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+    def start_pass(self, restart=False):
+        """Resume the unfinished pass, or start a new one (always, with `restart`)"""
+        self.db.cursor.execute("SELECT pass_id FROM lot_crawl_passes WHERE finished_at IS NULL ORDER BY pass_id DESC LIMIT 1")
+        row = self.db.cursor.fetchone()
+        if row and not restart:
+            self.pass_id = row[0]
+        else:
+            self.db.cursor.execute("INSERT INTO lot_crawl_passes (started_at) VALUES (?)", (self._now(),))
+            self.pass_id = self.db.cursor.lastrowid
+        self.db.conn.commit()
+        return self.pass_id
+
+    def category(self, lot_url):
+        """
+        The offer category of a lot list: its game title and lot name, the way
+        a profile page heads the same offers ("Fortnite Accounts"), or the lot
+        name alone when the game is unknown. None for a URL not in `lots`.
+        """
+        if lot_url not in self.categories:
+            # Lots recorded since the last lookup may still be buffered
+            self.db.flush()
+            self.db.cursor.execute('''
+                SELECT lots.lot_url, TRIM(COALESCE(games.game_title || ' ', '') || lots.lot_name)
+                FROM lots LEFT JOIN games ON games.game_id = lots.game_id
+                WHERE lots.lot_id IN (SELECT MAX(lot_id) FROM lots GROUP BY lot_url)
+            ''')
+            self.categories = dict(self.db.cursor.fetchall())
+            self.categories.setdefault(lot_url, None)
+        return self.categories[lot_url]
+
+    def finish_pass(self):
+        """Mark the current pass finished, after the lots queued so far"""
+        self.db.batch.add("UPDATE lot_crawl_passes SET finished_at = ? WHERE pass_id = ?", (self._now(), self.pass_id))
+        self.db.flush()
+
+    def pending(self):
+        """Distinct lot URLs not yet crawled in the current pass, in the order they were recorded"""
+        self.db.flush()
+        self.db.cursor.execute('''
+            SELECT lot_url FROM lots
+            WHERE lot_url NOT IN (SELECT lot_url FROM lot_crawl WHERE pass_id = ?)
+            GROUP BY lot_url ORDER BY MIN(lot_id)
+        ''', (self.pass_id,))
+        return [row[0] for row in self.db.cursor.fetchall()]
+
+    def fetch_lot(self, lot_url):
+        """Fetch a lot list and its following pages; returns (pages, offers). Runs on a worker thread"""
+        offers, seen, url = [], set(), lot_url
+        while url and url not in seen and len(seen) < self.max_pages:
+            seen.add(url)
+            page = (self.client or get_client()).get_parsed(url, parse_lot_page)
+            offers.extend(page["offers"])
+            url = urljoin(url, page["next_page"]) if page["next_page"] else None
+        return len(seen), offers
+
+    def save(self, lot_url, status, pages=0, offers=(), now=None):
+        """Queue the users, offers and progress row of one crawled lot (seen at `now`) on the batch writer"""
+        now = now or self._now()
+        self.db.batch.add_many(
+            "INSERT OR IGNORE INTO users (user_id, username, created_at, updated_at) VALUES (?, ?, ?, ?)",
+            [(user_id, user_name, now, now) for user_id, user_name, *_ in offers]
+        )
+        # Unchanged offers are not rewritten. A lot list shows only part of each
+        # seller's offers, so nothing is marked removed here.
+        category = self.category(lot_url) if offers else None
+        sync_listed_offers(self.db, [
+            (user_id, category, description, price, server, amount, link)
+            for user_id, _, description, price, server, amount, link in offers
+        ], now)
+        self.db.batch.add('''
+            INSERT OR REPLACE INTO lot_crawl (lot_url, pass_id, crawled_at, status, pages, offers)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (lot_url, self.pass_id, now, status, pages, len(offers)))
+
+    async def crawl_lot(self, lot_url, semaphore, executor):
+        """Crawl one lot list; returns the number of offers or None on failure (429s are retried by the client)"""
+        loop = asyncio.get_running_loop()
+        try:
+            async with semaphore:
+                pages, offers = await loop.run_in_executor(executor, self.fetch_lot, lot_url)
+            self.save(lot_url, "ok", pages, offers)
+            return len(offers)
+        except requests.HTTPError as http_err:
+            print(f"HTTP error occurred on {lot_url}: {http_err}")
+        except requests.RequestException as e:
+            print(f"Failed to fetch {lot_url}: {e}")
+
+        # Failed lots are retried by the next pass, not by this one
+        self.save(lot_url, "failed")
+        return None
+
+    async def crawl(self, lot_urls):
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor, \
+                tqdm(total=len(lot_urls), desc="Crawling lots") as pbar:
+            async def crawl_and_count(lot_url):
+                result = await self.crawl_lot(lot_url, semaphore, executor)
+                pbar.update(1)
+                return result
+            return await asyncio.gather(*(crawl_and_count(url) for url in lot_urls))
+
+    def run(self, restart=False):
+        """Crawl the pending lots of the current pass; returns {"lots", "offers", "failed"}"""
+        self.start_pass(restart)
+        lot_urls = self.pending()
+        results = asyncio.run(self.crawl(lot_urls))
+        self.finish_pass()
+        return {
+            "lots": len(lot_urls),
+            "offers": sum(result for result in results if result),
+            "failed": results.count(None),
+        }
+
+def main():
+    parser = argparse.ArgumentParser(description="Crawl every lot list recorded in the lots table into users/offers.")
+    parser.add_argument("--db", default="funpay.db", help="SQLite database with the lots table (filled by main.py)")
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY, help="lot pages fetched at the same time")
+    parser.add_argument("--restart", action="store_true", help="start a new pass instead of resuming the last one")
+    args = parser.parse_args()
+
+    metrics.start_from_env()
+    db = DatabaseManager(args.db, start_run=False)
+    try:
+        stats = LotCrawler(db, concurrency=args.concurrency).run(restart=args.restart)
+    finally:
+        metrics.export()
+        db.close()
+    print(f"Crawled {stats['lots']} lots: {stats['offers']} offers, {stats['failed']} failed")
+    print(get_client().summary())
+
+if __name__ == "__main__":
+    main()
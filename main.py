@@ -1,112 +1,221 @@
+import argparse
+import datetime
 import time
-import schedule
 import requests
-from bs4 import BeautifulSoup
-import re
+import metrics
+import profiling
 from db_manager import DatabaseManager
+from game_scheduler import GameRefreshScheduler, HOURLY_BUDGET
 from scraper import GameScraper
+from async_scraper import AsyncGameScraper
+from http_client import get_client, FUNPAY_URL
+from extractors import extract
 
-def get_games_data():
+# Maximum number of game pages fetched at the same time
+CONCURRENCY = 8
+# How often the home page is re-read for new games, and the shortest scheduler sleep
+HOME_INTERVAL = datetime.timedelta(hours=1)
+BATCH_WINDOW = datetime.timedelta(minutes=1)
+
+def parse_games_page(html):
     """
-    Fetches the HTML from funpay.com/en/, parses it, and extracts
-    game data (title, ID, URL, and lots).
+    Parses the funpay.com/en/ home page and extracts game data
+    (title, ID, URL, and lots).
 
     Returns:
-        list: A list of tuples, where each tuple contains (game_id, game_url, game_title, lots).
+        list: A list of [game_id, game_url, game_title, lots] entries.
     """
-    url = "https://funpay.com/en/"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
-    }
-    try:
-        response = requests.get(url, headers=headers)
-        response.raise_for_status()  # Raise HTTPError for bad responses (4xx or 5xx)
-    except requests.exceptions.RequestException as e:
-        print(f"Error fetching URL: {e}")
-        return []
-
-    soup = BeautifulSoup(response.content, 'html.parser')
-
     games_data = []
 
-    for game_item in soup.find_all('div', class_='promo-game-item'):
-        game_title_tag = game_item.find('div', class_='game-title')
-        if game_title_tag:
-            game_title = game_title_tag.get_text(strip=True)
-            game_id = game_title_tag.get('data-id')
-            game_url = game_title_tag.find('a').get('href')
+    for game_item in extract("home_page", html)["games"]:
+        if game_item["title"] is not None:
+            game_title = game_item["title"]
+            game_id = game_item["game_id"]
+            game_url = game_item["url"]
 
             if not game_url.startswith('http'):
-                game_url = "https://funpay.com" + game_url
+                game_url = FUNPAY_URL + game_url
 
             lots = []
-            lots_list = game_item.find('ul', class_='list-inline')
-            if lots_list:
-                for lot_item in lots_list.find_all('li'):
-                    lot_name = lot_item.get_text(strip=True)
-                    lot_url = lot_item.find('a').get('href')
+            if game_item["lot_list"]:
+                for lot_item in game_item["lot_list"]["lots"]:
+                    lot_name = lot_item["name"]
+                    lot_url = lot_item["url"]
                     if not lot_url.startswith('http'):
-                        lot_url = "https://funpay.com" + lot_url
+                        lot_url = FUNPAY_URL + lot_url
 
-                    lots.append((lot_name, lot_url))
+                    lots.append([lot_name, lot_url])
 
-            games_data.append((game_id, game_url, game_title, lots))
+            games_data.append([game_id, game_url, game_title, lots])
 
     return games_data
 
 
-def main():
-    # Initialize components
-    db = DatabaseManager()
-    scraper = GameScraper()
+def get_games_data(url=FUNPAY_URL + "/en/"):
+    """
+    Fetches the funpay.com/en/ home page through the shared HTTP client
+    and extracts game data (title, ID, URL, and lots).
+
+    Returns:
+        list: A list of tuples, where each tuple contains (game_id, game_url, game_title, lots).
+    """
+    try:
+        games_data = get_client().get_parsed(url, parse_games_page)
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching URL: {e}")
+        return []
 
-    games_data = get_games_data()
+    return [(game_id, game_url, game_title, [tuple(lot) for lot in lots])
+            for game_id, game_url, game_title, lots in games_data]
+
+
+def refresh_home(db):
+    """Fetch the home page into the current run; returns the [(game_id, game_url)] listed on it"""
+    with profiling.stage("home_fetch"):
+        games_data = get_games_data()
 
     db.insert_games(games_data)
     db.create_lots_table()
     db.insert_lots(games_data)
 
     # Get all games from the database
-    games = db.get_all_games()
-    print(f"Processing {len(games)} games...")
+    return db.get_all_games()
+
+
+def refresh_games(db, games):
+    """Scrape `games` [(game_id, game_url)] into the current run; returns {game_id: counters or None}"""
+    # Offers stream into the batched orders writer as each page arrives
+    game_ids = {game_url: game_id for game_id, game_url in games}
+    scraper = AsyncGameScraper(
+        GameScraper(on_offers=lambda game_url, offers: db.save_orders(game_ids.get(game_url), offers)),
+        concurrency=CONCURRENCY
+    )
+
+    # Scrape every game in one event loop, then apply the results
+    scraped = scraper.run(game_url for _, game_url in games)
+
+    # All metric rows of the run are written in one transaction
+    with db.transaction():
+        for game_id, game_url in games:
+            game_details = scraped.get(game_url)
+
+            if game_details:
+                # Update game data (new counter categories are registered on the fly)
+                db.update_game(game_id, game_details)
+                print(f"Updated game_id {game_id} with new values.")
+    return {game_id: scraped.get(game_url) for game_id, game_url in games}
+
 
-    # Process each game
-    for game_id, game_url in games:
-        print(f"Fetching data for {game_url}...")
+def start_run(db):
+    """Start a parser run and label the pages archived from now on with it, for reparse.py"""
+    db.start_run()
+    archive = get_client().archive
+    if archive is not None:
+        archive.run = db.timestamp
 
-        # Scrape game details
-        game_details = scraper.scrape_game_data(game_url)
 
-        if game_details:
-            # Update database structure if needed
-            existing_columns = db.get_existing_columns()
-            for category in game_details.keys():
-                if category not in existing_columns:
-                    print(f"Adding new column: {category}")
-                    db.add_column(category)
+def main():
+    """One full pass: the home page and every game on it"""
+    # Initialize components
+    summary = metrics.RunSummary()
+    db = DatabaseManager(start_run=False)
+    start_run(db)
 
-            # Update game data
-            db.update_game(game_id, game_details)
-            print(f"Updated game_id {game_id} with new values.")
+    games = refresh_home(db)
+    print(f"Processing {len(games)} games...")
+    refresh_games(db, games)
 
     # Cleanup
+    db.save_run_metrics(summary.values())
+    metrics.export()
+    save_profile(db)
     db.close()
+    print(get_client().summary())
+    get_client().reset_stats()
     print("Database update complete.")
 
 
-def run_hourly():
-    print("Starting hourly run...")
-    main()
-    print("Hourly run completed.")
+def run_scheduled(budget=HOURLY_BUDGET):
+    """
+    Refresh games as the GameRefreshScheduler makes them due, within `budget`
+    page requests per hour. The home page is re-read hourly to pick up new games.
+    Each batch of refreshes (with the home page, when it was due too) is its own
+    parser run, and its metrics summary is stored against it.
+    """
+    db = DatabaseManager(start_run=False)
+    scheduler = GameRefreshScheduler(db, budget)
+    next_home = datetime.datetime.now()
+    try:
+        while True:
+            now = datetime.datetime.now()
+            summary = metrics.RunSummary()
+            started = False
+            if now >= next_home:
+                start_run(db)
+                started = True
+                scheduler.spend()
+                scheduler.sync(refresh_home(db))
+                next_home = now + HOME_INTERVAL
+
+            due = scheduler.due()
+            if due:
+                if not started:
+                    start_run(db)
+                    started = True
+                print(f"Refreshing {len(due)} games ({scheduler.remaining()} requests left this hour)...")
+                results = refresh_games(db, due)
+                changed = sum(scheduler.record(game_id, counters) for game_id, counters in results.items())
+                scheduler.rebalance()
+                print(f"{changed} of {len(due)} games changed. {get_client().summary()}")
+                get_client().reset_stats()
+            if started:
+                db.save_run_metrics(summary.values())
+                metrics.export()
+                save_profile(db)
+
+            # Sleep until the next game (or the home page) is due, batching refreshes that fall close together
+            wake = min(filter(None, [scheduler.next_due_at(), next_home]))
+            time.sleep(max(BATCH_WINDOW.total_seconds(), (wake - datetime.datetime.now()).total_seconds()))
+    finally:
+        db.close()
+
+
+def save_profile(db):
+    """With --profile: store and print the stage timings of the current run, then start afresh"""
+    if profiling.PROFILER.enabled:
+        db.flush()
+        profiling.PROFILER.save(db.conn, db.run_id, "main")
+        print(profiling.PROFILER.report())
+        profiling.PROFILER.reset()
+
+
+def print_queue(limit=20):
+    """Print the next `limit` scheduled game refreshes"""
+    db = DatabaseManager(start_run=False)
+    try:
+        for entry in GameRefreshScheduler(db).queue(limit):
+            rate = "unknown" if entry["changes_per_hour"] is None else f"{entry['changes_per_hour']}/h"
+            print(f"{entry['next_due']}  every {entry['interval_min']:>6} min  changes {rate:>9}  "
+                  f"{entry['game_id']:>6} {entry['game_title']}")
+    finally:
+        db.close()
 
 
 if __name__ == "__main__":
-    # Run the script immediately
-    run_hourly()
-
-    # Schedule the script to run every hour
-    schedule.every().hour.do(run_hourly)
-
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Scrape FunPay game counters and offers.")
+    parser.add_argument("--once", action="store_true", help="refresh every game once and exit")
+    parser.add_argument("--budget", type=int, default=HOURLY_BUDGET, help="page requests per hour for the scheduler")
+    parser.add_argument("--queue", type=int, nargs="?", const=20, help="show the next N scheduled refreshes and exit")
+    parser.add_argument("--profile", action="store_true", help="time each stage and store the timings in run_profile")
+    parser.add_argument("--profile-dir", help="also write per-stage cProfile stats to this directory")
+    args = parser.parse_args()
+    if args.profile or args.profile_dir:
+        profiling.enable(args.profile_dir)
+
+    metrics.start_from_env()
+    if args.queue is not None:
+        print_queue(args.queue)
+    elif args.once:
+        main()
+    else:
+        run_scheduled(args.budget)
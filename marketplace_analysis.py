@@ -0,0 +1,341 @@
+"""
+Marketplace statistics over the users and offers tables, kept up to date incrementally.
+
+For every (category, server, currency) group of listed offers the report gives:
+    price distribution    quantiles, and offer counts over log-spaced price bins
+    seller concentration  sellers, Herfindahl index and top-5 share of the offers
+    rating vs price       Spearman correlation of seller rating and price
+    stock depth           total stock, and stock within 10% / 25% of the cheapest price
+Amounts in different currencies are not comparable, so currency is part of the group.
+
+The listed offers are kept in analysis_cache/marketplace/, one array per
+column (offer, seller, group, amount, stock, seller rating). Next to them,
+meta.json holds the high-water marks of offers.last_seen / removed_at and
+users.updated_at (and of their merged_at, stamped by shard merges, which keep
+the shard's own timestamps), and results.json the per-group results of the previous
+report. Each report reads, FETCH_ROWS at a time, only the offers inserted,
+updated or removed since then, plus the sellers whose profile was revisited.
+It applies them to the arrays and recomputes only the groups they touched.
+The statistics are pandas/NumPy group-wise operations, with no Python loop
+over offers.
+
+Batched writes can commit after newer ones, so every pass re-reads the
+OVERLAP window before the high-water marks. Applying a
+change twice does no harm. Use --full after backfill_prices.py, which fills
+amounts without touching last_seen.
+
+    python marketplace_analysis.py
+    python marketplace_analysis.py --full
+"""
+import argparse
+import json
+import os
+from datetime import datetime, timedelta
+from io import StringIO
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+import profiling
+import storage
+
+FETCH_ROWS = 100_000
+OVERLAP = timedelta(hours=1)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+QUANTILES = (0.1, 0.25, 0.5, 0.75, 0.9)
+# Histogram bin edges: quarter decades from 0.01 to 1 000 000
+PRICE_BINS = 10.0 ** np.arange(-2, 6.01, 0.25)
+# Stock offered at most this far above the group's cheapest price
+DEPTH_LEVELS = (0.10, 0.25)
+TOP_SELLERS = 5
+# Fewer rated offers than this give no rating / price correlation
+MIN_RATED = 5
+# User IDs per "IN (...)" lookup
+ID_BATCH = 500
+
+STATE_COLUMNS = {"user_id": np.int64, "group": np.int64, "amount": np.float64, "stock": np.float64,
+                 "rating": np.float64}
+OFFER_FIELDS = ["offer_id", "user_id", "category", "server", "currency", "amount", "stock", "removed_at"]
+OFFERS_QUERY = "SELECT offer_id, user_id, category, server_or_platform, currency, amount, stock, removed_at FROM offers"
+
+# Columns that tell an offer / a seller changed, when the table has them
+STAMP_COLUMNS = {"offers": ("last_seen", "removed_at", "merged_at"), "users": ("updated_at", "merged_at")}
+
+def _stamps(conn, table):
+    """The STAMP_COLUMNS `table` has (merged_at is missing until a shard merge or scraper adds it)"""
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    return [column for column in STAMP_COLUMNS[table] if column in existing]
+
+def _changed_since(conn, table, key, since):
+    """SQL selecting the `key` of `table` rows with any stamp >= `since` (one index range scan each), and its args"""
+    columns = _stamps(conn, table)
+    return (" UNION ".join(f"SELECT {key} FROM {table} WHERE {column} >= ?" for column in columns),
+            [since] * len(columns))
+
+def _mark(conn, table):
+    """The latest stamp of `table`, or None when it has none"""
+    columns = _stamps(conn, table)
+    stamps = conn.execute(f"SELECT {', '.join(f'MAX({column})' for column in columns)} FROM {table}").fetchone()
+    return max(filter(None, stamps), default=None)
+
+def _since(mark):
+    """`mark` moved back by OVERLAP, as a TIME_FORMAT string"""
+    return (datetime.strptime(mark, TIME_FORMAT) - OVERLAP).strftime(TIME_FORMAT)
+
+def seller_ratings(conn, user_ids):
+    """Series of users.seller_rating indexed by user_id (NaN for unrated or unknown sellers)"""
+    user_ids = [int(user_id) for user_id in user_ids]
+    ratings = {}
+    for start in range(0, len(user_ids), ID_BATCH):
+        batch = user_ids[start:start + ID_BATCH]
+        ratings.update(conn.execute(
+            f"SELECT user_id, seller_rating FROM users WHERE user_id IN ({','.join('?' * len(batch))})", batch
+        ))
+    return pd.Series(ratings, dtype=np.float64).reindex(user_ids)
+
+def group_stats(frame):
+    """One row of statistics per group of `frame` (listed offers with STATE_COLUMNS)"""
+    by_group = frame.groupby("group")
+    stats = pd.DataFrame({"offers": by_group.size(), "sellers": by_group["user_id"].nunique()})
+
+    # Seller concentration over the group's offers
+    per_seller = frame.groupby(["group", "user_id"]).size()
+    share = per_seller / per_seller.groupby(level="group").transform("sum")
+    stats["hhi"] = (share ** 2).groupby(level="group").sum()
+    top = share.sort_values(ascending=False).groupby(level="group").head(TOP_SELLERS)
+    stats[f"top{TOP_SELLERS}_share"] = top.groupby(level="group").sum()
+
+    # Price distribution
+    priced = frame[frame["amount"].notna()]
+    price = priced.groupby("group")["amount"]
+    stats["priced"] = price.size()
+    stats["min"], stats["mean"], stats["max"] = price.min(), price.mean(), price.max()
+    if len(priced):
+        quantiles = price.quantile(list(QUANTILES)).unstack()
+        for q in QUANTILES:
+            stats[f"p{round(q * 100)}"] = quantiles[q]
+        bins = np.searchsorted(PRICE_BINS, priced["amount"].to_numpy(), side="right")
+        counts = priced.groupby(["group", bins]).size().unstack(fill_value=0)
+        counts = counts.reindex(columns=range(len(PRICE_BINS) + 1), fill_value=0)
+        stats["histogram"] = pd.Series(counts.to_numpy().tolist(), index=counts.index)
+    else:
+        for q in QUANTILES:
+            stats[f"p{round(q * 100)}"] = np.nan
+        stats["histogram"] = None
+
+    # Rating vs price: Spearman = Pearson over the (tie-averaged) ranks within each group
+    rated = priced[priced["rating"].notna()]
+    x = rated.groupby("group")["amount"].rank()
+    y = rated.groupby("group")["rating"].rank()
+    sums = pd.DataFrame({"n": 1, "x": x, "y": y, "xy": x * y, "xx": x * x, "yy": y * y}).groupby(rated["group"]).sum()
+    covariance = sums["n"] * sums["xy"] - sums["x"] * sums["y"]
+    variance = (sums["n"] * sums["xx"] - sums["x"] ** 2) * (sums["n"] * sums["yy"] - sums["y"] ** 2)
+    stats["rated"] = sums["n"]
+    stats["rating_price_corr"] = (covariance / np.sqrt(variance)).where((sums["n"] >= MIN_RATED) & (variance > 0))
+
+    # Stock depth: everything listed, and what is offered close to the cheapest price
+    stats["stock"] = frame["stock"].groupby(frame["group"]).sum()
+    cheapest = price.transform("min")
+    stock = priced["stock"].fillna(0)
+    for level in DEPTH_LEVELS:
+        within = stock.where(priced["amount"] <= cheapest * (1 + level), 0)
+        stats[f"stock_within_{round(level * 100)}pct"] = within.groupby(priced["group"]).sum()
+
+    counts = ["priced", "rated"]
+    stats[counts] = stats[counts].fillna(0).astype(np.int64)
+    return stats
+
+class MarketplaceState:
+    """Listed offers as column arrays, per-group results and the high-water marks they cover"""
+
+    def __init__(self, cache_dir='analysis_cache/marketplace'):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.meta_path = self.dir / "meta.json"
+        self.state_path = self.dir / "offers.npz"
+        self.results_path = self.dir / "results.json"
+        self.load()
+
+    def reset(self):
+        self.meta = {"db": None, "offers_mark": None, "users_mark": None, "groups": []}
+        self.offers = pd.DataFrame({column: np.empty(0, dtype) for column, dtype in STATE_COLUMNS.items()},
+                                   index=pd.Index([], dtype=np.int64, name="offer_id"))
+        self.results = pd.DataFrame(index=pd.Index([], dtype=np.int64, name="group"))
+
+    def load(self):
+        self.reset()
+        if not (self.meta_path.exists() and self.state_path.exists() and self.results_path.exists()):
+            return
+        self.meta = json.loads(self.meta_path.read_text())
+        with np.load(self.state_path) as arrays:
+            self.offers = pd.DataFrame({column: arrays[column] for column in STATE_COLUMNS},
+                                       index=pd.Index(arrays["offer_id"], name="offer_id"))
+        self.results = pd.read_json(StringIO(self.results_path.read_text()), orient="split",
+                                    dtype=False, convert_dates=False)
+        self.results.index.name = "group"
+
+    def save(self):
+        # meta.json goes last: a crash part-way leaves the previous high-water marks, and the next pass redoes the work
+        tmp = self.state_path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            np.savez(f, offer_id=self.offers.index.to_numpy(dtype=np.int64),
+                     **{column: self.offers[column].to_numpy(dtype=dtype) for column, dtype in STATE_COLUMNS.items()})
+        os.replace(tmp, self.state_path)
+        for path, text in ((self.results_path, self.results.to_json(orient="split", double_precision=15)),
+                           (self.meta_path, json.dumps(self.meta))):
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(text)
+            os.replace(tmp, path)
+
+    def _group_codes(self, chunk):
+        """Group code of every row of `chunk`, registering (category, server, currency) groups seen for the first time"""
+        labels = chunk[["category", "server", "currency"]].fillna("")
+        keys = labels["category"] + "\x1f" + labels["server"] + "\x1f" + labels["currency"]
+        codes = {"\x1f".join(group): code for code, group in enumerate(self.meta["groups"])}
+        for key in keys.unique():
+            if key not in codes:
+                codes[key] = len(self.meta["groups"])
+                self.meta["groups"].append(key.split("\x1f"))
+        return keys.map(codes).astype(np.int64)
+
+    def _read_offers(self, conn, full):
+        """Offers changed since the high-water mark (every listed offer on a full pass), FETCH_ROWS at a time"""
+        if full:
+            cursor = conn.execute(OFFERS_QUERY + " WHERE removed_at IS NULL")
+        else:
+            changed, args = _changed_since(conn, "offers", "offer_id", _since(self.meta["offers_mark"]))
+            cursor = conn.execute(OFFERS_QUERY + f" WHERE offer_id IN ({changed})", args)
+        chunks = []
+        while rows := cursor.fetchmany(FETCH_ROWS):
+            chunk = pd.DataFrame.from_records(rows, columns=OFFER_FIELDS)
+            chunk["group"] = self._group_codes(chunk)
+            chunks.append(chunk.drop(columns=["category", "server", "currency"]))
+        if not chunks:
+            return pd.DataFrame(columns=OFFER_FIELDS[:2] + ["amount", "stock", "removed_at", "group"])
+        return pd.concat(chunks, ignore_index=True)
+
+    def _apply_offers(self, conn, changes):
+        """Replace the changed offers in the arrays; returns the groups whose offers differ from before"""
+        changes = changes.drop_duplicates("offer_id", keep="last").set_index("offer_id")
+        removed = changes.index[changes["removed_at"].notna()].intersection(self.offers.index)
+        listed = changes[changes["removed_at"].isna()]
+        listed = listed.assign(rating=seller_ratings(conn, listed["user_id"].unique())
+                               .reindex(listed["user_id"]).to_numpy())
+        listed = listed[list(STATE_COLUMNS)].astype(STATE_COLUMNS)
+
+        # Rows re-read from the overlap window usually match what is stored already
+        old = self.offers.reindex(listed.index)
+        same = ((old == listed) | (old.isna() & listed.isna())).all(axis=1)
+        listed, old = listed[~same], old[~same]
+
+        dirty = set(self.offers.loc[removed, "group"]) | set(listed["group"]) | set(old["group"].dropna().astype(np.int64))
+        self.offers = pd.concat([self.offers.drop(removed.union(listed.index), errors="ignore"), listed])
+        return dirty
+
+    def _apply_ratings(self, conn):
+        """Refresh the ratings of sellers whose profile was visited or merged since the high-water mark; returns dirty groups"""
+        changed, args = _changed_since(conn, "users", "user_id", _since(self.meta["users_mark"]))
+        cursor = conn.execute(f"SELECT user_id, seller_rating FROM users WHERE user_id IN ({changed})", args)
+        dirty = set()
+        while rows := cursor.fetchmany(FETCH_ROWS):
+            ratings = pd.Series(dict(rows), dtype=np.float64)
+            mask = self.offers["user_id"].isin(ratings.index)
+            if not mask.any():
+                continue
+            new = self.offers.loc[mask, "user_id"].map(ratings)
+            old = self.offers.loc[mask, "rating"]
+            changed = ~((new == old) | (new.isna() & old.isna()))
+            changed = changed[changed].index
+            self.offers.loc[changed, "rating"] = new[changed]
+            dirty |= set(self.offers.loc[changed, "group"])
+        return dirty
+
+    def update(self, conn, db_name, full=False):
+        """Bring the arrays and results up to date with `conn`; returns {"offers_read", "groups_recomputed", "full"}"""
+        if full or self.meta["db"] != str(Path(db_name).resolve()) or self.meta["offers_mark"] is None:
+            self.reset()
+            full = True
+        self.meta["db"] = str(Path(db_name).resolve())
+
+        # The marks are taken first: rows committed while reading are picked up by the next pass
+        offers_mark = _mark(conn, "offers")
+        users_mark = _mark(conn, "users")
+
+        with profiling.stage("marketplace_load"):
+            changes = self._read_offers(conn, full)
+            dirty = self._apply_offers(conn, changes)
+            if not full and self.meta["users_mark"] is not None:
+                dirty |= self._apply_ratings(conn)
+
+        with profiling.stage("marketplace_stats"):
+            dirty = sorted(dirty)
+            fresh = group_stats(self.offers[self.offers["group"].isin(dirty)])
+            kept = self.results.drop(index=dirty, errors="ignore")
+            self.results = pd.concat([kept, fresh]).sort_index() if len(kept) else fresh.sort_index()
+            self.results.index.name = "group"
+
+        self.meta["offers_mark"] = offers_mark or self.meta["offers_mark"]
+        self.meta["users_mark"] = users_mark or self.meta["users_mark"]
+        self.save()
+        return {"offers_read": len(changes), "groups_recomputed": len(dirty), "full": full}
+
+    def report(self):
+        """The per-group results with their category / server / currency labels, without the histograms"""
+        labels = pd.DataFrame([self.meta["groups"][code] for code in self.results.index],
+                              columns=["category", "server", "currency"], index=self.results.index)
+        return labels.join(self.results.drop(columns="histogram", errors="ignore"))
+
+    def histograms(self):
+        """{"edges", "groups": [{"category", "server", "currency", "counts"}]} of the price histograms"""
+        groups = []
+        for code, counts in self.results.get("histogram", pd.Series(dtype=object)).items():
+            if isinstance(counts, list):
+                category, server, currency = self.meta["groups"][code]
+                groups.append({"category": category, "server": server, "currency": currency, "counts": counts})
+        return {"edges": PRICE_BINS.tolist(), "groups": groups}
+
+def main(db_path='funpay.db', cache_dir='analysis_cache/marketplace', full=False):
+    conn = storage.connect(db_path, readonly=True)
+    try:
+        state = MarketplaceState(cache_dir)
+        counts = state.update(conn, db_path, full)
+    finally:
+        conn.close()
+
+    timestamp_str = datetime.utcnow().strftime("%Y%m%d_%H%M%S")
+    output_dir = Path(f"reports/{timestamp_str}")
+    output_dir.mkdir(parents=True, exist_ok=True)
+    report = state.report()
+    report.to_csv(output_dir / "marketplace.csv", index=False)
+    (output_dir / "marketplace_histograms.json").write_text(json.dumps(state.histograms()))
+
+    print(f"{'Full rebuild' if counts['full'] else 'Incremental update'}: {counts['offers_read']} offers read, "
+          f"{counts['groups_recomputed']} of {len(report)} groups recomputed")
+    if len(report):
+        print(report.sort_values("offers", ascending=False).head(20)[
+            ["category", "server", "currency", "offers", "sellers", "p50", "hhi", "rating_price_corr", "stock"]
+        ].to_string(index=False))
+    print(f"Marketplace report saved in {output_dir}")
+
+    if profiling.PROFILER.enabled:
+        conn = storage.connect(db_path)
+        try:
+            run_id = conn.execute("SELECT MAX(run_id) FROM parser_runs").fetchone()[0]
+            profiling.PROFILER.save(conn, run_id, "marketplace_analysis")
+        finally:
+            conn.close()
+        print(profiling.PROFILER.report())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Per category / server price, seller and stock statistics of the listed offers.")
+    parser.add_argument("--db", default="funpay.db")
+    parser.add_argument("--cache-dir", default="analysis_cache/marketplace")
+    parser.add_argument("--full", action="store_true", help="rebuild from every listed offer instead of the changes")
+    parser.add_argument("--profile", action="store_true", help="store per-stage wall/CPU times in run_profile")
+    parser.add_argument("--profile-dir", help="also write a cProfile dump per stage to this directory")
+    args = parser.parse_args()
+
+    if args.profile or args.profile_dir:
+        profiling.enable(args.profile_dir)
+    main(args.db, args.cache_dir, args.full)
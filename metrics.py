@@ -0,0 +1,216 @@
+"""
+Process-wide counters and latency histograms for the scrape pipeline.
+
+funpay_stage_seconds{stage} times each stage of a page's way into the database:
+    connect    opening an HTTP connection (DNS lookup, TCP and TLS handshakes)
+    wait       request sent until the response headers arrived
+    download   reading the response body
+    parse      HTML into a tree
+    extract    RULES applied to the tree
+    db_write   one BatchWriter flush (executemany + commit)
+Counters cover HTTP responses by status, 429/5xx answers, retries, conditional
+GET cache hits, bytes, pages extracted and rows written.
+
+Everything is rendered in the Prometheus text format. Set FUNPAY_METRICS_PORT
+to serve it on http://127.0.0.1:<port>/metrics, and FUNPAY_METRICS_FILE to have
+export() write it to a file (e.g. for node_exporter's textfile collector).
+RunSummary turns the counters into per-run deltas that DatabaseManager stores
+in run_metrics, next to parser_runs.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Histogram bucket upper bounds, in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, value=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self):
+        """[(sample name, value)] of every label combination seen so far"""
+        with self.lock:
+            return [(self.name + _labels(self.labels, key), value) for key, value in sorted(self.values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{sample} {value}" for sample, value in self.samples()]
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    state[index] += 1
+                    break
+            state[-2] += seconds
+            state[-1] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        """[(sample name, value)] of the _sum and _count series"""
+        with self.lock:
+            items = sorted((key, list(state)) for key, state in self.values.items())
+        samples = []
+        for key, state in items:
+            samples.append((f"{self.name}_sum{_labels(self.labels, key)}", state[-2]))
+            samples.append((f"{self.name}_count{_labels(self.labels, key)}", state[-1]))
+        return samples
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            items = sorted((key, list(state)) for key, state in self.values.items())
+        for key, state in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, state):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + (bound,))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), key + ('+Inf',))} {state[-1]}")
+            lines.append(f"{self.name}_sum{_labels(self.labels, key)} {state[-2]}")
+            lines.append(f"{self.name}_count{_labels(self.labels, key)} {state[-1]}")
+        return lines
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def _get(self, cls, name, help, labels):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, help, labels)
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def histogram(self, name, help, labels=()):
+        return self._get(Histogram, name, help, labels)
+
+    def render(self):
+        """Every metric in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """{sample name: value} of every counter and histogram sum/count"""
+        return {sample: value for metric in list(self.metrics.values()) for sample, value in metric.samples()}
+
+    def write(self, path):
+        """Write render() to `path` atomically"""
+        tmp = f"{path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+    def serve(self, port, host="127.0.0.1"):
+        """Serve render() on http://host:port/metrics from a daemon thread (once per process)"""
+        if self.server is not None:
+            return self.server
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] not in ("/metrics", "/"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self.server
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.histogram("funpay_stage_seconds", "Time spent in each pipeline stage", ("stage",))
+HTTP_RESPONSES = REGISTRY.counter("funpay_http_responses_total", "HTTP responses by status code", ("status",))
+HTTP_RETRIES = REGISTRY.counter("funpay_http_retries_total", "Requests sent again after a 429/5xx answer")
+PAGES = REGISTRY.counter("funpay_pages_extracted_total", "Pages run through the extractor", ("page_type",))
+DB_ROWS = REGISTRY.counter("funpay_db_rows_written_total", "Rows written by the batch writer")
+
+def stage(name):
+    """Context manager timing one `name` stage into funpay_stage_seconds"""
+    return STAGE_SECONDS.time(stage=name)
+
+def start_from_env():
+    """Serve the metrics endpoint when FUNPAY_METRICS_PORT is set"""
+    port = os.environ.get("FUNPAY_METRICS_PORT")
+    if port:
+        REGISTRY.serve(int(port))
+
+def export():
+    """Write the metrics file when FUNPAY_METRICS_FILE is set"""
+    path = os.environ.get("FUNPAY_METRICS_FILE")
+    if path:
+        REGISTRY.write(path)
+
+class RunSummary:
+    """What the counters and histograms gained between construction and values()"""
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.baseline = REGISTRY.snapshot()
+
+    def values(self):
+        """{sample name: increase}, plus duration_seconds and pages_per_second"""
+        duration = time.monotonic() - self.start
+        values = {"duration_seconds": duration}
+        for sample, value in REGISTRY.snapshot().items():
+            delta = value - self.baseline.get(sample, 0)
+            if delta:
+                values[sample] = delta
+        pages = sum(value for sample, value in values.items() if sample.startswith(PAGES.name))
+        values["pages_per_second"] = pages / duration if duration else 0.0
+        return values
@@ -0,0 +1,123 @@
+"""
+Append-only columnar cache of the game_metrics series for game_analysis.
+
+The cache is one raw binary file per column (run_id, game_id, category_id,
+value) plus meta.json, which records how many rows are valid and the last
+run they cover. Columns are read back with np.memmap, so loading the whole
+history costs a few page faults instead of a SQL scan. update() appends
+only the runs added since the last call. A run is cached once its writer
+has set parser_runs.finished_at, or once it started more than STALE_RUN ago
+(a writer that crashed, or a database from before the column). Several
+processes start runs, so an older run_id may still be writing when a newer
+one exists; the cache stops at the first unfinished run, and it and
+everything after it are read from SQLite on every load.
+
+If the database no longer has the last cached run with the same timestamp
+(rebuilt, replaced or pointed at another file), the cache is dropped and
+rebuilt.
+"""
+import json
+import os
+import sqlite3
+from datetime import datetime, timedelta
+from pathlib import Path
+
+import numpy as np
+
+COLUMNS = {"run_id": np.int64, "game_id": np.int64, "category_id": np.int32, "value": np.int64}
+METRICS_QUERY = "SELECT run_id, game_id, category_id, value FROM game_metrics WHERE run_id > ? AND run_id <= ? ORDER BY run_id"
+FETCH_ROWS = 100_000
+# A run not marked finished this long after it started is treated as complete
+STALE_RUN = timedelta(days=1)
+
+class MetricsCache:
+    def __init__(self, cache_dir='analysis_cache'):
+        self.dir = Path(cache_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.meta_path = self.dir / "meta.json"
+        self.meta = self._read_meta()
+
+    def _read_meta(self):
+        if self.meta_path.exists():
+            return json.loads(self.meta_path.read_text())
+        return {"rows": 0, "last_run_id": 0, "last_timestamp": None}
+
+    def _write_meta(self):
+        # Written after the column data, and atomically: a crash leaves the old row count in force
+        tmp = self.meta_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.meta))
+        os.replace(tmp, self.meta_path)
+
+    def _path(self, column):
+        return self.dir / f"{column}.bin"
+
+    def reset(self):
+        for column in COLUMNS:
+            self._path(column).unlink(missing_ok=True)
+        self.meta = {"rows": 0, "last_run_id": 0, "last_timestamp": None}
+        self._write_meta()
+
+    def _append(self, rows):
+        block = np.array(rows, dtype=np.int64).reshape(-1, len(COLUMNS))
+        for index, (column, dtype) in enumerate(COLUMNS.items()):
+            with open(self._path(column), "ab") as f:
+                f.write(block[:, index].astype(dtype).tobytes())
+        return len(block)
+
+    def update(self, conn):
+        """Append the complete runs that are not cached yet; returns the number of rows added"""
+        try:
+            rows = conn.execute("SELECT run_id, timestamp, finished_at FROM parser_runs ORDER BY run_id").fetchall()
+        except sqlite3.OperationalError:
+            # parser_runs from before finished_at: only the age of a run tells it is complete
+            rows = conn.execute("SELECT run_id, timestamp, NULL FROM parser_runs ORDER BY run_id").fetchall()
+        runs = {run_id: timestamp for run_id, timestamp, _ in rows}
+        last_run_id = self.meta["last_run_id"]
+        if last_run_id and runs.get(last_run_id) != self.meta["last_timestamp"]:
+            self.reset()
+            last_run_id = 0
+
+        stale = (datetime.now() - STALE_RUN).strftime("%Y%m%d_%H%M%S")
+        upto = None
+        for run_id, timestamp, finished_at in rows:
+            if run_id <= last_run_id:
+                continue
+            if finished_at is None and timestamp >= stale:
+                break
+            upto = run_id
+        if upto is None:
+            return 0
+
+        # Drop bytes past the recorded row count (left by an append that did not finish)
+        for column, dtype in COLUMNS.items():
+            path = self._path(column)
+            if path.exists():
+                with open(path, "r+b") as f:
+                    f.truncate(self.meta["rows"] * np.dtype(dtype).itemsize)
+
+        added = 0
+        cursor = conn.execute(METRICS_QUERY, (last_run_id, upto))
+        while rows := cursor.fetchmany(FETCH_ROWS):
+            added += self._append(rows)
+
+        self.meta.update(rows=self.meta["rows"] + added, last_run_id=upto, last_timestamp=runs[upto])
+        self._write_meta()
+        return added
+
+    def columns(self):
+        """{column: read-only memory-mapped array} of the cached rows"""
+        rows = self.meta["rows"]
+        if rows == 0:
+            return {column: np.empty(0, dtype=dtype) for column, dtype in COLUMNS.items()}
+        return {column: np.memmap(self._path(column), dtype=dtype, mode="r", shape=(rows,))
+                for column, dtype in COLUMNS.items()}
+
+    def load(self, conn):
+        """All game_metrics rows as {column: array}: the cached ones plus those newer than the cache, from SQLite"""
+        cached = self.columns()
+        tail = conn.execute(METRICS_QUERY, (self.meta["last_run_id"], 2 ** 62)).fetchall()
+        if not tail:
+            return cached
+        tail = np.array(tail, dtype=np.int64).reshape(-1, len(COLUMNS))
+        return {column: np.concatenate([cached[column], tail[:, index].astype(dtype)])
+                for index, (column, dtype) in enumerate(COLUMNS.items())}
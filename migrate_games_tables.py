@@ -0,0 +1,82 @@
+import argparse
+import re
+import sqlite3
+
+from db_manager import DatabaseManager
+
+LEGACY_TABLE = re.compile(r'^games_(\d{8}_\d{6})$')
+BASE_COLUMNS = ('game_id', 'game_url', 'game_title')
+
+def list_legacy_tables(cursor):
+    """Return the per-run games_YYYYMMDD_HHMMSS tables ordered by timestamp"""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'games%'")
+    return sorted(name for (name,) in cursor.fetchall() if LEGACY_TABLE.match(name))
+
+def migrate_table(db, table_name):
+    """Import one legacy games_* table into games / categories / game_metrics; returns rows imported"""
+    cursor = db.cursor
+    timestamp = LEGACY_TABLE.match(table_name).group(1)
+
+    cursor.execute("INSERT OR IGNORE INTO parser_runs (timestamp) VALUES (?)", (timestamp,))
+    cursor.execute("SELECT run_id FROM parser_runs WHERE timestamp = ?", (timestamp,))
+    run_id = cursor.fetchone()[0]
+
+    cursor.execute(f"PRAGMA table_info({table_name})")
+    metric_columns = [row[1] for row in cursor.fetchall() if row[1] not in BASE_COLUMNS]
+
+    cursor.execute(f"SELECT game_id, game_url, game_title FROM {table_name}")
+    games = cursor.fetchall()
+    # Keep the newest URL/title for each game, without moving its last_seen_run
+    cursor.executemany('''
+        INSERT INTO games (game_id, game_url, game_title, last_seen_run) VALUES (?, ?, ?, ?)
+        ON CONFLICT(game_id) DO UPDATE SET
+            game_url = excluded.game_url,
+            game_title = excluded.game_title,
+            last_seen_run = MAX(COALESCE(last_seen_run, 0), excluded.last_seen_run)
+    ''', [(game_id, game_url, game_title, run_id) for game_id, game_url, game_title in games])
+
+    if not metric_columns:
+        return 0
+
+    category_ids = db.get_category_ids(metric_columns)
+    cursor.execute(f"SELECT game_id, {', '.join(metric_columns)} FROM {table_name}")
+    rows = [
+        (run_id, row[0], category_ids[column], value)
+        for row in cursor.fetchall()
+        for column, value in zip(metric_columns, row[1:])
+        if value is not None
+    ]
+    cursor.executemany(
+        "INSERT OR IGNORE INTO game_metrics (run_id, game_id, category_id, value) VALUES (?, ?, ?, ?)", rows
+    )
+    return cursor.rowcount
+
+def migrate(db_name='funpay.db', drop=False):
+    """Import every legacy games_* table, one transaction per table so an interrupted run can be resumed"""
+    db = DatabaseManager(db_name, start_run=False)
+    tables = list_legacy_tables(db.cursor)
+    print(f"Found {len(tables)} legacy games_* tables.")
+
+    for table_name in tables:
+        try:
+            imported = migrate_table(db, table_name)
+            if drop:
+                db.cursor.execute(f"DROP TABLE {table_name}")
+            db.conn.commit()
+        except sqlite3.Error as e:
+            db.conn.rollback()
+            db._category_ids = {}
+            print(f"Failed to migrate {table_name}: {e}")
+            continue
+        print(f"Migrated {table_name}: {imported} metric rows.")
+
+    if drop:
+        db.cursor.execute("VACUUM")
+    db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Import per-run games_* tables into the game_metrics store.")
+    parser.add_argument("--db", default="funpay.db", help="SQLite database to migrate")
+    parser.add_argument("--drop", action="store_true", help="drop each legacy table once it has been imported")
+    args = parser.parse_args()
+    migrate(args.db, args.drop)
@@ -0,0 +1,233 @@
+"""
+Offers with a stable identity and a change history.
+
+Each offer is identified by (user_id, offer_key), where offer_key is the lot
+id from its link (".../lots/offer?id=<id>"). A content hash over description,
+price, stock and server tells whether it changed. Visiting a profile writes
+only the offers that were inserted, updated or removed, and every change is
+appended to offer_changes.
+
+Offers that are still listed have removed_at NULL. They were last seen at
+the owner's users.updated_at. last_seen is only written when an offer changes
+or disappears, so unchanged offers cost no writes.
+
+Next to the raw price and in_stock texts, every write stores them parsed:
+amount, currency (ISO code) and integer stock. With idx_offers_category_amount,
+price ranges and the cheapest offers of a category are index range scans.
+Rows written before these columns existed are filled in by backfill_prices.py.
+"""
+import hashlib
+from urllib.parse import parse_qs, urlparse
+
+from prices import normalize
+
+OFFER_COLUMNS = {
+    "offer_key": "TEXT",
+    "content_hash": "TEXT",
+    "first_seen": "DATETIME",
+    "last_seen": "DATETIME",
+    "removed_at": "DATETIME",
+}
+# Parsed from price / in_stock at ingest
+NUMERIC_COLUMNS = {
+    "amount": "REAL",
+    "currency": "TEXT",
+    "stock": "INTEGER",
+}
+
+def offer_key(link, fallback=None):
+    """Stable identity of an offer: the lot id of its link, else the link, else `fallback`"""
+    if not link:
+        return fallback
+    ids = parse_qs(urlparse(link).query).get("id")
+    return ids[0] if ids else link
+
+def content_hash(description, price, in_stock, server_or_platform):
+    payload = "\x1f".join("" if value is None else str(value) for value in (description, price, in_stock, server_or_platform))
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()[:16]
+
+def setup_offer_tables(cursor):
+    """Create offers / offer_changes, upgrading an offers table from the delete-and-reinsert layout"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS offers (
+            offer_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            category TEXT,
+            description TEXT,
+            price TEXT,
+            server_or_platform TEXT,
+            in_stock TEXT,
+            link TEXT,
+            offer_key TEXT,
+            content_hash TEXT,
+            first_seen DATETIME,
+            last_seen DATETIME,
+            removed_at DATETIME,
+            amount REAL,
+            currency TEXT,
+            stock INTEGER,
+            merged_at DATETIME,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''')
+
+    cursor.execute("PRAGMA table_info(offers)")
+    existing = {row[1] for row in cursor.fetchall()}
+    missing = [name for name in OFFER_COLUMNS if name not in existing]
+    for name in missing:
+        cursor.execute(f"ALTER TABLE offers ADD COLUMN {name} {OFFER_COLUMNS[name]}")
+    if missing:
+        # Give legacy rows their identity and drop the duplicates re-inserted over time
+        cursor.connection.create_function("offer_key", 1, offer_key, deterministic=True)
+        cursor.execute("UPDATE offers SET offer_key = offer_key(link) WHERE offer_key IS NULL")
+        cursor.execute('''
+            DELETE FROM offers WHERE offer_key IS NOT NULL AND offer_id NOT IN (
+                SELECT MAX(offer_id) FROM offers WHERE offer_key IS NOT NULL GROUP BY user_id, offer_key
+            )
+        ''')
+
+    cursor.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_offers_identity ON offers (user_id, offer_key)")
+    for name in NUMERIC_COLUMNS:
+        if name not in existing:
+            cursor.execute(f"ALTER TABLE offers ADD COLUMN {name} {NUMERIC_COLUMNS[name]}")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_category_amount ON offers (category, amount)")
+    # Inserts and updates set last_seen, removals removed_at: "changed since" is two range scans
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_last_seen ON offers (last_seen)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_removed_at ON offers (removed_at)")
+    # Set by crawl_coordinator.merge_shards, which keeps the shard's last_seen / removed_at
+    if "merged_at" not in existing:
+        cursor.execute("ALTER TABLE offers ADD COLUMN merged_at DATETIME")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_offers_merged_at ON offers (merged_at)")
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS offer_changes (
+            change_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            offer_key TEXT NOT NULL,
+            change TEXT NOT NULL,
+            content_hash TEXT,
+            price TEXT,
+            in_stock TEXT,
+            changed_at DATETIME NOT NULL
+        )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_offer_changes_offer ON offer_changes (user_id, offer_key, changed_at)")
+
+UPSERT_OFFER = '''
+    INSERT INTO offers (user_id, category, description, price, server_or_platform, in_stock, link,
+                        offer_key, content_hash, amount, currency, stock, first_seen, last_seen, removed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, NULL)
+    ON CONFLICT(user_id, offer_key) DO UPDATE SET
+        category = COALESCE(excluded.category, offers.category),
+        description = excluded.description,
+        price = excluded.price,
+        server_or_platform = excluded.server_or_platform,
+        in_stock = excluded.in_stock,
+        link = excluded.link,
+        content_hash = excluded.content_hash,
+        amount = excluded.amount,
+        currency = excluded.currency,
+        stock = excluded.stock,
+        first_seen = COALESCE(offers.first_seen, excluded.first_seen),
+        last_seen = excluded.last_seen,
+        removed_at = NULL
+    WHERE offers.content_hash IS NOT excluded.content_hash OR offers.removed_at IS NOT NULL
+'''
+
+REMOVE_OFFER = '''
+    UPDATE offers SET removed_at = ?, last_seen = COALESCE(?, last_seen)
+    WHERE user_id = ? AND offer_key = ?
+'''
+
+RECORD_CHANGE = '''
+    INSERT INTO offer_changes (user_id, offer_key, change, content_hash, price, in_stock, changed_at)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+'''
+
+def keyed_offers(offers):
+    """{offer_key: (category, description, price, server_or_platform, in_stock, link, hash)} for a page"""
+    keyed = {}
+    for category, description, price, server_or_platform, in_stock, link in offers:
+        key = offer_key(link, fallback="h:" + content_hash(category, description, None, server_or_platform))
+        keyed[key] = (category, description, price, server_or_platform, in_stock, link,
+                      content_hash(description, price, in_stock, server_or_platform))
+    return keyed
+
+def sync_user_offers(db, user_id, offers, now):
+    """
+    Bring a user's stored offers in line with the offers just scraped from their
+    profile, queueing only the changes on the batch writer. Must run before the
+    user's own row is updated, since the previous users.updated_at is the
+    last-seen time of removed offers. Returns {"insert", "update", "remove"} counts.
+    """
+    db.cursor.execute('''
+        SELECT offers.offer_key, offers.content_hash, users.updated_at
+        FROM offers LEFT JOIN users ON users.user_id = offers.user_id
+        WHERE offers.user_id = ? AND offers.removed_at IS NULL
+    ''', (user_id,))
+    rows = db.cursor.fetchall()
+    stored = {key: stored_hash for key, stored_hash, _ in rows if key is not None}
+    listed = set(stored)
+    previous_visit = rows[0][2] if rows else None
+    if len(stored) < len(rows):
+        # Rows without any identity from the old layout cannot be diffed; replace them
+        db.batch.add("DELETE FROM offers WHERE user_id = ? AND offer_key IS NULL", (user_id,))
+
+    counts = {"insert": 0, "update": 0, "remove": 0}
+    upserts, changes = [], []
+    for key, (category, description, price, server, in_stock, link, new_hash) in keyed_offers(offers).items():
+        if key in stored and stored.pop(key) == new_hash:
+            continue
+        change = "update" if key in listed else "insert"
+        counts[change] += 1
+        upserts.append((user_id, category, description, price, server, in_stock, link, key, new_hash,
+                        *normalize(price, in_stock), now, now))
+        changes.append((user_id, key, change, new_hash, price, in_stock, now))
+
+    # Whatever is left in `stored` was listed last time but not any more
+    removals = [(now, previous_visit, user_id, key) for key in stored]
+    changes.extend((user_id, key, "remove", None, None, None, now) for key in stored)
+    counts["remove"] = len(removals)
+
+    db.batch.add_many(UPSERT_OFFER, upserts)
+    db.batch.add_many(REMOVE_OFFER, removals)
+    db.batch.add_many(RECORD_CHANGE, changes)
+    return counts
+
+def sync_listed_offers(db, offers, now):
+    """
+    Upsert offers seen on a page that lists only some of each seller's offers
+    (a lot list), as (user_id, category, description, price, server_or_platform,
+    in_stock, link) rows. Like sync_user_offers, only inserts and updates are
+    queued and recorded in offer_changes; nothing is marked removed.
+    Returns {"insert", "update"} counts.
+    """
+    keyed = {}
+    for user_id, category, description, price, server, in_stock, link in offers:
+        keyed[(user_id, offer_key(link))] = (category, description, price, server, in_stock, link,
+                                             content_hash(description, price, in_stock, server))
+    # Buffered rows of an earlier page may hold the same offers; write them so the diff sees them
+    db.flush()
+    stored = {}
+    user_ids = sorted({user_id for user_id, _ in keyed})
+    for start in range(0, len(user_ids), 500):
+        chunk = user_ids[start:start + 500]
+        db.cursor.execute(f'''
+            SELECT user_id, offer_key, content_hash FROM offers
+            WHERE user_id IN ({", ".join("?" * len(chunk))}) AND offer_key IS NOT NULL AND removed_at IS NULL
+        ''', chunk)
+        stored.update(((user_id, key), stored_hash) for user_id, key, stored_hash in db.cursor.fetchall())
+
+    counts = {"insert": 0, "update": 0}
+    upserts, changes = [], []
+    for (user_id, key), (category, description, price, server, in_stock, link, new_hash) in keyed.items():
+        if key is not None and stored.get((user_id, key)) == new_hash:
+            continue
+        change = "update" if (user_id, key) in stored else "insert"
+        counts[change] += 1
+        upserts.append((user_id, category, description, price, server, in_stock, link, key, new_hash,
+                        *normalize(price, in_stock), now, now))
+        changes.append((user_id, key, change, new_hash, price, in_stock, now))
+
+    db.batch.add_many(UPSERT_OFFER, upserts)
+    db.batch.add_many(RECORD_CHANGE, changes)
+    return counts
@@ -0,0 +1,151 @@
+"""
+Compressed, content-addressed archive of every fetched page.
+
+Each distinct page body is stored once in `pages`, keyed by the SHA-256 of
+its HTML and compressed with zstd when the zstandard package is installed,
+or with gzip otherwise. Every fetch adds a small row to `fetches`: the URL,
+the fetch time, the hash of the body seen and the parser run it was made
+for (`run`, set by the scraper; NULL outside runs). A 304 answer records
+the body last stored for that URL. Each row keeps its own codec, so an archive may
+mix both formats.
+
+HttpClient writes to the archive named by the FUNPAY_ARCHIVE env var
+(page_archive.db by default, empty to disable). reparse.py rebuilds the
+database from it offline.
+"""
+import datetime
+import gzip
+import hashlib
+import sqlite3
+import threading
+
+import storage
+
+try:
+    import zstandard
+    CODEC = "zstd"
+except ImportError:
+    zstandard = None
+    CODEC = "gzip"
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def compress(data, codec=CODEC):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return gzip.compress(data, compresslevel=6, mtime=0)
+
+def decompress(data, codec):
+    if codec == "zstd":
+        if zstandard is None:
+            raise RuntimeError("This archive holds zstd pages; install zstandard to read them")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return gzip.decompress(data)
+
+class PageArchive:
+    """Append-only page store; safe to share between threads and between processes on one file"""
+
+    def __init__(self, db_name='page_archive.db', readonly=False):
+        self.db_name = db_name
+        self.conn = storage.connect(db_name, readonly=readonly, check_same_thread=False)
+        if not readonly:
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS pages (
+                    content_hash TEXT PRIMARY KEY,
+                    codec TEXT NOT NULL,
+                    raw_size INTEGER NOT NULL,
+                    body BLOB NOT NULL
+                ) WITHOUT ROWID
+            ''')
+            self.conn.execute('''
+                CREATE TABLE IF NOT EXISTS fetches (
+                    fetch_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    fetched_at TEXT NOT NULL,
+                    content_hash TEXT NOT NULL,
+                    run TEXT
+                )
+            ''')
+            if "run" not in {row[1] for row in self.conn.execute("PRAGMA table_info(fetches)")}:
+                self.conn.execute("ALTER TABLE fetches ADD COLUMN run TEXT")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_fetches_url ON fetches (url, fetched_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS idx_fetches_time ON fetches (fetched_at)")
+            self.conn.commit()
+        self.lock = threading.Lock()
+        # parser_runs timestamp recorded with the fetches archived from now on
+        self.run = None
+
+    @staticmethod
+    def _now():
+        return datetime.datetime.now().strftime(TIME_FORMAT)
+
+    def store(self, url, html, fetched_at=None):
+        """Archive one fetched page body; returns its content hash"""
+        data = html.encode("utf-8")
+        content_hash = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            known = self.conn.execute("SELECT 1 FROM pages WHERE content_hash = ?", (content_hash,)).fetchone()
+        # Only new bodies are compressed, and not while holding the lock
+        body = None if known else compress(data)
+        with self.lock:
+            if body is not None:
+                self.conn.execute(
+                    "INSERT OR IGNORE INTO pages (content_hash, codec, raw_size, body) VALUES (?, ?, ?, ?)",
+                    (content_hash, CODEC, len(data), body)
+                )
+            self.conn.execute(
+                "INSERT INTO fetches (url, fetched_at, content_hash, run) VALUES (?, ?, ?, ?)",
+                (url, fetched_at or self._now(), content_hash, self.run)
+            )
+            self.conn.commit()
+        return content_hash
+
+    def touch(self, url, fetched_at=None):
+        """Record a fetch whose body did not change (HTTP 304); a no-op for URLs never archived"""
+        with self.lock:
+            self.conn.execute('''
+                INSERT INTO fetches (url, fetched_at, content_hash, run)
+                SELECT url, ?, content_hash, ? FROM fetches WHERE url = ? ORDER BY fetched_at DESC, fetch_id DESC LIMIT 1
+            ''', (fetched_at or self._now(), self.run, url))
+            self.conn.commit()
+
+    def load(self, content_hash):
+        """The HTML stored under `content_hash`"""
+        with self.lock:
+            codec, body = self.conn.execute(
+                "SELECT codec, body FROM pages WHERE content_hash = ?", (content_hash,)
+            ).fetchone()
+        return decompress(body, codec).decode("utf-8")
+
+    def latest(self, url):
+        """The most recently archived HTML of `url`, or None"""
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT content_hash FROM fetches WHERE url = ? ORDER BY fetched_at DESC, fetch_id DESC LIMIT 1", (url,)
+            ).fetchone()
+        return self.load(row[0]) if row else None
+
+    def fetches(self, since=None, until=None):
+        """[(fetch_id, url, fetched_at, content_hash, run)] in fetch order, optionally within [since, until)"""
+        sql = '''
+            SELECT fetch_id, url, fetched_at, content_hash, {run} FROM fetches
+            WHERE fetched_at >= ? AND fetched_at < ? ORDER BY fetched_at, fetch_id
+        '''
+        with self.lock:
+            try:
+                return self.conn.execute(sql.format(run="run"), (since or "", until or "9999")).fetchall()
+            except sqlite3.OperationalError:
+                # Archive written before fetches.run, opened read-only
+                return self.conn.execute(sql.format(run="NULL"), (since or "", until or "9999")).fetchall()
+
+    def stats(self):
+        """Counts and sizes: fetches, distinct pages, raw bytes and stored (compressed) bytes"""
+        with self.lock:
+            fetches = self.conn.execute("SELECT COUNT(*) FROM fetches").fetchone()[0]
+            pages, raw, stored = self.conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(raw_size), 0), COALESCE(SUM(LENGTH(body)), 0) FROM pages"
+            ).fetchone()
+        return {"fetches": fetches, "pages": pages, "raw_bytes": raw, "stored_bytes": stored}
+
+    def close(self):
+        self.conn.close()
@@ -1,6 +1,5 @@
+import argparse
 import requests
-from bs4 import BeautifulSoup
-import random
 import time
 from tqdm import tqdm
 import sqlite3
@@ -9,21 +8,31 @@ import logging
 import re
 
 # Import the provided DatabaseManager class
+import metrics
+import profiling
 from db_manager import DatabaseManager
+from http_client import get_client, FUNPAY_URL
+from extractors import extract
+from crawl_frontier import PermutationFrontier
+from offers_store import setup_offer_tables, sync_user_offers
+from recrawl_scheduler import RecrawlScheduler, PARSED, NOT_FOUND, FAILED
 
 # Constants
 MAX_USER_ID = 14112521
-BASE_URL = "https://funpay.com/en/users/"
+BASE_URL = f"{FUNPAY_URL}/en/users/"
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 }
-ONE_WEEK = datetime.timedelta(days=7)
+# Due recrawls, and then never-visited IDs, taken per crawl batch
+RECRAWL_BATCH = 50
+
+USERS = metrics.REGISTRY.counter("funpay_users_total", "User profiles visited, by outcome", ("outcome",))
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 def setup_database(db):
-    """Set up the users and offers tables with DATETIME columns."""
+    """Set up the users table and the offers / offer_changes tables with DATETIME columns."""
     db.cursor.execute('''
         CREATE TABLE IF NOT EXISTS users (
             user_id INTEGER PRIMARY KEY,
@@ -33,23 +42,19 @@ def setup_database(db):
             seller_rating REAL,
             total_reviews INTEGER,
             created_at DATETIME NOT NULL,
-            updated_at DATETIME NOT NULL
+            updated_at DATETIME NOT NULL,
+            merged_at DATETIME
         )
     ''')
+    # Set by crawl_coordinator.merge_shards, which keeps the shard's updated_at
+    db.cursor.execute("PRAGMA table_info(users)")
+    if "merged_at" not in {row[1] for row in db.cursor.fetchall()}:
+        db.cursor.execute("ALTER TABLE users ADD COLUMN merged_at DATETIME")
+    # Incremental readers (marketplace_analysis) look up the profiles visited or merged since their last pass
+    db.cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users (updated_at)")
+    db.cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_merged_at ON users (merged_at)")
     
-    db.cursor.execute('''
-        CREATE TABLE IF NOT EXISTS offers (
-            offer_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            category TEXT,
-            description TEXT,
-            price TEXT,
-            server_or_platform TEXT,
-            in_stock TEXT,
-            link TEXT,
-            FOREIGN KEY (user_id) REFERENCES users (user_id)
-        )
-    ''')
+    setup_offer_tables(db.cursor)
     db.conn.commit()
 
 def parse_date_to_datetime(date_str):
@@ -77,156 +82,190 @@ def is_valid_float(value):
     except ValueError:
         return False
 
-def parse_user_page(user_id, db):
-    """Parse a FunPay user profile and save to database."""
+def extract_user_profile(html):
+    """Extract profile fields and offers from a user page; returns None if the user does not exist."""
+    record = extract("user_page", html)
+
+    # Check if user exists
+    if "User not found" in html or record["h1"] is None:
+        return None
+
+    profile = {"warnings": []}
+
+    # Extract username
+    username = record["username"]
+    if not username:
+        username = record["h1"].split()[0] if record["h1"] else None
+        profile["warnings"].append(f"Username fallback used - {username}")
+    profile["username"] = username
+
+    # Extract status
+    status = record["status"]
+    profile["online"] = bool(status and "Online" in status)
+    if status is None:
+        profile["warnings"].append("Status not found")
+
+    # Extract registration date
+    reg_date_str = record["param_item"]["registration"] if record["param_item"] else None
+    profile["registration_date"] = reg_date_str
+    if not reg_date_str:
+        profile["warnings"].append("Registration date not found")
+
+    # Extract seller rating
+    seller_rating_str = record["rating"]["value"] if record["rating"] else None
+    profile["seller_rating"] = float(seller_rating_str) if seller_rating_str and is_valid_float(seller_rating_str) else None
+    if not seller_rating_str:
+        profile["warnings"].append("Seller rating not found")
+
+    # Extract total reviews
+    reviews = record["reviews"]
+    total_reviews_str = reviews.split()[0] if reviews else None
+    profile["total_reviews"] = int(total_reviews_str) if total_reviews_str and total_reviews_str.isdigit() else None
+    if not total_reviews_str:
+        profile["warnings"].append("Total reviews not found")
+
+    # Extract offers
+    offers = []
+    for section in record["sections"]:
+        category = section["category"] or "Unknown category"
+
+        for item in section["items"]:
+            description = item["description"] or "No description"
+            price = item["price_value"] or "No price"
+            offers.append([category, description, price, item["server"], item["amount"], item["link"]])
+    profile["offers"] = offers
+
+    return profile
+
+def parse_user_page(user_id, db, client=None, scheduler=None):
+    """
+    Parse a FunPay user profile and save to database.
+    When a RecrawlScheduler is given, the outcome re-queues the user for its next visit.
+    """
     url = f"{BASE_URL}{user_id}/"
+    client = client or get_client()
     current_time = datetime.datetime.now()
-    current_time_str = current_time.strftime("%Y-%m-%d %H:%M:%S")
-    
-    # Check if user was updated recently
-    db.cursor.execute("SELECT updated_at FROM users WHERE user_id = ?", (user_id,))
-    result = db.cursor.fetchone()
-    if result:
-        last_updated = datetime.datetime.strptime(result[0], "%Y-%m-%d %H:%M:%S")
-        if (current_time - last_updated) < ONE_WEEK:
-            logging.info(f"User {user_id}: Skipped (updated within last week)")
-            return False
+
+    def record(outcome, profile=None):
+        USERS.inc(outcome=outcome)
+        if scheduler is not None:
+            scheduler.record(user_id, outcome, profile, now=current_time)
     
     try:
-        response = requests.get(url, headers=HEADERS, timeout=10)
-        if response.status_code != 200:
-            logging.error(f"User {user_id}: Failed with status code {response.status_code}")
-            return False
-        
-        soup = BeautifulSoup(response.text, "html.parser")
-        
-        # Check if user exists
-        if "User not found" in response.text or soup.find("h1") is None:
-            logging.info(f"User {user_id}: Not found")
-            return False
-        
-        # Extract username
-        h1_tag = soup.find("h1", class_="mb40")
-        username = h1_tag.find("span", class_="mr4").get_text(strip=True) if h1_tag and h1_tag.find("span", class_="mr4") else None
-        if not username:
-            username_tag = soup.find("h1")
-            username = username_tag.get_text(strip=True).split()[0] if username_tag else f"User_{user_id}"
-            logging.warning(f"User {user_id}: Username fallback used - {username}")
-        
-        # Extract status
-        status = soup.find("span", class_="media-user-status")
-        status_timestamp = current_time_str if status and "Online" in status.get_text(strip=True) else None
-        if not status:
-            logging.warning(f"User {user_id}: Status not found")
-        
-        # Extract registration date
-        reg_date = soup.find("div", class_="param-item")
-        reg_date_str = reg_date.find("div", class_="text-nowrap").get_text(strip=True) if reg_date and reg_date.find("div", class_="text-nowrap") else None
-        registration_timestamp = parse_date_to_datetime(reg_date_str) if reg_date_str else None
-        if not reg_date_str:
-            logging.warning(f"User {user_id}: Registration date not found")
-        
-        # Extract seller rating
-        rating = soup.find("div", class_="rating-value")
-        seller_rating_str = rating.find("span", class_="big").get_text(strip=True) if rating and rating.find("span", class_="big") else None
-        seller_rating = float(seller_rating_str) if seller_rating_str and is_valid_float(seller_rating_str) else None
-        if not seller_rating_str:
-            rating_div = soup.find("div", class_="rating-value")
-            logging.warning(f"User {user_id}: Seller rating not found. Rating div: {rating_div}")
-        
-        # Extract total reviews
-        reviews = soup.find("div", class_="rating-full-count")
-        total_reviews_str = reviews.get_text(strip=True).split()[0] if reviews else None
-        total_reviews = int(total_reviews_str) if total_reviews_str and total_reviews_str.isdigit() else None
-        if not total_reviews_str:
-            reviews_div = soup.find("div", class_="rating-full-count")
-            logging.warning(f"User {user_id}: Total reviews not found. Reviews div: {reviews_div}")
-        
-        # Insert or update user in database
-        db.cursor.execute('''
-            INSERT INTO users (user_id, username, status_timestamp, registration_timestamp, seller_rating, total_reviews, created_at, updated_at)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET
-                username = excluded.username,
-                status_timestamp = excluded.status_timestamp,
-                registration_timestamp = excluded.registration_timestamp,
-                seller_rating = excluded.seller_rating,
-                total_reviews = excluded.total_reviews,
-                updated_at = excluded.updated_at
-        ''', (user_id, username, status_timestamp, registration_timestamp, seller_rating, total_reviews, current_time_str, current_time_str))
-        
-        # Delete existing offers for this user
-        db.cursor.execute("DELETE FROM offers WHERE user_id = ?", (user_id,))
-        
-        # Extract and insert offers
-        offer_sections = soup.find_all("div", class_="offer")
-        for section in offer_sections:
-            category_tag = section.find("div", class_="offer-list-title")
-            category = category_tag.find("h3").get_text(strip=True) if category_tag and category_tag.find("h3") else "Unknown category"
-            
-            offer_items = section.find_all("a", class_="tc-item")
-            for item in offer_items:
-                desc = item.find("div", class_="tc-desc-text")
-                description = desc.get_text(strip=True) if desc else "No description"
-                
-                price_div = item.find("div", class_="tc-price")
-                price = price_div.find("div").get_text(strip=True) if price_div and price_div.find("div") else "No price"
-                
-                server = item.find("div", class_="tc-server")
-                server_or_platform = server.get_text(strip=True) if server else None
-                
-                amount = item.find("div", class_="tc-amount")
-                in_stock = amount.get_text(strip=True) if amount else None
-                
-                link = item["href"] if "href" in item.attrs else None
-                
-                db.cursor.execute('''
-                    INSERT INTO offers (user_id, category, description, price, server_or_platform, in_stock, link)
-                    VALUES (?, ?, ?, ?, ?, ?, ?)
-                ''', (user_id, category, description, price, server_or_platform, in_stock, link))
-        
-        db.conn.commit()
-        logging.info(f"User {user_id}: Successfully parsed - {username}")
-        return True
-    
+        # A 304 returns the previously extracted profile without re-parsing
+        with profiling.stage("user_fetch"):
+            profile = client.get_parsed(url, extract_user_profile, headers=HEADERS, timeout=10)
+    except requests.HTTPError as e:
+        logging.error(f"User {user_id}: Failed with status code {e.response.status_code}")
+        record(NOT_FOUND if e.response.status_code == 404 else FAILED)
+        return False
     except requests.RequestException as e:
         logging.error(f"User {user_id}: Request failed - {e}")
+        record(FAILED)
         return False
 
+    if profile is None:
+        logging.info(f"User {user_id}: Not found")
+        record(NOT_FOUND)
+        return False
+
+    for warning in profile["warnings"]:
+        logging.warning(f"User {user_id}: {warning}")
+
+    with profiling.stage("user_save"):
+        changes = save_user_profile(db, user_id, profile, current_time)
+
+    record(PARSED, profile)
+    logging.info(f"User {user_id}: Successfully parsed - {profile['username'] or f'User_{user_id}'} "
+                 f"(offers +{changes['insert']} ~{changes['update']} -{changes['remove']})")
+    return True
+
+def save_user_profile(db, user_id, profile, current_time):
+    """Queue the writes for a profile seen at `current_time`; returns the offer change counts."""
+    current_time_str = current_time.strftime("%Y-%m-%d %H:%M:%S")
+    username = profile["username"] or f"User_{user_id}"
+    status_timestamp = current_time_str if profile["online"] else None
+    registration_timestamp = parse_date_to_datetime(profile["registration_date"]) if profile["registration_date"] else None
+
+    # Write only the offers that changed since the last visit (reads the previous updated_at)
+    changes = sync_user_offers(db, user_id, profile["offers"], current_time_str)
+
+    # Insert or update user in database (buffered; committed by the batch writer)
+    db.batch.add('''
+        INSERT INTO users (user_id, username, status_timestamp, registration_timestamp, seller_rating, total_reviews, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT(user_id) DO UPDATE SET
+            username = excluded.username,
+            status_timestamp = excluded.status_timestamp,
+            registration_timestamp = excluded.registration_timestamp,
+            seller_rating = excluded.seller_rating,
+            total_reviews = excluded.total_reviews,
+            updated_at = excluded.updated_at
+    ''', (user_id, username, status_timestamp, registration_timestamp, profile["seller_rating"], profile["total_reviews"], current_time_str, current_time_str))
+    return changes
+
 def main():
     # Initialize database
+    summary = metrics.RunSummary()
     db = DatabaseManager("funpay.db")
     setup_database(db)
     
-    total_users = MAX_USER_ID
-    print(f"Starting to parse {total_users} users randomly without repeats...")
-    
-    # Load visited IDs from database
-    db.cursor.execute("SELECT user_id FROM users")
-    visited_ids = {row[0] for row in db.cursor.fetchall()}
+    # Every ID is visited exactly once in a seeded pseudo-random order; the cursor
+    # is committed together with the users it covers, so a restart resumes exactly
+    frontier = PermutationFrontier(db, MAX_USER_ID)
+    # Known IDs are revisited in staleness order: busy sellers hourly, dead IDs rarely
+    scheduler = RecrawlScheduler(db)
+    total_users = frontier.max_id
+    print(f"Starting to parse {total_users} users randomly without repeats ({frontier.remaining} remaining)...")
     
-    # Use tqdm for progress tracking
-    with tqdm(total=total_users, desc="Parsing Users") as pbar:
-        pbar.update(len(visited_ids))  # Set initial progress
-        
-        while len(visited_ids) < total_users:
-            user_id = random.randint(1, MAX_USER_ID)
-            
-            if user_id in visited_ids:
-                if not parse_user_page(user_id, db):
-                    continue
-            else:
-                if parse_user_page(user_id, db):
-                    visited_ids.add(user_id)
+    # Use tqdm for progress tracking; buffered writes are flushed even on interrupt
+    try:
+        with tqdm(total=total_users, initial=frontier.cursor, desc="Parsing Users") as pbar:
+            while True:
+                due = scheduler.due(RECRAWL_BATCH)
+                for user_id in due:
+                    # Pacing and 429 back-off are handled by the client's rate limiter
+                    parse_user_page(user_id, db, scheduler=scheduler)
+                
+                # Fill the rest of the batch with never-visited IDs
+                discovered = 0
+                for user_id in frontier:
+                    parse_user_page(user_id, db, scheduler=scheduler)
+                    frontier.save()
                     pbar.update(1)
-            
-            # Random delay to avoid rate limiting (1-5 seconds)
-            time.sleep(random.uniform(1, 5))
-    
-    print(f"Completed parsing all {total_users} users.")
-    db.close()
+                    discovered += 1
+                    if discovered >= RECRAWL_BATCH:
+                        break
+                metrics.export()
+                
+                if not due and not discovered:
+                    # Frontier exhausted and nothing due: sleep until the next recrawl
+                    next_due = scheduler.next_due_at()
+                    if next_due is None:
+                        break
+                    time.sleep(max(1, (next_due - datetime.datetime.now()).total_seconds()))
+        
+        print(f"Completed parsing all {total_users} users.")
+        print(get_client().summary())
+    finally:
+        # The whole crawl is one parser run; its summary is stored however it ends
+        db.save_run_metrics(summary.values())
+        metrics.export()
+        if profiling.PROFILER.enabled:
+            db.flush()
+            profiling.PROFILER.save(db.conn, db.run_id, "parse_funpay_users")
+            print(profiling.PROFILER.report())
+        db.close()
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Crawl FunPay user profiles and their offers into funpay.db.")
+    parser.add_argument("--profile", action="store_true", help="time each stage and store the timings in run_profile")
+    parser.add_argument("--profile-dir", help="also write per-stage cProfile stats to this directory")
+    args = parser.parse_args()
+    if args.profile or args.profile_dir:
+        profiling.enable(args.profile_dir)
+
+    metrics.start_from_env()
     try:
         main()
     except KeyboardInterrupt:
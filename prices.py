@@ -0,0 +1,38 @@
+import re
+
+# Currency signs FunPay shows next to prices, as ISO 4217 codes
+CURRENCY_SIGNS = {"€": "EUR", "$": "USD", "₽": "RUB", "₴": "UAH", "₸": "KZT"}
+
+PRICE_PATTERN = re.compile(r"(\d[\d\s  ,]*(?:\.\d+)?)\s*([^\d\s]+)?")
+STOCK_PATTERN = re.compile(r"\d[\d\s  ,]*")
+
+def parse_price(text):
+    """
+    Split a price such as "1 234.50 €" into (1234.5, "EUR").
+    Returns (None, None) when there is no number; unknown currency signs are kept as-is.
+    """
+    match = PRICE_PATTERN.search(text or "")
+    if match is None:
+        return None, None
+    number = re.sub(r"[\s  ]", "", match.group(1))
+    if "," in number:
+        # "1,234.50" has thousands commas, "12,50" a decimal comma
+        number = number.replace(",", "") if "." in number else number.replace(",", ".")
+    try:
+        amount = float(number)
+    except ValueError:
+        return None, None
+    sign = match.group(2)
+    return amount, CURRENCY_SIGNS.get(sign, sign)
+
+def parse_stock(text):
+    """Items in stock from text such as "1 000 pcs" or "5"; None when no number is shown"""
+    match = STOCK_PATTERN.search(text or "")
+    if match is None:
+        return None
+    return int(re.sub(r"[\s  ,]", "", match.group(0)))
+
+def normalize(price, in_stock):
+    """(amount, currency, stock) of an offer's price and stock texts, as stored next to them"""
+    amount, currency = parse_price(price)
+    return amount, currency, parse_stock(in_stock)
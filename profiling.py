@@ -0,0 +1,105 @@
+"""
+Per-stage wall and CPU timers for --profile runs.
+
+Code marks its stages with `with profiling.stage("update_game"):`; that costs
+nothing until enable() is called by an entry point's --profile flag. Wall time
+is perf_counter and CPU time is the calling thread's thread_time, so stages
+running side by side on worker threads are not charged for each other.
+
+With a profile directory, every stage entered while no other stage is being
+profiled also runs under cProfile (cProfile follows one thread only), and
+its stats are dumped to <dir>/<program>_<run_id>_<stage>.prof for snakeviz /
+pstats. save() stores the totals in run_profile against the parser_runs row.
+"""
+import cProfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.profile_dir = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self, profile_dir=None):
+        self.enabled = True
+        if profile_dir:
+            self.profile_dir = Path(profile_dir)
+            self.profile_dir.mkdir(parents=True, exist_ok=True)
+
+    def reset(self):
+        """Forget the timings and captured profiles (e.g. after they were saved for a run)"""
+        with self.lock:
+            self.timings = {}  # stage -> [calls, wall_s, cpu_s]
+            self.profiles = {}  # stage -> cProfile.Profile
+            self.profiling = False
+
+    @contextmanager
+    def stage(self, name):
+        if not self.enabled:
+            yield
+            return
+        profile = None
+        if self.profile_dir is not None:
+            with self.lock:
+                if not self.profiling:
+                    self.profiling = True
+                    profile = self.profiles.setdefault(name, cProfile.Profile())
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if profile is not None:
+            profile.enable()
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            with self.lock:
+                if profile is not None:
+                    self.profiling = False
+                totals = self.timings.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += 1
+                totals[1] += wall
+                totals[2] += cpu
+
+    def report(self):
+        """Text table of the stages, slowest first"""
+        lines = [f"{'stage':<20} {'calls':>7} {'wall s':>10} {'cpu s':>10}"]
+        for name, (calls, wall, cpu) in sorted(self.timings.items(), key=lambda item: -item[1][1]):
+            lines.append(f"{name:<20} {calls:>7} {wall:>10.3f} {cpu:>10.3f}")
+        return "\n".join(lines)
+
+    def save(self, conn, run_id, program):
+        """Store the timings in run_profile for `run_id` and dump the captured cProfile stats"""
+        if not self.enabled or run_id is None:
+            return
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS run_profile (
+                run_id INTEGER NOT NULL,
+                program TEXT NOT NULL,
+                stage TEXT NOT NULL,
+                calls INTEGER NOT NULL,
+                wall_s REAL NOT NULL,
+                cpu_s REAL NOT NULL,
+                PRIMARY KEY (run_id, program, stage)
+            ) WITHOUT ROWID
+        ''')
+        conn.executemany(
+            "INSERT OR REPLACE INTO run_profile (run_id, program, stage, calls, wall_s, cpu_s) VALUES (?, ?, ?, ?, ?, ?)",
+            [(run_id, program, name, calls, wall, cpu) for name, (calls, wall, cpu) in self.timings.items()]
+        )
+        conn.commit()
+        for name, profile in self.profiles.items():
+            profile.dump_stats(str(self.profile_dir / f"{program}_{run_id}_{name}.prof"))
+
+PROFILER = Profiler()
+
+def stage(name):
+    """Time the enclosed block as stage `name` when profiling is enabled"""
+    return PROFILER.stage(name)
+
+def enable(profile_dir=None):
+    PROFILER.enable(profile_dir)
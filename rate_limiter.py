@@ -0,0 +1,147 @@
+"""
+Adaptive per-host rate limiting shared by every HttpClient request.
+
+Each host gets a token bucket whose rate follows AIMD: every successful
+response adds `increase` requests/s, and every 429 or 5xx multiplies the rate
+by `decrease`. When the response carries Retry-After, the whole host is also
+paused until then. Only responses to requests sent after the last cut can cut
+again, so a burst of concurrent 429s counts as one signal. The rate then
+settles just under what the server tolerates instead of staying at a fixed
+guess.
+"""
+import datetime
+import email.utils
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+# Starting and maximum requests per second per host; overridable from the environment
+INITIAL_RATE = float(os.environ.get("FUNPAY_RATE", "1.0"))
+MAX_RATE = float(os.environ.get("FUNPAY_MAX_RATE", "10.0"))
+
+# Status codes that mean "slow down"
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+
+def parse_retry_after(value, now=None):
+    """Seconds to wait from a Retry-After header (delta-seconds or HTTP-date), or None"""
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = now or datetime.datetime.now(datetime.timezone.utc)
+    return max(0.0, (when - now).total_seconds())
+
+class HostBucket:
+    """Token bucket of one host; its rate is adjusted by AdaptiveRateLimiter"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.last_cut = 0.0
+        self.stats = {"requests": 0, "throttled": 0}
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Seconds until a request may be sent; takes a token when that is 0"""
+        if now < self.paused_until:
+            return self.paused_until - now
+        self._refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+class AdaptiveRateLimiter:
+    """
+    Per-host AIMD token buckets.
+
+    acquire(url) blocks the calling thread until the host has a token and
+    returns the send time. Pass that time back to feedback() with the
+    response status and Retry-After header. rates() gives the live rate of
+    every host.
+    """
+
+    def __init__(self, initial_rate=INITIAL_RATE, min_rate=0.05, max_rate=MAX_RATE,
+                 increase=0.05, decrease=0.5, burst=2):
+        self.initial_rate = initial_rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    def _bucket(self, url):
+        host = urlsplit(url).netloc
+        bucket = self.buckets.get(host)
+        if bucket is None:
+            bucket = self.buckets[host] = HostBucket(min(self.initial_rate, self.max_rate), self.burst)
+        return bucket
+
+    def acquire(self, url):
+        """Wait until a request to `url`'s host is allowed; returns the monotonic send time"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                bucket = self._bucket(url)
+                wait = bucket.wait_time(now)
+                if wait == 0:
+                    bucket.stats["requests"] += 1
+                    return now
+            time.sleep(wait)
+
+    def feedback(self, url, sent_at, status, retry_after=None):
+        """
+        Adjust the host's rate after a response: additive increase on success,
+        multiplicative decrease (and a pause for Retry-After) on 429/5xx.
+        Returns True when the response was a throttle.
+        """
+        with self.lock:
+            bucket = self._bucket(url)
+            if status not in THROTTLE_STATUSES:
+                if status < 400:
+                    bucket.rate = min(self.max_rate, bucket.rate + self.increase)
+                return False
+
+            bucket.stats["throttled"] += 1
+            now = time.monotonic()
+            delay = parse_retry_after(retry_after)
+            if delay is not None:
+                bucket.paused_until = max(bucket.paused_until, now + delay)
+            if sent_at >= bucket.last_cut:
+                bucket.rate = max(self.min_rate, bucket.rate * self.decrease)
+                bucket.tokens = min(bucket.tokens, 0)
+                bucket.last_cut = now
+            return True
+
+    def rates(self):
+        """{host: current requests per second}"""
+        with self.lock:
+            return {host: round(bucket.rate, 3) for host, bucket in self.buckets.items()}
+
+    def snapshot(self):
+        """{host: {"rate", "requests", "throttled", "paused_for"}} for monitoring"""
+        with self.lock:
+            now = time.monotonic()
+            return {
+                host: {"rate": round(bucket.rate, 3), **bucket.stats,
+                       "paused_for": round(max(0.0, bucket.paused_until - now), 3)}
+                for host, bucket in self.buckets.items()
+            }
+
+    def summary(self):
+        return ", ".join(f"{host} {info['rate']} req/s ({info['throttled']}/{info['requests']} throttled)"
+                         for host, info in self.snapshot().items()) or "no requests"
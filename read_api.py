@@ -0,0 +1,334 @@
+"""
+Local read-only JSON API over the scraped dataset.
+
+    python read_api.py --db funpay.db --port 8780
+
+Endpoints (GET, JSON):
+    /games                                   every game and the run that last listed it
+    /games/<game_id>/metrics?category=&limit= counter history, oldest first
+    /games/<game_id>/lots                    lot lists recorded for the game
+    /games/<game_id>/orders?limit=           latest offers seen on the game page
+    /games/<game_id>/orders/summary?limit=   offer count and price range per run
+    /categories/<category>/sellers?limit=    sellers with the most listed offers in a category
+    /categories/<category>/offers?min_price=&max_price=&limit=  listed offers in a price range, cheapest first
+    /users/<user_id>                         a user profile
+    /users/<user_id>/offers                  the offers the user currently lists
+    /runs?limit=                             latest parser runs with their duration and throughput
+    /stats                                   cache counters
+
+Every endpoint is one index range scan, except /metrics, which is one per
+counter category (a few dozen) so that each series gets `limit` points.
+READ_INDEXES makes them covering, so the scans never touch the table rows.
+Each server thread reads through its own read-only connection, and WAL lets
+it read while the scrapers write.
+
+Responses are kept in an LRU cache with a TTL. The whole cache is dropped as
+soon as a run starts or finishes (a new parser_runs row, or one more with
+finished_at set), so a finished run is never hidden behind stale results.
+Rows of a run still in progress may show up to CACHE_TTL seconds late.
+"""
+import argparse
+import json
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+import storage
+
+# Indexes behind the fixed endpoints, created on start-up for the tables that exist
+READ_INDEXES = {
+    "offers": "CREATE INDEX IF NOT EXISTS idx_offers_category_seller ON offers (category, removed_at, user_id)",
+    "lots": "CREATE INDEX IF NOT EXISTS idx_lots_game ON lots (game_id, lot_name, lot_url)",
+    "orders": "CREATE INDEX IF NOT EXISTS idx_orders_game_run ON orders (game_id, run_id, price)",
+}
+
+CACHE_SIZE = 1024
+CACHE_TTL = 30.0
+# Seconds between checks for a new parser_runs row
+RUN_CHECK_INTERVAL = 1.0
+MAX_LIMIT = 1000
+
+def ensure_indexes(db_name):
+    """Create READ_INDEXES on the tables present in `db_name`; schema and data migrations are left to the writers"""
+    conn = storage.connect(db_name)
+    try:
+        tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for table, sql in READ_INDEXES.items():
+            if table in tables:
+                conn.execute(sql)
+        conn.commit()
+    finally:
+        conn.close()
+
+class ResultCache:
+    """LRU cache of encoded responses, each valid for `ttl` seconds"""
+
+    def __init__(self, maxsize=CACHE_SIZE, ttl=CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] < time.monotonic():
+                self.stats["misses"] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.stats["invalidations"] += 1
+
+def _limit(params, default):
+    try:
+        return max(1, min(int(params.get("limit", default)), MAX_LIMIT))
+    except ValueError:
+        return default
+
+def _float(params, name):
+    try:
+        return float(params[name]) if name in params else None
+    except ValueError:
+        return None
+
+def _rows(cursor):
+    names = [column[0] for column in cursor.description]
+    return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+def games(conn, params):
+    return _rows(conn.execute("SELECT game_id, game_title, game_url, last_seen_run FROM games ORDER BY game_id"))
+
+def game_metrics(conn, params, game_id):
+    # One backward range scan of idx_game_metrics_series per category, so each series gets `limit` points
+    if "category" in params:
+        categories = conn.execute("SELECT category_id, name FROM categories WHERE name = ?", (params["category"],))
+    else:
+        categories = conn.execute("SELECT category_id, name FROM categories ORDER BY name")
+    series = {}
+    for category_id, name in categories.fetchall():
+        points = conn.execute('''
+            SELECT parser_runs.timestamp, game_metrics.value
+            FROM game_metrics JOIN parser_runs ON parser_runs.run_id = game_metrics.run_id
+            WHERE game_metrics.game_id = ? AND game_metrics.category_id = ?
+            ORDER BY game_metrics.run_id DESC LIMIT ?
+        ''', (int(game_id), category_id, _limit(params, 100))).fetchall()
+        if points:
+            series[name] = [list(point) for point in reversed(points)]
+    return series
+
+def game_lots(conn, params, game_id):
+    return _rows(conn.execute(
+        "SELECT DISTINCT lot_name, lot_url FROM lots WHERE game_id = ? ORDER BY lot_name", (int(game_id),)
+    ))
+
+def game_orders(conn, params, game_id):
+    return _rows(conn.execute('''
+        SELECT run_id, user_id, user_name, description, price, currency, stock, link, timestamp
+        FROM orders WHERE game_id = ? ORDER BY run_id DESC LIMIT ?
+    ''', (int(game_id), _limit(params, 50))))
+
+def game_orders_summary(conn, params, game_id):
+    return _rows(conn.execute('''
+        SELECT run_id, COUNT(*) AS offers, MIN(price) AS min_price, AVG(price) AS avg_price, MAX(price) AS max_price
+        FROM orders WHERE game_id = ? GROUP BY run_id ORDER BY run_id DESC LIMIT ?
+    ''', (int(game_id), _limit(params, 24))))
+
+def category_sellers(conn, params, category):
+    return _rows(conn.execute('''
+        SELECT ranked.user_id, users.username, users.seller_rating, users.total_reviews, ranked.offers
+        FROM (
+            SELECT user_id, COUNT(*) AS offers FROM offers
+            WHERE category = ? AND removed_at IS NULL
+            GROUP BY user_id ORDER BY offers DESC LIMIT ?
+        ) AS ranked
+        LEFT JOIN users ON users.user_id = ranked.user_id
+        ORDER BY ranked.offers DESC, ranked.user_id
+    ''', (category, _limit(params, 20))))
+
+def category_offers(conn, params, category):
+    # amount BETWEEN, ordered by amount: one range scan over idx_offers_category_amount
+    low, high = _float(params, "min_price"), _float(params, "max_price")
+    return _rows(conn.execute('''
+        SELECT user_id, offer_key, description, amount, currency, stock, server_or_platform, link
+        FROM offers
+        WHERE category = ? AND amount BETWEEN ? AND ? AND removed_at IS NULL
+        ORDER BY amount LIMIT ?
+    ''', (category, -1e308 if low is None else low, 1e308 if high is None else high, _limit(params, 20))))
+
+def user(conn, params, user_id):
+    rows = _rows(conn.execute('''
+        SELECT user_id, username, status_timestamp, registration_timestamp, seller_rating, total_reviews,
+               created_at, updated_at
+        FROM users WHERE user_id = ?
+    ''', (int(user_id),)))
+    return rows[0] if rows else None
+
+def user_offers(conn, params, user_id):
+    return _rows(conn.execute('''
+        SELECT offer_key, category, description, price, amount, currency, server_or_platform, in_stock, stock,
+               link, first_seen
+        FROM offers WHERE user_id = ? AND removed_at IS NULL ORDER BY offer_key
+    ''', (int(user_id),)))
+
+def runs(conn, params):
+    limit = _limit(params, 20)
+    try:
+        return _rows(conn.execute('''
+            SELECT parser_runs.run_id, parser_runs.timestamp, duration.value AS duration_seconds,
+                   throughput.value AS pages_per_second
+            FROM parser_runs
+            LEFT JOIN run_metrics AS duration
+                ON duration.run_id = parser_runs.run_id AND duration.metric = 'duration_seconds'
+            LEFT JOIN run_metrics AS throughput
+                ON throughput.run_id = parser_runs.run_id AND throughput.metric = 'pages_per_second'
+            ORDER BY parser_runs.run_id DESC LIMIT ?
+        ''', (limit,)))
+    except sqlite3.OperationalError:
+        # Database written before run_metrics existed
+        return _rows(conn.execute("SELECT run_id, timestamp FROM parser_runs ORDER BY run_id DESC LIMIT ?", (limit,)))
+
+ROUTES = [
+    (re.compile(r"^/games$"), games),
+    (re.compile(r"^/games/(\d+)/metrics$"), game_metrics),
+    (re.compile(r"^/games/(\d+)/lots$"), game_lots),
+    (re.compile(r"^/games/(\d+)/orders$"), game_orders),
+    (re.compile(r"^/games/(\d+)/orders/summary$"), game_orders_summary),
+    (re.compile(r"^/categories/([^/]+)/sellers$"), category_sellers),
+    (re.compile(r"^/categories/([^/]+)/offers$"), category_offers),
+    (re.compile(r"^/users/(\d+)$"), user),
+    (re.compile(r"^/users/(\d+)/offers$"), user_offers),
+    (re.compile(r"^/runs$"), runs),
+]
+
+class ReadApi:
+    """Routes, per-thread read-only connections and the result cache of one database"""
+
+    def __init__(self, db_name='funpay.db', cache=None):
+        self.db_name = db_name
+        self.cache = cache or ResultCache()
+        self.local = threading.local()
+        self.run_lock = threading.Lock()
+        self.last_run_id = None
+        self.runs_state = None
+        self.run_checked = 0.0
+
+    def _conn(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = storage.connect(self.db_name, readonly=True, check_same_thread=False)
+        return conn
+
+    def _check_runs(self):
+        """Drop the cache when a run has started or finished since the last check"""
+        with self.run_lock:
+            if time.monotonic() - self.run_checked < RUN_CHECK_INTERVAL:
+                return
+            self.run_checked = time.monotonic()
+            try:
+                state = self._conn().execute(
+                    "SELECT MAX(run_id), COUNT(finished_at), MAX(finished_at) FROM parser_runs"
+                ).fetchone()
+            except sqlite3.OperationalError:
+                # parser_runs from before finished_at: only new runs are seen
+                state = self._conn().execute("SELECT MAX(run_id), 0, NULL FROM parser_runs").fetchone()
+            if state != self.runs_state:
+                self.runs_state = state
+                self.last_run_id = state[0]
+                self.cache.clear()
+
+    def handle(self, target):
+        """(status, encoded JSON body, cache status) for a request target such as /games/1/lots?limit=5"""
+        url = urlsplit(target)
+        path = unquote(url.path).rstrip("/") or "/"
+        if path == "/stats":
+            body = {**self.cache.stats, "entries": len(self.cache.entries), "last_run_id": self.last_run_id}
+            return 200, json.dumps(body).encode("utf-8"), "BYPASS"
+
+        self._check_runs()
+        key = path + "?" + url.query
+        cached = self.cache.get(key)
+        if cached is not None:
+            return 200, cached, "HIT"
+
+        params = {name: values[-1] for name, values in parse_qs(url.query).items()}
+        for pattern, endpoint in ROUTES:
+            match = pattern.match(path)
+            if match is None:
+                continue
+            try:
+                result = endpoint(self._conn(), params, *match.groups())
+            except sqlite3.OperationalError as e:
+                return 503, json.dumps({"error": str(e)}).encode("utf-8"), "MISS"
+            except OverflowError:
+                # An ID past SQLite's 64-bit integers names nothing stored
+                return 404, b'{"error": "not found"}', "MISS"
+            except ValueError as e:
+                return 400, json.dumps({"error": str(e)}).encode("utf-8"), "MISS"
+            if result is None:
+                return 404, b'{"error": "not found"}', "MISS"
+            body = json.dumps(result).encode("utf-8")
+            self.cache.put(key, body)
+            return 200, body, "MISS"
+        return 404, b'{"error": "unknown endpoint"}', "MISS"
+
+def serve(db_name='funpay.db', host='127.0.0.1', port=8780):
+    """Start the API on a daemon thread; returns the ThreadingHTTPServer (call shutdown() to stop)"""
+    ensure_indexes(db_name)
+    api = ReadApi(db_name)
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Headers and body go out in two writes; without this, Nagle holds the body back for the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def do_GET(self):
+            status, body, cache_status = api.handle(self.path)
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("X-Cache", cache_status)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    server.daemon_threads = True
+    server.api = api
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the scraped dataset as a local read-only JSON API.")
+    parser.add_argument("--db", default="funpay.db")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8780)
+    args = parser.parse_args()
+
+    server = serve(args.db, args.host, args.port)
+    print(f"Read API on http://{args.host}:{server.server_address[1]}/ over {args.db}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import datetime
+import math
+
+HOUR = datetime.timedelta(hours=1)
+ONE_WEEK = datetime.timedelta(days=7)
+MAX_INTERVAL = datetime.timedelta(days=30)
+
+# Backoff for IDs that do not exist (yet) and for failed requests
+NOT_FOUND_INTERVAL = datetime.timedelta(days=1)
+NOT_FOUND_MAX_INTERVAL = datetime.timedelta(days=90)
+FAILED_INTERVAL = datetime.timedelta(minutes=10)
+FAILED_MAX_INTERVAL = datetime.timedelta(days=1)
+
+# Outcomes reported by parse_user_page
+PARSED = "parsed"
+NOT_FOUND = "not_found"
+FAILED = "failed"
+
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def activity_interval(profile, previous_reviews, since_last):
+    """
+    Recrawl interval for a parsed profile: a week for a dormant account, shrinking
+    with live activity (online now), review growth per day and number of offers,
+    down to hourly for busy sellers.
+    """
+    factor = 24 if profile["online"] else 1
+    factor *= 1 + math.log2(1 + len(profile["offers"])) / 2
+    if previous_reviews is not None and profile["total_reviews"] is not None and since_last:
+        growth_per_day = max(0, profile["total_reviews"] - previous_reviews) / max(since_last / datetime.timedelta(days=1), 1 / 24)
+        factor *= 1 + min(growth_per_day, 10)
+    return min(max(ONE_WEEK / factor, HOUR), MAX_INTERVAL)
+
+class RecrawlScheduler:
+    """
+    Staleness-ordered recrawl queue for user profiles.
+
+    crawl_schedule holds one row per known user ID with the time it is next due.
+    The index on next_due makes it a priority queue: due() is a single index range
+    scan, and record() re-queues an ID with an interval derived from what the
+    crawl saw. No per-ID lookup is needed in the crawl loop.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        db.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS crawl_schedule (
+                user_id INTEGER PRIMARY KEY,
+                next_due TEXT NOT NULL,
+                interval_s REAL NOT NULL,
+                misses INTEGER NOT NULL DEFAULT 0,
+                total_reviews INTEGER,
+                last_crawled TEXT
+            )
+        ''')
+        db.cursor.execute("CREATE INDEX IF NOT EXISTS idx_crawl_schedule_due ON crawl_schedule (next_due)")
+        db.cursor.execute("SELECT 1 FROM crawl_schedule LIMIT 1")
+        if db.cursor.fetchone() is None:
+            # First run: queue every known user a week after its last update, in one statement
+            db.cursor.execute(f'''
+                INSERT OR IGNORE INTO crawl_schedule (user_id, next_due, interval_s, total_reviews, last_crawled)
+                SELECT user_id, datetime(updated_at, '+7 days'), {ONE_WEEK.total_seconds()}, total_reviews, updated_at
+                FROM users
+            ''')
+        db.conn.commit()
+        self.pending = {}
+
+    def due(self, limit=100, now=None):
+        """Return up to `limit` IDs whose recrawl is due, most overdue first"""
+        self.db.flush()
+        now = (now or datetime.datetime.now()).strftime(TIME_FORMAT)
+        self.db.cursor.execute('''
+            SELECT user_id, misses, total_reviews, last_crawled FROM crawl_schedule
+            WHERE next_due <= ? ORDER BY next_due LIMIT ?
+        ''', (now, limit))
+        rows = self.db.cursor.fetchall()
+        self.pending = {row[0]: row[1:] for row in rows}
+        return [row[0] for row in rows]
+
+    def next_due_at(self):
+        """When the earliest queued recrawl is due, or None if the queue is empty"""
+        self.db.flush()
+        self.db.cursor.execute("SELECT MIN(next_due) FROM crawl_schedule")
+        value = self.db.cursor.fetchone()[0]
+        return datetime.datetime.strptime(value, TIME_FORMAT) if value else None
+
+    def record(self, user_id, outcome, profile=None, now=None):
+        """Re-queue `user_id` after a crawl with `outcome` (PARSED, NOT_FOUND or FAILED)"""
+        now = now or datetime.datetime.now()
+        misses, previous_reviews, last_crawled = self.pending.pop(user_id, (0, None, None))
+        since_last = now - datetime.datetime.strptime(last_crawled, TIME_FORMAT) if last_crawled else None
+
+        if outcome == PARSED:
+            interval = activity_interval(profile, previous_reviews, since_last)
+            misses = 0
+            total_reviews = profile["total_reviews"]
+            last_crawled = now.strftime(TIME_FORMAT)
+        else:
+            base, cap = (NOT_FOUND_INTERVAL, NOT_FOUND_MAX_INTERVAL) if outcome == NOT_FOUND else (FAILED_INTERVAL, FAILED_MAX_INTERVAL)
+            interval = min(base * 2 ** min(misses, 20), cap)
+            misses += 1
+            total_reviews = previous_reviews
+
+        self.db.batch.add('''
+            INSERT INTO crawl_schedule (user_id, next_due, interval_s, misses, total_reviews, last_crawled)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET
+                next_due = excluded.next_due,
+                interval_s = excluded.interval_s,
+                misses = excluded.misses,
+                total_reviews = excluded.total_reviews,
+                last_crawled = excluded.last_crawled
+        ''', (user_id, (now + interval).strftime(TIME_FORMAT), interval.total_seconds(), misses, total_reviews, last_crawled))
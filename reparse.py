@@ -0,0 +1,193 @@
+"""
+Rebuild games/metrics, lots, users and offers from the page archive, offline.
+
+Archived fetches are replayed in fetch order. Home and game pages rebuild the
+parser runs they were fetched for: each fetch carries its run's timestamp
+(main.py labels the archive), so a scheduled run that refreshed a batch of
+games without the home page is rebuilt as a run of its own. Fetches from
+before the labels start a run at every home page, and at the first game page
+fetched again since, stamped with their fetch time. Game pages and lot lists share the
+/en/lots/<id>/ URLs; the archived home pages tell them apart, and lot lists
+(with their following pages) are saved through LotCrawler under one lot
+crawl pass. Every profile and lot list fetch goes through the same write
+path as the live crawlers, so offers and offer_changes are rebuilt as well.
+The parsing runs in a process pool on all cores. Writes stay in the parent
+process and keep fetch order.
+
+    python reparse.py --db funpay_reparsed.db
+    python reparse.py --since "2024-10-01 00:00:00" --workers 4
+"""
+import argparse
+import datetime
+import functools
+import multiprocessing
+import os
+import re
+from urllib.parse import urljoin, urlparse
+
+from tqdm import tqdm
+
+from page_archive import PageArchive, TIME_FORMAT
+
+PAGE_KINDS = [
+    ("home", re.compile(r"^/en/$")),
+    # A game page or a lot list (or one of its following pages)
+    ("listing", re.compile(r"^(/en/lots/\d+/)")),
+    ("user", re.compile(r"^/en/users/(\d+)/$")),
+]
+
+def page_kind(url):
+    """'home', 'listing' or 'user' for an archived URL, or None for pages nothing is rebuilt from"""
+    path = urlparse(url).path
+    for kind, pattern in PAGE_KINDS:
+        if pattern.match(path):
+            return kind
+    return None
+
+_archive = None
+
+def _init_worker(archive_name):
+    global _archive
+    _archive = PageArchive(archive_name, readonly=True)
+
+@functools.lru_cache(maxsize=1024)
+def _parse_page(kind, content_hash):
+    from lot_scraper import parse_lot_page
+    from main import parse_games_page
+    from parse_funpay_users import extract_user_profile
+    from scraper import GameScraper
+
+    html = _archive.load(content_hash)
+    if kind == "home":
+        return parse_games_page(html)
+    if kind == "game":
+        return GameScraper.parse_game_page(html)
+    if kind == "lot":
+        return parse_lot_page(html)
+    return extract_user_profile(html)
+
+def _parse_fetch(fetch):
+    url, fetched_at, content_hash, kind, run = fetch
+    return fetch, _parse_page(kind, content_hash)
+
+def _resolve_listings(fetches, homes):
+    """
+    Replace each 'listing' fetch by a 'game' and/or 'lot' fetch, after the
+    game and lot list URLs of the parsed home pages; listings neither kind of
+    are dropped. A game page is only its first page, a lot list also its next ones.
+    """
+    game_paths, lot_paths = set(), set()
+    for games_data in homes:
+        for _, game_url, _, lots in games_data or ():
+            game_paths.add(urlparse(game_url).path)
+            lot_paths.update(urlparse(lot_url).path for _, lot_url in lots)
+
+    resolved = []
+    for url, fetched_at, content_hash, kind, run in fetches:
+        if kind != "listing":
+            resolved.append((url, fetched_at, content_hash, kind, run))
+            continue
+        parts = urlparse(url)
+        base = PAGE_KINDS[1][1].match(parts.path).group(1)
+        if parts.path == base and not parts.query and base in game_paths:
+            resolved.append((url, fetched_at, content_hash, "game", run))
+        if base in lot_paths:
+            resolved.append((url, fetched_at, content_hash, "lot", run))
+    return resolved
+
+def reparse(archive_name='page_archive.db', db_name='funpay_reparsed.db', workers=None, since=None, until=None, chunksize=16):
+    """Replay the archived fetches in [since, until) into `db_name`; returns per-kind page counts and the runs started"""
+    from db_manager import DatabaseManager
+    from lot_scraper import LotCrawler
+    from parse_funpay_users import setup_database, save_user_profile
+
+    archive = PageArchive(archive_name, readonly=True)
+    fetches = [(url, fetched_at, content_hash, page_kind(url), run)
+               for _, url, fetched_at, content_hash, run in archive.fetches(since, until)]
+    archive.close()
+    fetches = [fetch for fetch in fetches if fetch[3] is not None]
+
+    db = DatabaseManager(db_name, start_run=False)
+    setup_database(db)
+    crawler = LotCrawler(db)
+
+    counts = {"runs": 0, "home": 0, "game": 0, "lot": 0, "user": 0}
+    run_games = {}  # game page path -> game_id, from the last home page
+    current_run, refreshed = None, set()  # run label being rebuilt, game_ids it has a page of
+    lot_lists = {}  # lot list path -> [lot_url, fetched_at, pages, offers] being collected
+    try:
+        with multiprocessing.Pool(workers, _init_worker, (archive_name,)) as pool:
+            # Home pages first: they tell game pages from lot lists
+            homes = [fetch for fetch in fetches if fetch[3] == "home"]
+            fetches = _resolve_listings(fetches, [result for _, result in pool.imap(_parse_fetch, homes, chunksize)])
+            if any(fetch[3] == "lot" for fetch in fetches):
+                crawler.start_pass(restart=True)
+
+            results = pool.imap(_parse_fetch, fetches, chunksize)
+            for (url, fetched_at, _, kind, run), result in tqdm(results, total=len(fetches), desc="Re-parsing"):
+                fetched = datetime.datetime.strptime(fetched_at, TIME_FORMAT)
+                if kind == "home":
+                    if run is None or run != current_run:
+                        current_run, refreshed = run or fetched.strftime("%Y%m%d_%H%M%S"), set()
+                        db.start_run(current_run)
+                        counts["runs"] += 1
+                    games_data = [(game_id, game_url, game_title, [tuple(lot) for lot in lots])
+                                  for game_id, game_url, game_title, lots in result]
+                    db.insert_games(games_data)
+                    db.insert_lots(games_data)
+                    run_games = {urlparse(game_url).path: game_id for game_id, game_url, _, _ in games_data}
+                elif kind == "game":
+                    game_id = run_games.get(urlparse(url).path)
+                    if game_id is None or not result:
+                        continue
+                    # Labelled: the run it was fetched for. Unlabelled: a game refreshed again is the next batch
+                    if (run is not None and run != current_run) or (run is None and game_id in refreshed):
+                        current_run, refreshed = run or fetched.strftime("%Y%m%d_%H%M%S"), set()
+                        db.start_run(current_run)
+                        counts["runs"] += 1
+                    refreshed.add(game_id)
+                    db.update_game(game_id, result["counters"])
+                    db.save_orders(game_id, result["offers"], fetched_at)
+                elif kind == "lot":
+                    parts = urlparse(url)
+                    base = PAGE_KINDS[1][1].match(parts.path).group(1)
+                    if parts.path == base and not parts.query and base in lot_lists:
+                        # The list is fetched again: the previous visit is complete
+                        lot_url, first_fetched, pages, offers = lot_lists.pop(base)
+                        crawler.save(lot_url, "ok", pages, offers, first_fetched)
+                    lot = lot_lists.setdefault(base, [urljoin(url, base), fetched_at, 0, []])
+                    lot[2] += 1
+                    lot[3].extend(result["offers"])
+                elif result is not None:
+                    user_id = int(PAGE_KINDS[2][1].match(urlparse(url).path).group(1))
+                    save_user_profile(db, user_id, result, fetched)
+                counts[kind] += 1
+            for lot_url, fetched_at, pages, offers in lot_lists.values():
+                crawler.save(lot_url, "ok", pages, offers, fetched_at)
+            if crawler.pass_id is not None:
+                crawler.finish_pass()
+    finally:
+        db.close()
+    return counts
+
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild the database from the raw page archive, without network.")
+    parser.add_argument("--archive", default=os.environ.get("FUNPAY_ARCHIVE") or "page_archive.db", help="page archive file")
+    parser.add_argument("--db", default="funpay_reparsed.db", help="database to rebuild into (best a fresh file)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="parser processes")
+    parser.add_argument("--since", help="first fetch time to replay, YYYY-mm-dd HH:MM:SS")
+    parser.add_argument("--until", help="replay fetches before this time")
+    args = parser.parse_args()
+
+    archive = PageArchive(args.archive, readonly=True)
+    stats = archive.stats()
+    archive.close()
+    print(f"Archive: {stats['fetches']} fetches of {stats['pages']} distinct pages, "
+          f"{stats['raw_bytes']} bytes stored in {stats['stored_bytes']}")
+
+    counts = reparse(args.archive, args.db, args.workers, args.since, args.until)
+    print(f"Rebuilt {args.db}: {counts['runs']} runs from {counts['home']} home pages, {counts['game']} game pages, "
+          f"{counts['lot']} lot list pages, {counts['user']} profiles")
+
+if __name__ == "__main__":
+    main()
@@ -1,93 +1,90 @@
 import re
 import requests
-from bs4 import BeautifulSoup
-import threading
-import time
-import random
+
+import profiling
+from extractors import extract
+from http_client import get_client, payload_version
+from prices import parse_price, parse_stock
 
 class GameScraper:
-    def scrape_game_data(self, game_url):
-        """Scrape game details from the provided URL with retry mechanism"""
-        max_retries = 5
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(game_url)
-                response.raise_for_status()
-                soup = BeautifulSoup(response.text, "html.parser")
+    """
+    Fetches game pages and returns their counters. The offer rows of each page
+    are handed to `on_offers(game_url, offers)` when one is given, e.g. a
+    DatabaseManager.save_orders writer.
+    """
 
-                counter_list = soup.find("div", class_="counter-list")
-                if not counter_list:
-                    return None
+    def __init__(self, client=None, on_offers=None):
+        self.client = client or get_client()
+        self.on_offers = on_offers
 
-                game_data = {}
-                for a_tag in counter_list.find_all("a", class_="counter-item"):
-                    inside_div = a_tag.find("div", class_="inside")
-                    param_div = inside_div.find("div", class_="counter-param")
-                    value_div = inside_div.find("div", class_="counter-value")
+    def fetch_game_page(self, game_url):
+        """Conditionally fetch and parse a game page into {"counters", "offers"}, raising requests errors to the caller"""
+        with profiling.stage("game_scrape"):
+            return self.client.get_parsed(game_url, self.parse_game_page)
 
-                    if param_div and value_div:
-                        category = (param_div.text.strip())
-                        category = re.sub(r'[^a-zA-Z0-9_]', '', category)
-                        value = int(value_div.text.strip())
-                        game_data[category] = value
+    def emit(self, game_url, page):
+        """Pass the offers of a fetched page to `on_offers` and return its counters"""
+        if page is None:
+            return None
+        if self.on_offers is not None:
+            self.on_offers(game_url, page["offers"])
+        return page["counters"]
 
-                orders = soup.find_all('a', class_='tc-item')
-                # Loop through each order and extract the required information
-                for order in orders:
-                    # Extract the user ID and user name
-                    user_info = order.find('div', class_='media-user-name')
-                    user_id = int(order.find('div', class_='avatar-photo')['data-href'].split('/')[-2])
-                    user_name = user_info.text.strip() if user_info else 'N/A'
+    def fetch_game_data(self, game_url):
+        """Fetch a game page, emit its offers and return its {category: value} counters"""
+        return self.emit(game_url, self.fetch_game_page(game_url))
 
-                    # Extract the description
-                    description_div = order.find('div', class_='tc-desc-text')
-                    description = description_div.text.strip() if description_div else 'No description available'
+    # Version 3: results cached before offers were part of the page record have another shape
+    @staticmethod
+    @payload_version(3)
+    def parse_game_page(html):
+        """
+        Extract the counter categories of a game page into a {category: value}
+        dict, and its offers as [user_id, user_name, description, amount, currency, stock, link] rows.
+        """
+        record = extract("game_page", html)
 
-                    # Extract the price
-                    price = order.find('div', class_='tc-price').text.strip()
-    
-                    # Extract the link
-                    link = order['href']
+        if not record["counter_list"]:
+            return None
 
-                    print(f"User ID: {user_id}")
-                    print(f"User Name: {user_name}")
-                    print(f"Description: {description}")
-                    print(f"Price: {price}")
-                    print(f"Link: {link}")
+        counters = {}
+        for counter in record["counter_list"]["counters"]:
+            if counter["param"] is not None and counter["value"] is not None:
+                category = re.sub(r'[^a-zA-Z0-9_]', '', counter["param"])
+                counters[category] = int(counter["value"])
 
-                return game_data
+        offers = []
+        for order in record["offers"]:
+            if not order["avatar_href"]:
+                continue
+            amount, currency = parse_price(order["price_value"] or order["price"])
+            offers.append([
+                int(order["avatar_href"].rstrip('/').split('/')[-1]),
+                order["user_name"] or 'N/A',
+                order["description"] or 'No description available',
+                amount,
+                currency,
+                parse_stock(order["amount"]),
+                order["link"],
+            ])
 
-            except requests.HTTPError as http_err:
-                if http_err.response.status_code == 429:
-                    retry_after = int(http_err.response.headers.get("Retry-After", 2))
-                    print(f"Rate limited. Retrying after {retry_after} seconds...")
-                    time.sleep(retry_after)
-                else:
-                    print(f"HTTP error occurred: {http_err}")
-                    return None
-            except requests.RequestException as e:
-                print(f"Failed to fetch {game_url}: {e}")
-                return None
+        return {"counters": counters, "offers": offers}
 
-        print(f"Failed to fetch {game_url} after {max_retries} attempts.")
+    def scrape_game_data(self, game_url):
+        """Scrape game details from the provided URL (429s are retried by the client's rate limiter)"""
+        try:
+            return self.fetch_game_data(game_url)
+        except requests.HTTPError as http_err:
+            print(f"HTTP error occurred: {http_err}")
+        except requests.RequestException as e:
+            print(f"Failed to fetch {game_url}: {e}")
         return None
 
-    def scrape_multiple_games(self, game_urls):
-        """Scrape multiple game URLs with a delay of 2 seconds between each request"""
-        def scrape_with_delay(url):
-            game_data = self.scrape_game_data(url)
-            print(f"Scraped data: {game_data}")
-            # Add a random delay between requests to avoid rate limiting
-            time.sleep(random.uniform(2, 5))
-
-        threads = []
-        for url in game_urls:
-            thread = threading.Thread(target=scrape_with_delay, args=(url,))
-            threads.append(thread)
-            thread.start()
+    def scrape_multiple_games(self, game_urls, concurrency=8):
+        """Scrape multiple game URLs concurrently, returning {url: game_data}"""
+        from async_scraper import AsyncGameScraper
 
-        for thread in threads:
-            thread.join()
+        return AsyncGameScraper(self, concurrency=concurrency).run(game_urls)
 
 # Example usage
 if __name__ == "__main__":
@@ -97,5 +94,6 @@ if __name__ == "__main__":
         "https://funpay.com/en/lots/2867/",
         "https://funpay.com/en/lots/2868/"
     ]
-    scraper.scrape_multiple_games(game_urls)
+    for url, game_data in scraper.scrape_multiple_games(game_urls).items():
+        print(f"Scraped data for {url}: {game_data}")
     print("Scraping completed.")
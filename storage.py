@@ -0,0 +1,87 @@
+"""
+One way to open the project's SQLite files, with the same tuning everywhere.
+
+connect() applies the PRAGMA profile below to every read-write connection:
+WAL so readers never block the writer, synchronous=NORMAL (durable at each
+checkpoint, which is safe in WAL mode), a 64 MiB page cache, 256 MiB of
+memory-mapped I/O, in-memory temp tables and a busy timeout. With the busy
+timeout, a second script waits for the lock instead of failing with
+"database is locked". The statement cache holds the prepared form of every
+parameterised query we run, so executemany loops never re-prepare.
+
+connect(readonly=True) opens the file read-only (mode=ro, query_only) for
+analysis and reports. It gets the same cache and mmap settings, but cannot
+change the journal mode.
+
+WalCheckpointer runs a PASSIVE checkpoint (it never waits for readers)
+every few minutes from the writer, and close_writer() a TRUNCATE one.
+Together with journal_size_limit this keeps the -wal file from growing
+without bound while long crawls hold it open.
+"""
+import sqlite3
+import time
+
+# Seconds a connection waits for a lock held by another process before failing
+BUSY_TIMEOUT = 30
+# Prepared statements kept per connection (sqlite3 default: 128)
+STATEMENT_CACHE = 256
+
+PRAGMAS = {
+    "journal_mode": "WAL",
+    "synchronous": "NORMAL",
+    "cache_size": -64 * 1024,  # KiB
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+    "journal_size_limit": 64 * 1024 * 1024,
+}
+READONLY_PRAGMAS = {
+    "query_only": "ON",
+    "cache_size": -64 * 1024,
+    "mmap_size": 256 * 1024 * 1024,
+    "temp_store": "MEMORY",
+}
+
+# Seconds between WAL checkpoints on a writing connection
+CHECKPOINT_INTERVAL = 300
+
+def connect(db_name='funpay.db', readonly=False, **kwargs):
+    """sqlite3 connection to `db_name` with the project's PRAGMA profile; extra kwargs go to sqlite3.connect"""
+    kwargs.setdefault("timeout", BUSY_TIMEOUT)
+    kwargs.setdefault("cached_statements", STATEMENT_CACHE)
+    if readonly:
+        conn = sqlite3.connect(f"file:{db_name}?mode=ro", uri=True, **kwargs)
+        pragmas = READONLY_PRAGMAS
+    else:
+        conn = sqlite3.connect(db_name, **kwargs)
+        pragmas = PRAGMAS
+    for name, value in pragmas.items():
+        conn.execute(f"PRAGMA {name}={value}")
+    return conn
+
+def checkpoint(conn, mode="TRUNCATE"):
+    """Run a WAL checkpoint; returns (busy, wal frames, frames checkpointed)"""
+    return conn.execute(f"PRAGMA wal_checkpoint({mode})").fetchone()
+
+class WalCheckpointer:
+    """Checkpoints a writing connection at most every `interval` seconds; call maybe() after commits"""
+
+    def __init__(self, conn, interval=CHECKPOINT_INTERVAL):
+        self.conn = conn
+        self.interval = interval
+        self.last = time.monotonic()
+
+    def maybe(self):
+        if time.monotonic() - self.last < self.interval or self.conn.in_transaction:
+            return None
+        self.last = time.monotonic()
+        return checkpoint(self.conn, "PASSIVE")
+
+def close_writer(conn):
+    """Checkpoint the WAL back into the database file (best effort) and close"""
+    try:
+        # Give readers a moment to finish rather than the full busy timeout
+        conn.execute("PRAGMA busy_timeout=1000")
+        checkpoint(conn)
+    except sqlite3.Error:
+        pass
+    conn.close()
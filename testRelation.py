@@ -1,7 +1,7 @@
-import sqlite3
+import storage
 
-# Connect to the SQLite database
-conn = sqlite3.connect('funpay.db')
+# Connect to the SQLite database (read-only: this only builds a report)
+conn = storage.connect('funpay.db', readonly=True)
 cursor = conn.cursor()
 
 # Query the games and their related lots